@@ -0,0 +1,239 @@
+import re
+import time
+import uuid
+import random
+from collections import defaultdict
+
+import pandas as pd
+
+# Length of the postal code prefix used as blocking key
+POSTAL_PREFIX_LENGTH = 3
+
+# Number of significant name tokens that produce a phonetic key
+NAME_KEY_TOKENS = 2
+
+# Tokens that carry no information about which site a record refers to
+NAME_STOPWORDS = {
+    "the", "of", "and", "inc", "incorporated", "ltd", "limited", "llc", "co", "corp",
+    "corporation", "company", "gmbh", "ag", "sa", "srl", "spa", "bv", "zrt", "kft",
+    "plc", "pvt", "private", "sro",
+}
+
+SOUNDEX_CODES = {
+    **dict.fromkeys("bfpv", "1"),
+    **dict.fromkeys("cgjkqsxz", "2"),
+    **dict.fromkeys("dt", "3"),
+    "l": "4",
+    **dict.fromkeys("mn", "5"),
+    "r": "6",
+}
+
+
+# Function to normalize a field for use inside a blocking key
+def normalize_key_text(text):
+    if not isinstance(text, str):
+        return ""
+    return re.sub(r"[^a-z0-9]+", " ", text.lower()).strip()
+
+
+# Function to compute the Soundex code of a single token
+def soundex(token):
+    if not token:
+        return ""
+    if not token[0].isalpha():
+        # Numbers are kept verbatim, they are already a good key
+        return token
+    code = token[0]
+    previous = SOUNDEX_CODES.get(token[0], "")
+    for char in token[1:]:
+        digit = SOUNDEX_CODES.get(char, "")
+        if digit and digit != previous:
+            code += digit
+        if char not in "hw":
+            previous = digit
+    return (code + "000")[:4]
+
+
+def name_tokens(company_name):
+    """
+    Split a company name into the tokens used for blocking.
+    Legal suffixes and filler words are dropped unless nothing else is left.
+    :param company_name: Raw company name.
+    :return: List of normalized tokens.
+    """
+    tokens = normalize_key_text(company_name).split()
+    significant = [token for token in tokens if token not in NAME_STOPWORDS]
+    return significant or tokens
+
+
+def blocking_keys(record):
+    """
+    Compute the blocking keys of a company record.
+    A record is a candidate for another one when they share at least one key.
+    :param record: Mapping with company_name, postal_code and country fields.
+    :return: Set of hashable blocking keys.
+    """
+    keys = set()
+
+    # Normalized country + postal-code prefix
+    postal_code = normalize_key_text(record.get("postal_code")).replace(" ", "")
+    if postal_code:
+        country = normalize_key_text(record.get("country"))
+        keys.add(("postal", country, postal_code[:POSTAL_PREFIX_LENGTH]))
+
+    # Phonetic keys of the first significant name tokens
+    for token in name_tokens(record.get("company_name"))[:NAME_KEY_TOKENS]:
+        keys.add(("name", soundex(token)))
+
+    return keys
+
+
+def add_to_blocking_index(blocking_index, record, position):
+    """
+    Register a company record in the blocking index.
+    :param blocking_index: Index created by build_blocking_index.
+    :param record: Company record.
+    :param position: Row position of the record in the companies table.
+    """
+    for key in blocking_keys(record):
+        blocking_index[key].append(position)
+
+
+def build_blocking_index(companies_df):
+    """
+    Build a blocking index over the companies table.
+    :param companies_df: DataFrame with the companies master.
+    :return: Mapping of blocking key to list of row positions.
+    """
+    blocking_index = defaultdict(list)
+    records = companies_df[["company_name", "postal_code", "country"]].to_dict("records")
+    for position, record in enumerate(records):
+        add_to_blocking_index(blocking_index, record, position)
+    return blocking_index
+
+
+def candidate_positions(blocking_index, record):
+    """
+    Get the companies that may match a record.
+    :param blocking_index: Index created by build_blocking_index.
+    :param record: Query record.
+    :return: Sorted list of candidate row positions, so the first match in
+             table order is still the one that wins.
+    """
+    candidates = set()
+    for key in blocking_keys(record):
+        candidates.update(blocking_index.get(key, ()))
+    return sorted(candidates)
+
+
+def blocking_recall_report(query_records, companies_df, similarity_fn):
+    """
+    Compare blocked candidate generation against the exhaustive comparison.
+    :param query_records: List of query records.
+    :param companies_df: DataFrame with the companies master.
+    :param similarity_fn: Function (query, company_row) -> bool, e.g. is_similar.
+    :return: Dictionary with recall, reduction ratio and timings.
+    """
+    company_rows = companies_df.to_dict("records")
+
+    # Exhaustive comparison, the ground truth for the report
+    start = time.perf_counter()
+    true_matches = set()
+    for query_position, query in enumerate(query_records):
+        for position, company_row in enumerate(company_rows):
+            if similarity_fn(query, company_row):
+                true_matches.add((query_position, position))
+    exhaustive_seconds = time.perf_counter() - start
+
+    # Blocked comparison
+    start = time.perf_counter()
+    blocking_index = build_blocking_index(companies_df)
+    blocked_matches = set()
+    compared_pairs = 0
+    for query_position, query in enumerate(query_records):
+        candidates = candidate_positions(blocking_index, query)
+        compared_pairs += len(candidates)
+        for position in candidates:
+            if similarity_fn(query, company_rows[position]):
+                blocked_matches.add((query_position, position))
+    blocked_seconds = time.perf_counter() - start
+
+    total_pairs = len(query_records) * len(company_rows)
+    return {
+        "queries": len(query_records),
+        "companies": len(company_rows),
+        "true_matches": len(true_matches),
+        "found_matches": len(blocked_matches & true_matches),
+        "recall": len(blocked_matches & true_matches) / len(true_matches) if true_matches else 1.0,
+        "compared_pairs": compared_pairs,
+        "reduction_ratio": 1 - compared_pairs / total_pairs if total_pairs else 0.0,
+        "exhaustive_seconds": exhaustive_seconds,
+        "blocked_seconds": blocked_seconds,
+        "speedup": exhaustive_seconds / blocked_seconds if blocked_seconds else float("inf"),
+    }
+
+
+# Function to introduce a typo in a string, used to build noisy duplicates
+def _add_typo(text, rng):
+    if len(text) < 4:
+        return text
+    position = rng.randrange(1, len(text) - 1)
+    return text[:position] + text[position + 1] + text[position] + text[position + 2:]
+
+
+def generate_synthetic_companies(n_companies, n_queries, seed=42):
+    """
+    Generate a synthetic companies table and noisy query records that
+    duplicate some of its rows, used to measure blocking recall.
+    :param n_companies: Number of companies in the master table.
+    :param n_queries: Number of query records.
+    :param seed: Random seed.
+    :return: Tuple (companies_df, query_records).
+    """
+    rng = random.Random(seed)
+    words = ["Alpha", "Nova", "Medi", "Bio", "Gen", "Pharma", "Lab", "Chem", "Vita", "Sano",
+             "Cura", "Apex", "Zen", "Orion", "Helix", "Terra", "Luma", "Vector", "Prime", "Aster"]
+    suffixes = ["Inc.", "Ltd.", "GmbH", "S.R.L.", "Co., Ltd.", "LLC", ""]
+    countries = ["USA", "China", "India", "Germany", "HU (Hungary)", "RO (Romania)"]
+
+    companies = []
+    for _ in range(n_companies):
+        companies.append({
+            "company_id": str(uuid.UUID(int=rng.getrandbits(128))),
+            "company_name": f"{rng.choice(words)}{rng.choice(words).lower()} {rng.choice(words)} {rng.choice(suffixes)}".strip(),
+            "address": f"{rng.randint(1, 999)} {rng.choice(words)} St",
+            "locality": rng.choice(words) + " City",
+            "region": rng.choice(words)[:2].upper(),
+            "postal_code": str(rng.randint(10000, 99999)),
+            "country": rng.choice(countries),
+            "oms_organisation_id": None,
+            "oms_location_id": None,
+        })
+
+    queries = []
+    for _ in range(n_queries):
+        company = dict(rng.choice(companies))
+        # Half of the queries are noisy duplicates, the rest are unrelated sites
+        if rng.random() < 0.5:
+            company["company_name"] = _add_typo(company["company_name"], rng)
+            company["address"] = _add_typo(company["address"], rng)
+        else:
+            company["company_name"] = f"{rng.choice(words)}{rng.choice(words).lower()} {rng.choice(words)}"
+            company["postal_code"] = str(rng.randint(10000, 99999))
+        queries.append(company)
+
+    return pd.DataFrame(companies), queries
+
+
+if __name__ == "__main__":
+    from cross_reference_datasets import is_similar
+
+    # Recall-vs-speed report on a synthetic master table
+    for n_companies in [1000, 2000]:
+        companies_df, query_records = generate_synthetic_companies(n_companies, n_queries=100)
+        report = blocking_recall_report(query_records, companies_df, is_similar)
+        print(f"Companies: {report['companies']}, queries: {report['queries']}")
+        print(f"  Recall: {report['recall']:.2%} ({report['found_matches']}/{report['true_matches']} true matches)")
+        print(f"  Compared pairs: {report['compared_pairs']} (reduction ratio {report['reduction_ratio']:.2%})")
+        print(f"  Exhaustive: {report['exhaustive_seconds']:.2f}s, blocked: {report['blocked_seconds']:.2f}s, "
+              f"speedup x{report['speedup']:.1f}")
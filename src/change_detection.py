@@ -0,0 +1,220 @@
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from sqlite_helpers import parameter_batches
+
+# Default location of the snapshot database
+SNAPSHOT_PATH = "../data/snapshots.db"
+
+# Columns added to the rows of a delta
+ROW_KEY_COLUMN = "row_key"
+CONTENT_HASH_COLUMN = "content_hash"
+CHANGE_COLUMN = "change"
+SNAPSHOT_COLUMNS = [ROW_KEY_COLUMN, CONTENT_HASH_COLUMN, CHANGE_COLUMN]
+
+INSERTED = "inserted"
+UPDATED = "updated"
+DELETED = "deleted"
+
+# Row position written by to_csv, not part of the content of a row
+IGNORED_COLUMNS = ["Unnamed: 0"]
+
+
+def open_snapshot_store(path=SNAPSHOT_PATH):
+    """
+    Open (or create) the SQLite database holding the last snapshot of every source.
+    :param path: Path of the database file.
+    :return: sqlite3 connection.
+    """
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS row_snapshots (
+        source TEXT NOT NULL,
+        row_key TEXT NOT NULL,
+        content_hash TEXT NOT NULL,
+        row_data TEXT NOT NULL,
+        updated_at TEXT,
+        PRIMARY KEY (source, row_key)
+    )
+    """)
+    conn.commit()
+    return conn
+
+
+def row_keys(df, key_column, key_function=None):
+    """
+    Key every row of a scraped table by its reference (report number, letter
+    link...). Rows sharing a reference are told apart by their occurrence
+    number, rows without one by their position.
+    :param df: Scraped table.
+    :param key_column: Column holding the reference of the rows.
+    :param key_function: Optional function mapping a reference to its key (e.g. parse_cache.letter_key).
+    :return: Series of unique string keys, aligned with df.
+    """
+    references = df[key_column]
+    keys = pd.Series([f"row_{position + 1}" if pd.isna(reference) else
+                      str(key_function(reference) if key_function else reference)
+                      for position, reference in enumerate(references)], index=df.index, dtype=object)
+    occurrence = keys.groupby(keys).cumcount()
+    return keys.where(occurrence == 0, keys + "#" + occurrence.astype(str))
+
+
+def content_hashes(df):
+    """
+    Hash the content of every row, independently of the column order and of
+    the dtypes the table was read with (values are compared as text).
+    :param df: Scraped table.
+    :return: Series of 16-character hex digests, aligned with df.
+    """
+    columns = sorted(column for column in df.columns if column not in IGNORED_COLUMNS + SNAPSHOT_COLUMNS)
+    text = df[columns].astype(object).where(df[columns].notna(), "").astype(str)
+    return pd.util.hash_pandas_object(text, index=False).map("{:016x}".format)
+
+
+def _json_rows(df):
+    columns = [column for column in df.columns if column not in SNAPSHOT_COLUMNS]
+    records = df[columns].astype(object).where(df[columns].notna(), None).to_dict("records")
+    return [json.dumps(record, default=str) for record in records]
+
+
+def load_snapshot(conn, source):
+    """
+    :return: Dictionary of row key to content hash of the last snapshot of a source.
+    """
+    return dict(conn.execute("SELECT row_key, content_hash FROM row_snapshots WHERE source = ?", (source,)))
+
+
+def stored_rows(conn, source, keys):
+    """
+    Fetch rows of the last snapshot, e.g. the former version of updated rows.
+    :param conn: Connection returned by open_snapshot_store.
+    :param source: Source name.
+    :param keys: List of row keys.
+    :return: DataFrame of the stored rows with their row_key column.
+    """
+    records = []
+    keys = list(keys)
+    for batch in parameter_batches(keys):
+        cursor = conn.execute(
+            "SELECT row_key, row_data FROM row_snapshots "
+            f"WHERE source = ? AND row_key IN ({','.join('?' * len(batch))})", [source] + batch)
+        records.extend(dict(json.loads(row_data), **{ROW_KEY_COLUMN: key}) for key, row_data in cursor)
+    return pd.DataFrame(records)
+
+
+def diff_snapshot(conn, source, df, key_column, key_function=None):
+    """
+    Compare a freshly scraped table with the last snapshot of its source.
+    The snapshot is left as it is: call commit_snapshot once the delta has
+    been processed, so a failed run emits it again.
+    :param conn: Connection returned by open_snapshot_store.
+    :param source: Source name (one snapshot per source and consumer).
+    :param df: Scraped table.
+    :param key_column: Column holding the reference of the rows.
+    :param key_function: Optional function mapping a reference to its key.
+    :return: DataFrame with the inserted and updated rows of df, then the
+             deleted rows as stored in the snapshot, with the row_key,
+             content_hash and change columns.
+    """
+    keys = row_keys(df, key_column, key_function)
+    hashes = content_hashes(df)
+    previous = load_snapshot(conn, source)
+    previous_hashes = keys.map(previous)
+
+    change = pd.Series(np.where(previous_hashes.isna(), INSERTED, np.where(previous_hashes != hashes, UPDATED, "")),
+                       index=df.index)
+    changed = df[change != ""].copy()
+    changed[ROW_KEY_COLUMN] = keys[change != ""]
+    changed[CONTENT_HASH_COLUMN] = hashes[change != ""]
+    changed[CHANGE_COLUMN] = change[change != ""]
+
+    deleted = stored_rows(conn, source, set(previous) - set(keys))
+    if len(deleted):
+        deleted[CONTENT_HASH_COLUMN] = deleted[ROW_KEY_COLUMN].map(previous)
+        deleted[CHANGE_COLUMN] = DELETED
+        changed = pd.concat([changed, deleted], ignore_index=True)
+    return changed.reset_index(drop=True)
+
+
+def commit_snapshot(conn, source, changes):
+    """
+    Apply a delta returned by diff_snapshot to the snapshot of its source.
+    :param conn: Connection returned by open_snapshot_store.
+    :param source: Source name.
+    :param changes: Delta returned by diff_snapshot.
+    """
+    updated_at = datetime.now().isoformat(timespec="seconds")
+    deleted = changes[CHANGE_COLUMN] == DELETED
+    current = changes[~deleted]
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO row_snapshots (source, row_key, content_hash, row_data, updated_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            zip([source] * len(current), current[ROW_KEY_COLUMN], current[CONTENT_HASH_COLUMN], _json_rows(current),
+                [updated_at] * len(current)))
+        conn.executemany("DELETE FROM row_snapshots WHERE source = ? AND row_key = ?",
+                         [(source, key) for key in changes.loc[deleted, ROW_KEY_COLUMN]])
+
+
+def change_counts(changes):
+    """
+    :return: Dictionary with the number of inserted, updated and deleted rows of a delta.
+    """
+    counts = changes[CHANGE_COLUMN].value_counts() if len(changes) else {}
+    return {change: int(counts.get(change, 0)) for change in [INSERTED, UPDATED, DELETED]}
+
+
+def write_changes(changes, path):
+    """
+    Save a delta for the downstream steps, next to the table it was computed from.
+    """
+    changes.to_csv(path, index=False)
+    print(f"Changes saved to {os.path.basename(path)}: {change_counts(changes)}")
+
+
+if __name__ == "__main__":
+    # Diff successive versions of a large synthetic reports table
+    parser = argparse.ArgumentParser(description="Benchmark the change detection on a synthetic table")
+    parser.add_argument("--rows", type=int, default=200_000, help="Rows of the table")
+    parser.add_argument("--changed", type=float, default=0.01, help="Share of rows changed between versions")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    table = pd.DataFrame({
+        "Report Number": [f"NCR-{number}" for number in range(args.rows)],
+        "Site Name": [f"Site {number}" for number in rng.integers(0, args.rows // 10, args.rows)],
+        "Issue Date": (pd.Timestamp("2015-01-01") + pd.to_timedelta(rng.integers(0, 3650, args.rows), unit="D"))
+        .strftime("%Y-%m-%d"),
+    })
+    # The first n_changed reports are updated, the next n_changed deleted, and n_changed new ones inserted
+    n_changed = int(args.rows * args.changed)
+    new_table = pd.concat([
+        table.iloc[:n_changed].assign(**{"Site Name": "Renamed site"}),
+        table.iloc[2 * n_changed:],
+        pd.DataFrame({"Report Number": [f"NCR-new-{number}" for number in range(n_changed)],
+                      "Site Name": "New site", "Issue Date": "2025-01-01"}),
+    ], ignore_index=True)
+
+    folder = tempfile.mkdtemp()
+    try:
+        conn = open_snapshot_store(os.path.join(folder, "snapshots.db"))
+        for label, version in [("first snapshot", table), ("unchanged", table), ("new version", new_table)]:
+            start = time.perf_counter()
+            changes = diff_snapshot(conn, "reports", version, "Report Number")
+            diff_seconds = time.perf_counter() - start
+            commit_snapshot(conn, "reports", changes)
+            print(f"{label}: {change_counts(changes)} in {diff_seconds:.2f}s "
+                  f"(commit {time.perf_counter() - start - diff_seconds:.2f}s)")
+        conn.close()
+    finally:
+        shutil.rmtree(folder)
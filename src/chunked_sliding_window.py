@@ -0,0 +1,258 @@
+import argparse
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from dataset_storage import MONTH_FORMAT, read_historical_records, write_historical_records
+from feature_aggregation import COUNT_FEATURES, SUM_FEATURES, MEAN_FEATURES
+from mock_history_generator import CURRENT_DATE, iter_history_chunks, records_per_supplier_counts
+from record_schema import ID_COLUMN, RECORD_CATEGORIES, apply_record_schema, read_historical_csv
+from sliding_window import (SLIDING_WINDOW_COLUMNS, finalize_window_partials, merge_window_partials,
+                            sliding_window_aggregate, window_bounds, window_partials)
+
+# Window parameters of generate_historical_dataset_and_aggregate_with_sliding_window.py
+ANALYSIS_WINDOW_SIZE = pd.DateOffset(months=12)
+PREDICTION_WINDOW_SIZE = pd.DateOffset(months=6)
+STEP_SIZE = pd.DateOffset(months=3)
+
+# Records read at a time from a CSV history
+CHUNK_ROWS = 500_000
+
+# Years covered by the mock history of the benchmark
+HISTORY_YEARS = 6
+
+# Columns of the historical records used by the sliding-window features
+AGGREGATION_COLUMNS = list(dict.fromkeys(
+    [ID_COLUMN, "record_date", "severity_level"] + [source for source, _ in COUNT_FEATURES.values()] +
+    list(SUM_FEATURES.values()) + list(MEAN_FEATURES.values()) + ["ncr_or_warning_letter"]))
+
+
+def month_partitions(path):
+    """
+    List the month partition directories of a Parquet history.
+    :param path: Root directory of the dataset.
+    :return: Sorted list of directory paths.
+    """
+    return sorted(os.path.join(path, name) for name in os.listdir(path) if name.startswith("record_month="))
+
+
+def supplier_partition(supplier_ids, n_partitions):
+    """
+    Assign suppliers to partitions by hashing their id, so all the records of a
+    supplier land in the same partition whatever chunk they are read in.
+    :param supplier_ids: Series of supplier ids.
+    :param n_partitions: Number of partitions.
+    :return: Array with the partition number of every id.
+    """
+    return pd.util.hash_pandas_object(supplier_ids.astype(str), index=False).to_numpy() % n_partitions
+
+
+def _month_batches(path, columns, chunksize):
+    # The files of the month partitions are read in order, chunksize records at most at a time, and
+    # consecutive reads are gathered into chunks of exactly chunksize records: a large month is split
+    # instead of being loaded whole, so a chunk does not grow with the records per month. The reads are
+    # gathered as Arrow tables and converted to a DataFrame once per chunk
+    batch, n_batch = [], 0
+    for partition_path in month_partitions(path):
+        for file_path in sorted(glob.glob(os.path.join(partition_path, "*.parquet"))):
+            for record_batch in pq.ParquetFile(file_path).iter_batches(batch_size=chunksize, columns=columns):
+                batch.append(pa.Table.from_batches([record_batch]))
+                n_batch += record_batch.num_rows
+                if n_batch >= chunksize:
+                    records = pa.concat_tables(batch, promote_options="permissive")
+                    yield apply_record_schema(records.slice(0, chunksize).to_pandas())
+                    batch, n_batch = [records.slice(chunksize)], n_batch - chunksize
+    if n_batch:
+        yield apply_record_schema(pa.concat_tables(batch, promote_options="permissive").to_pandas())
+
+
+def history_chunks(path, chunksize=CHUNK_ROWS, columns=None, n_partitions=1, partition=0):
+    """
+    Stream the historical records one chunk at a time: chunksize records of a
+    CSV file, or of the month partitions of a Parquet dataset in month order.
+    :param path: CSV file or partitioned Parquet directory.
+    :param chunksize: Records per chunk.
+    :param columns: Columns to load (default: the AGGREGATION_COLUMNS).
+    :param n_partitions: Number of supplier hash partitions the history is split into.
+    :param partition: Partition whose records are returned (see supplier_partition).
+    :return: Iterator of DataFrames with the compact dtypes of record_schema.
+    """
+    columns = columns or AGGREGATION_COLUMNS
+    if n_partitions > 1 and ID_COLUMN not in columns:
+        columns = [ID_COLUMN] + columns
+    if os.path.isdir(path):
+        chunks = _month_batches(path, columns, chunksize)
+    else:
+        dtypes = {column: "category" for column in [ID_COLUMN] + list(RECORD_CATEGORIES) if column in columns}
+        chunks = (apply_record_schema(chunk)
+                  for chunk in pd.read_csv(path, usecols=columns, dtype=dtypes, chunksize=chunksize))
+    for chunk in chunks:
+        if n_partitions > 1:
+            chunk = chunk[supplier_partition(chunk[ID_COLUMN], n_partitions) == partition]
+        if len(chunk):
+            yield chunk
+
+
+def history_date_range(path, chunksize=CHUNK_ROWS):
+    """
+    Find the first and last record dates of a history, reading only its record_date column.
+    :return: (first date, last date) timestamps, None for an empty history.
+    """
+    first_date = last_date = None
+    for chunk in history_chunks(path, chunksize, columns=["record_date"]):
+        dates = chunk["record_date"]
+        first_date = dates.min() if first_date is None else min(first_date, dates.min())
+        last_date = dates.max() if last_date is None else max(last_date, dates.max())
+    return first_date, last_date
+
+
+def chunked_sliding_window_aggregate(path, analysis_window_size=ANALYSIS_WINDOW_SIZE,
+                                     prediction_window_size=PREDICTION_WINDOW_SIZE, step_size=STEP_SIZE,
+                                     chunksize=CHUNK_ROWS, n_partitions=1):
+    """
+    Aggregate a history that does not fit in memory over sliding windows.
+    The records are streamed chunk by chunk, each chunk is reduced to
+    mergeable partials per (window, supplier) and the partials are merged as
+    they accumulate, so only one chunk of records is held at a time. Memory is
+    bounded by one chunk plus the partials, at most one row per (window,
+    supplier) whatever the number of records. With n_partitions > 1 the
+    history is read once per supplier hash partition, which also divides the
+    partials held while reading.
+    :param path: CSV file or partitioned Parquet directory with the historical records.
+    :param analysis_window_size: DateOffset of the analysis window.
+    :param prediction_window_size: DateOffset of the prediction window.
+    :param step_size: DateOffset between two consecutive windows.
+    :param chunksize: Records per chunk.
+    :param n_partitions: Number of supplier hash partitions.
+    :return: DataFrame in the layout and order of sliding_window_aggregate.
+    """
+    # Windows follow each other from the first record, as in sliding_window_aggregate
+    first_date, last_date = history_date_range(path, chunksize)
+    if first_date is None:
+        return pd.DataFrame(columns=SLIDING_WINDOW_COLUMNS)
+    windows = window_bounds(first_date, last_date, analysis_window_size, prediction_window_size, step_size)
+    if not windows:
+        return pd.DataFrame(columns=SLIDING_WINDOW_COLUMNS)
+
+    partition_partials = []
+    for partition in range(n_partitions):
+        merged, pending, n_pending = None, [], 0
+        for chunk in history_chunks(path, chunksize, n_partitions=n_partitions, partition=partition):
+            pending.append(window_partials(chunk, windows))
+            n_pending += len(pending[-1])
+            # Merge once the pending partials outgrow the merged ones, so each partial is merged a few times only
+            if n_pending >= (0 if merged is None else len(merged)):
+                merged = merge_window_partials(pending if merged is None else [merged] + pending)
+                pending, n_pending = [], 0
+        if pending:
+            merged = merge_window_partials(pending if merged is None else [merged] + pending)
+        if merged is not None:
+            partition_partials.append(merged)
+    return finalize_window_partials(merge_window_partials(partition_partials), windows)
+
+
+def peak_memory_mb():
+    """
+    :return: Peak resident memory of the process in MB (Linux; the maxrss of
+             getrusage would include the parent process it was started from).
+    """
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+
+
+def write_flagged_mock_history(csv_path, parquet_path, n_records, n_suppliers, rng):
+    """
+    Stream a mock history over HISTORY_YEARS, with a random NCR / warning
+    letter flag, to CSV and to a partitioned Parquet dataset, one chunk in
+    memory at a time.
+    """
+    counts = records_per_supplier_counts(n_suppliers, rng, n_records=n_records)
+    for chunk_number, chunk in enumerate(iter_history_chunks(n_suppliers, counts, rng)):
+        days_before = rng.integers(1, HISTORY_YEARS * 365, len(chunk))
+        chunk["record_date"] = CURRENT_DATE - pd.to_timedelta(days_before, unit="D")
+        chunk["ncr_or_warning_letter"] = rng.integers(0, 2, len(chunk))
+        chunk.to_csv(csv_path, mode="w" if chunk_number == 0 else "a", header=chunk_number == 0, index=False)
+        write_historical_records(chunk, parquet_path, chunk_name=f"chunk-{chunk_number:05d}")
+
+
+if __name__ == "__main__":
+    # Compare the chunked aggregation with the in-memory one on mock histories of growing size,
+    # each run in its own process to measure its peak memory
+    parser = argparse.ArgumentParser(description="Aggregate a history over sliding windows chunk by chunk")
+    parser.add_argument("--records", type=int, nargs="+", default=[1_000_000, 2_000_000, 4_000_000],
+                        help="Records of the mock histories")
+    parser.add_argument("--suppliers", type=int, default=5_000, help="Suppliers of the mock history")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS, help="Records per chunk")
+    parser.add_argument("--partitions", type=int, default=1, help="Supplier hash partitions")
+    parser.add_argument("--history", help="Only aggregate this history (CSV file or Parquet directory)")
+    parser.add_argument("--in-memory", action="store_true", help="Aggregate the history in one DataFrame")
+    parser.add_argument("--output", help="Parquet file written by --history")
+    args = parser.parse_args()
+
+    if args.history:
+        import_mb = peak_memory_mb()
+        start = time.perf_counter()
+        if args.in_memory:
+            data = (read_historical_records(args.history, AGGREGATION_COLUMNS) if os.path.isdir(args.history)
+                    else read_historical_csv(args.history, usecols=AGGREGATION_COLUMNS))
+            result = sliding_window_aggregate(data, ANALYSIS_WINDOW_SIZE, PREDICTION_WINDOW_SIZE, STEP_SIZE)
+        else:
+            result = chunked_sliding_window_aggregate(args.history, chunksize=args.chunk_rows,
+                                                      n_partitions=args.partitions)
+        seconds = time.perf_counter() - start
+        print(f"  {len(result)} window rows in {seconds:.1f}s, peak memory {peak_memory_mb():.0f} MB "
+              f"({import_mb:.0f} MB after the imports)")
+        if args.output:
+            result.to_parquet(args.output, index=False)
+            with open(args.output + ".json", "w") as f:
+                json.dump({"seconds": seconds, "peak_mb": peak_memory_mb()}, f)
+        sys.exit()
+
+    runs = [("in memory, CSV", "csv", ["--in-memory"]),
+            ("chunked, CSV", "csv", ["--partitions", str(args.partitions)]),
+            ("chunked, Parquet months", "parquet", ["--partitions", str(args.partitions)])]
+    peaks = []
+    for n_records in args.records:
+        folder = tempfile.mkdtemp()
+        try:
+            paths = {"csv": os.path.join(folder, "history.csv"), "parquet": os.path.join(folder, "history.parquet")}
+            write_flagged_mock_history(paths["csv"], paths["parquet"], n_records, args.suppliers,
+                                       np.random.default_rng(42))
+            print(f"{n_records} records of {args.suppliers} suppliers, {len(month_partitions(paths['parquet']))} "
+                  f"months")
+
+            results = []
+            for label, history, options in runs:
+                print(label)
+                output = os.path.join(folder, f"windows_{len(results)}.parquet")
+                subprocess.run([sys.executable, __file__, "--history", paths[history], "--output", output,
+                                "--chunk-rows", str(args.chunk_rows)] + options, check=True)
+                results.append(pd.read_parquet(output))
+                with open(output + ".json") as f:
+                    stats = json.load(f)
+                peaks.append({"records": n_records, "run": label, "peak_mb": round(stats["peak_mb"])})
+            # The chunked aggregations give the same windows as the in-memory one
+            expected = results[0].astype({ID_COLUMN: str})
+            for result in results[1:]:
+                pd.testing.assert_frame_equal(result.astype({ID_COLUMN: str}), expected)
+            print(f"Identical sliding windows, from {expected['analysis_start'].min():{MONTH_FORMAT}} "
+                  f"to {expected['analysis_start'].max():{MONTH_FORMAT}}")
+        finally:
+            shutil.rmtree(folder)
+
+    # The in-memory peak grows with the records, the chunked ones are bounded by a chunk and the
+    # partials (one row per window and supplier) and stay flat
+    print(f"\nPeak memory in MB, chunks of {args.chunk_rows} records:")
+    print(pd.DataFrame(peaks).pivot(index="records", columns="run", values="peak_mb")[[label for label, _, _ in runs]])
@@ -0,0 +1,105 @@
+import numpy as np
+import pandas as pd
+
+from blocking_index import build_blocking_index, add_to_blocking_index, candidate_positions
+from similarity_engine import FIELD_WEIGHTS, normalize_text, normalize_block
+
+# Columns of the companies table (see create_tables.sql)
+COMPANY_COLUMNS = [
+    "company_id", "company_name", "address", "locality", "region", "postal_code", "country",
+    "oms_organisation_id", "oms_location_id",
+]
+
+# Minimum number of rows allocated for the buffers
+INITIAL_CAPACITY = 1024
+
+
+class CompanyRegistry:
+    """
+    Append-only companies table used during a resolution run.
+    Every column (raw and normalized for the similarity engine) is kept in a
+    growable NumPy buffer whose capacity doubles when full, so inserting a new
+    company is O(1) amortized and the table is only materialized to a
+    DataFrame once, with to_dataframe().
+    """
+
+    def __init__(self, companies_df):
+        """
+        :param companies_df: DataFrame with the existing companies table.
+        """
+        self.columns = list(companies_df.columns) + [column for column in COMPANY_COLUMNS
+                                                      if column not in companies_df.columns]
+        self.dtypes = companies_df.dtypes.to_dict()
+        self.size = len(companies_df)
+        capacity = max(INITIAL_CAPACITY, 2 * self.size)
+
+        self.raw = {}
+        for column in self.columns:
+            self.raw[column] = np.empty(capacity, dtype=object)
+            if column in companies_df.columns:
+                self.raw[column][:self.size] = companies_df[column].to_numpy(dtype=object)
+
+        self.normalized = {}
+        for field, values in normalize_block(companies_df).items():
+            self.normalized[field] = np.empty(capacity, dtype=object)
+            self.normalized[field][:self.size] = values
+
+        self.blocking_index = build_blocking_index(companies_df)
+
+    def __len__(self):
+        return self.size
+
+    def _grow(self):
+        # Double the capacity of every buffer
+        for buffers in (self.raw, self.normalized):
+            for column, buffer in buffers.items():
+                grown = np.empty(2 * len(buffer), dtype=object)
+                grown[:self.size] = buffer[:self.size]
+                buffers[column] = grown
+
+    def add(self, company):
+        """
+        Append a new company to the registry.
+        :param company: Mapping with the company columns.
+        :return: Row position of the new company.
+        """
+        if self.size == len(self.raw["company_id"]):
+            self._grow()
+        position = self.size
+        for column in self.columns:
+            self.raw[column][position] = company.get(column)
+        for field in FIELD_WEIGHTS:
+            self.normalized[field][position] = normalize_text(company.get(field))
+        add_to_blocking_index(self.blocking_index, company, position)
+        self.size += 1
+        return position
+
+    def company_id(self, position):
+        return self.raw["company_id"][position]
+
+    def candidates(self, record):
+        """
+        Get the companies that may match a record, from the blocking index.
+        :param record: Query record.
+        :return: Sorted list of candidate row positions.
+        """
+        return candidate_positions(self.blocking_index, record)
+
+    def normalized_block(self, positions=None):
+        """
+        Get normalized fields of the registry for the similarity engine.
+        :param positions: Row positions to select (default: all rows).
+        :return: Normalized block, see similarity_engine.normalize_block.
+        """
+        if positions is None:
+            return {field: buffer[:self.size] for field, buffer in self.normalized.items()}
+        positions = np.asarray(positions, dtype=np.int64)
+        return {field: buffer[positions] for field, buffer in self.normalized.items()}
+
+    def to_dataframe(self):
+        """
+        Materialize the registry as a companies DataFrame.
+        :return: DataFrame with the existing and the new companies.
+        """
+        return pd.DataFrame({column: pd.Series(self.raw[column][:self.size], dtype=self.dtypes.get(column, object))
+                             for column in self.columns})
@@ -1,7 +1,20 @@
+import argparse
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from itertools import count
+
+import numpy as np
 import pandas as pd
 import uuid
 from fuzzywuzzy import fuzz
 
+from blocking_index import blocking_keys, build_blocking_index, candidate_positions, generate_synthetic_companies
+from company_registry import CompanyRegistry
+from resolution_cache import RESOLUTION_CACHE_PATH, NO_MATCH, open_resolution_cache, record_hashes, block_hash, \
+    company_hashes, lookup_decisions, store_decisions
+from similarity_engine import normalize_text, normalize_block, take_block, pairwise_similarity, similarity_matrix
+
 # Example "companies" table
 companies_data = [
     {
@@ -67,17 +80,14 @@ eudra_data = [
     }
 ]
 
+# Prefix of the temporary company_ids created by the workers of a parallel run
+PROVISIONAL_ID_PREFIX = "provisional-"
+
 # Convert datasets to pandas DataFrames
 companies_df = pd.DataFrame(companies_data)
 warning_letters_df = pd.DataFrame(warning_letters_data)
 eudra_df = pd.DataFrame(eudra_data)
 
-# Function to normalize text
-def normalize_text(text):
-    if not isinstance(text, str):
-        return ""
-    return ''.join(e for e in text.lower() if e.isalnum() or e.isspace()).strip()
-
 # Function to generate a unique company ID
 def generate_company_id():
     return str(uuid.uuid4())
@@ -122,102 +132,274 @@ def is_similar(company_info, company_row, threshold=85):
 
     return overall_similarity >= threshold
 
+def resolve_companies(company_records, registry, threshold=85, id_factory=generate_company_id, cache=None):
+    """
+    Assign a company_id to each company record, adding a new company to the
+    registry for every record that matches none of the known ones.
+    Records are scored with the batch similarity engine, which gives the same
+    decisions as is_similar.
+    :param company_records: List of company records (company fields plus OMS identifiers).
+    :param registry: CompanyRegistry with the companies table, updated in place.
+    :param threshold: Minimum overall similarity for a match.
+    :param id_factory: Function returning the company_id of each new company.
+    :param cache: Optional connection from open_resolution_cache. Records whose
+                  candidate companies did not change since their stored decision
+                  reuse it without being scored.
+    :return: List of company_ids, one per record.
+    """
+    query_block = normalize_block(company_records)
+    n_existing = len(registry)
+    candidates = [registry.candidates(record) for record in company_records]
+
+    # Reuse the stored decisions (match or no match) whose block of candidate companies did not change
+    first_match = {}
+    known_unmatched = set()
+    if cache is not None:
+        hashes = record_hashes(query_block)
+        existing_hashes = company_hashes(registry, {position for positions in candidates for position in positions})
+        block_hashes = [block_hash(existing_hashes, positions, threshold) for positions in candidates]
+        stored_decisions = lookup_decisions(cache, hashes)
+        for query_position, positions in enumerate(candidates):
+            decision = stored_decisions.get(hashes[query_position])
+            if decision is None or decision[0] != block_hashes[query_position]:
+                continue
+            if decision[1] == NO_MATCH:
+                known_unmatched.add(query_position)
+                continue
+            for position in positions:
+                if registry.company_id(position) == decision[1]:
+                    first_match[query_position] = position
+                    break
+    pending = [query_position for query_position in range(len(company_records))
+               if query_position not in first_match and query_position not in known_unmatched]
+
+    # Score every other record against its candidates among the existing companies in one batch
+    query_positions = np.repeat(np.array(pending, dtype=np.int64),
+                                [len(candidates[query_position]) for query_position in pending])
+    company_positions = np.array([position for query_position in pending for position in candidates[query_position]],
+                                 dtype=np.int64)
+    scores = pairwise_similarity(query_block, registry.normalized_block(), query_positions, company_positions)
+    matched = scores >= threshold
+
+    # Keep the first matching company of each record, in table order
+    new_decisions = []
+    for query_position, company_position, score in zip(query_positions[matched], company_positions[matched],
+                                                       scores[matched]):
+        if query_position in first_match:
+            continue
+        first_match[query_position] = company_position
+        if cache is not None:
+            new_decisions.append((hashes[query_position], block_hashes[query_position],
+                                  registry.company_id(company_position), float(score)))
+
+    # Records matching none of their existing candidates are stored as such, to skip their scoring next time
+    if cache is not None:
+        new_decisions.extend((hashes[query_position], block_hashes[query_position], NO_MATCH, None)
+                             for query_position in pending if query_position not in first_match)
+
+    company_ids = []
+    for query_position, record in enumerate(company_records):
+        if query_position in first_match:
+            company_ids.append(registry.company_id(first_match[query_position]))
+            continue
+
+        # Companies created earlier in this run come after the existing ones in table order
+        new_positions = [position for position in registry.candidates(record) if position >= n_existing]
+        if new_positions:
+            scores = similarity_matrix(take_block(query_block, [query_position]),
+                                       registry.normalized_block(new_positions))[0]
+            if (scores >= threshold).any():
+                company_ids.append(registry.company_id(new_positions[int(np.argmax(scores >= threshold))]))
+                continue
+
+        # If no match is found, create a new company entry
+        new_company_id = id_factory()
+        company_ids.append(new_company_id)
+
+        # Add the new company to the companies table
+        registry.add({
+            "company_id": new_company_id,
+            "company_name": record["company_name"],
+            "address": record["address"],
+            "locality": record["locality"],
+            "region": record["region"],
+            "postal_code": record["postal_code"],
+            "country": record["country"],
+            "oms_organisation_id": record.get("oms_organisation_id"),
+            "oms_location_id": record.get("oms_location_id")
+        })
+
+    # Decisions are only about the companies that existed before the run: the
+    # block of a record changes once new companies among its candidates are saved
+    if cache is not None:
+        store_decisions(cache, new_decisions)
+
+    return company_ids
+
+# Function to assign a record to a shard from its blocking keys
+def shard_of(record, n_shards):
+    keys = blocking_keys(record)
+    if not keys:
+        return 0
+    return zlib.crc32(repr(min(keys)).encode("utf-8")) % n_shards
+
+# Function run by the workers of resolve_companies_parallel
+def _resolve_shard(shard, company_records, companies_slice, threshold, cache_path):
+    provisional_ids = count()
+    registry = CompanyRegistry(companies_slice)
+    n_existing = len(registry)
+    cache = open_resolution_cache(cache_path) if cache_path else None
+    company_ids = resolve_companies(company_records, registry, threshold,
+                                    id_factory=lambda: f"{PROVISIONAL_ID_PREFIX}{shard}-{next(provisional_ids)}",
+                                    cache=cache)
+    if cache is not None:
+        cache.close()
+    return company_ids, registry.to_dataframe().iloc[n_existing:]
+
+def resolve_companies_parallel(company_records, companies_df, workers, threshold=85, cache_path=None):
+    """
+    Parallel version of resolve_companies over a process pool.
+    Records are sharded by blocking key and each shard is resolved against the
+    slice of the companies table holding its candidates, so matches against
+    existing companies are the same as in a sequential run. Workers only
+    create provisional ids; the new companies of all shards are then
+    reconciled against each other, in the order of their first record, and
+    only this step creates the final UUIDs. A site seen by two shards
+    therefore gets a single company_id.
+    :param company_records: List of company records (company fields plus OMS identifiers).
+    :param companies_df: DataFrame with the companies table.
+    :param workers: Number of worker processes.
+    :param threshold: Minimum overall similarity for a match.
+    :param cache_path: Optional path of the resolution cache database.
+    :return: Tuple (list of company_ids, updated companies DataFrame).
+    """
+    shards = [[] for _ in range(workers)]
+    for position, record in enumerate(company_records):
+        shards[shard_of(record, workers)].append(position)
+    shards = [positions for positions in shards if positions]
+
+    # Each shard only needs the companies that are candidates of its records
+    blocking_index = build_blocking_index(companies_df)
+    tasks = []
+    for shard, positions in enumerate(shards):
+        slice_positions = sorted({candidate for position in positions
+                                  for candidate in candidate_positions(blocking_index, company_records[position])})
+        tasks.append((shard, [company_records[position] for position in positions],
+                      companies_df.iloc[slice_positions], threshold, cache_path))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_resolve_shard, *zip(*tasks)))
+
+    company_ids = [None] * len(company_records)
+    first_position = {}
+    for positions, (shard_ids, _) in zip(shards, results):
+        for position, company_id in zip(positions, shard_ids):
+            company_ids[position] = company_id
+            first_position[company_id] = min(position, first_position.get(company_id, position))
+
+    # Reconcile the new companies of all shards and give them their final company_id
+    new_companies = [company for _, shard_companies in results for company in shard_companies.to_dict("records")]
+    new_companies.sort(key=lambda company: first_position[company["company_id"]])
+    registry = CompanyRegistry(companies_df.iloc[:0])
+    final_ids = resolve_companies(new_companies, registry, threshold)
+    final_id_of = {company["company_id"]: final_id for company, final_id in zip(new_companies, final_ids)}
+    company_ids = [final_id_of.get(company_id, company_id) for company_id in company_ids]
+
+    new_companies_df = registry.to_dataframe()
+    if len(new_companies_df):
+        companies_df = pd.concat([companies_df, new_companies_df], ignore_index=True)
+    return company_ids, companies_df
+
+# Function to resolve records sequentially or in parallel, with the optional cache
+def _resolve(company_records, companies_df, workers, cache_path):
+    if workers > 1:
+        return resolve_companies_parallel(company_records, companies_df, workers, cache_path=cache_path)
+    registry = CompanyRegistry(companies_df)
+    cache = open_resolution_cache(cache_path) if cache_path else None
+    company_ids = resolve_companies(company_records, registry, cache=cache)
+    if cache is not None:
+        cache.close()
+    return company_ids, registry.to_dataframe()
+
 # Function to cross-reference Warning Letters dataset
-def cross_reference_warning_letters(warning_letters_df, companies_df):
+def cross_reference_warning_letters(warning_letters_df, companies_df, workers=1, cache_path=None):
     # Extract company info from warning letters
     company_info_list = warning_letters_df["Company Info"].apply(pd.Series)
+    company_records = company_info_list.to_dict("records")
 
     # Add a column for company_id in the warning letters dataset
-    warning_letters_df["company_id"] = None
-
-    # Iterate through each company in the warning letters dataset
-    for index, company_info in company_info_list.iterrows():
-        matched = False
-
-        # Check for matches in the companies table
-        for _, company_row in companies_df.iterrows():
-            if is_similar(company_info, company_row):
-                # If a match is found, assign the existing company_id
-                warning_letters_df.at[index, "company_id"] = company_row["company_id"]
-                matched = True
-                break
-
-        if not matched:
-            # If no match is found, create a new company entry
-            new_company_id = generate_company_id()
-            warning_letters_df.at[index, "company_id"] = new_company_id
-
-            # Add the new company to the companies table
-            new_company = {
-                "company_id": new_company_id,
-                "company_name": company_info["company_name"],
-                "address": company_info["address"],
-                "locality": company_info["locality"],
-                "region": company_info["region"],
-                "postal_code": company_info["postal_code"],
-                "country": company_info["country"],
-                "oms_organisation_id": None,
-                "oms_location_id": None
-            }
-            companies_df = pd.concat([companies_df, pd.DataFrame([new_company])], ignore_index=True)
+    company_ids, companies_df = _resolve(company_records, companies_df, workers, cache_path)
+    warning_letters_df["company_id"] = company_ids
 
     return warning_letters_df, companies_df
 
 # Function to cross-reference Eudra dataset
-def cross_reference_eudra(eudra_df, companies_df):
+def cross_reference_eudra(eudra_df, companies_df, workers=1, cache_path=None):
+    # Map the Eudra columns to the companies fields
+    company_records = [{
+        "company_name": eudra_row["Site Name"],
+        "address": eudra_row["Site Address"],
+        "locality": eudra_row["City"],
+        "region": None,  # Region is not provided in the Eudra dataset
+        "postal_code": eudra_row["Postcode"],
+        "country": eudra_row["Country"],
+        "oms_organisation_id": eudra_row["OMS Organisation Identifier"],
+        "oms_location_id": eudra_row["OMS Location Identifier"]
+    } for eudra_row in eudra_df.to_dict("records")]
+
     # Add a column for company_id in the Eudra dataset
-    eudra_df["company_id"] = None
-
-    # Iterate through each company in the Eudra dataset
-    for index, eudra_row in eudra_df.iterrows():
-        matched = False
-
-        # Check for matches in the companies table
-        for _, company_row in companies_df.iterrows():
-            if is_similar({
-                "company_name": eudra_row["Site Name"],
-                "address": eudra_row["Site Address"],
-                "locality": eudra_row["City"],
-                "region": None,  # Region is not provided in the Eudra dataset
-                "postal_code": eudra_row["Postcode"],
-                "country": eudra_row["Country"]
-            }, company_row):
-                # If a match is found, assign the existing company_id
-                eudra_df.at[index, "company_id"] = company_row["company_id"]
-                matched = True
-                break
-
-        if not matched:
-            # If no match is found, create a new company entry
-            new_company_id = generate_company_id()
-            eudra_df.at[index, "company_id"] = new_company_id
-
-            # Add the new company to the companies table
-            new_company = {
-                "company_id": new_company_id,
-                "company_name": eudra_row["Site Name"],
-                "address": eudra_row["Site Address"],
-                "locality": eudra_row["City"],
-                "region": None,
-                "postal_code": eudra_row["Postcode"],
-                "country": eudra_row["Country"],
-                "oms_organisation_id": eudra_row["OMS Organisation Identifier"],
-                "oms_location_id": eudra_row["OMS Location Identifier"]
-            }
-            companies_df = pd.concat([companies_df, pd.DataFrame([new_company])], ignore_index=True)
+    company_ids, companies_df = _resolve(company_records, companies_df, workers, cache_path)
+    eudra_df["company_id"] = company_ids
 
     return eudra_df, companies_df
 
-# Cross-reference both datasets
-updated_warning_letters_df, companies_df = cross_reference_warning_letters(warning_letters_df, companies_df)
-updated_eudra_df, companies_df = cross_reference_eudra(eudra_df, companies_df)
+def benchmark_parallel_resolution(n_companies=20000, n_records=5000, worker_counts=(1, 2, 4, 8)):
+    """
+    Measure the wall time of the resolution for several numbers of workers.
+    :param n_companies: Number of companies in the synthetic master table.
+    :param n_records: Number of synthetic records to resolve.
+    :param worker_counts: Numbers of worker processes to benchmark.
+    :return: DataFrame with the time and speedup of each number of workers.
+    """
+    companies_df, company_records = generate_synthetic_companies(n_companies, n_records)
+    results = []
+    for workers in worker_counts:
+        start = time.perf_counter()
+        if workers > 1:
+            company_ids, _ = resolve_companies_parallel(company_records, companies_df, workers)
+        else:
+            company_ids = resolve_companies(company_records, CompanyRegistry(companies_df))
+        results.append({"workers": workers, "seconds": time.perf_counter() - start,
+                        "companies_created": len(set(company_ids) - set(companies_df["company_id"]))})
+    results = pd.DataFrame(results)
+    results["speedup"] = results["seconds"].iloc[0] / results["seconds"]
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cross-reference warning letters and NCRs with the companies table")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes used for the resolution")
+    parser.add_argument("--cache", nargs="?", const=RESOLUTION_CACHE_PATH, default=None,
+                        help="Reuse and store match decisions in this SQLite database")
+    parser.add_argument("--benchmark", action="store_true", help="Run the scaling benchmark at 1/2/4/8 workers")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        print(benchmark_parallel_resolution())
+        raise SystemExit
+
+    # Cross-reference both datasets
+    updated_warning_letters_df, companies_df = cross_reference_warning_letters(warning_letters_df, companies_df,
+                                                                               workers=args.workers,
+                                                                               cache_path=args.cache)
+    updated_eudra_df, companies_df = cross_reference_eudra(eudra_df, companies_df, workers=args.workers,
+                                                           cache_path=args.cache)
 
-# Display the updated datasets
-print("Updated Warning Letters:")
-print(updated_warning_letters_df)
+    # Display the updated datasets
+    print("Updated Warning Letters:")
+    print(updated_warning_letters_df)
 
-print("\nUpdated Eudra Non-Compliance Reports:")
-print(updated_eudra_df)
+    print("\nUpdated Eudra Non-Compliance Reports:")
+    print(updated_eudra_df)
 
-print("\nUpdated Companies Table:")
-print(companies_df)
+    print("\nUpdated Companies Table:")
+    print(companies_df)
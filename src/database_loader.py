@@ -0,0 +1,414 @@
+import argparse
+import ast
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from change_detection import SNAPSHOT_PATH, CHANGE_COLUMN, DELETED, change_counts, commit_snapshot, \
+    diff_snapshot, open_snapshot_store
+from company_registry import COMPANY_COLUMNS
+from cross_reference_datasets import cross_reference_warning_letters, cross_reference_eudra
+from parse_cache import letter_key
+from sqlite_helpers import parameter_batches
+
+# Default location of the database and of its schema (scripts are run from src/)
+DATABASE_PATH = "../data/supplier_risk.db"
+SCHEMA_PATH = "create_tables.sql"
+
+# Scraper outputs loaded by default
+WARNING_LETTERS_CSV = "../data/warning_letters/warning_letters_with_metadata.csv"
+NCR_CSV = "../data/NCR/eudra_non_compliance_reports.csv"
+
+# Rows sent per executemany call
+LOAD_BATCH_SIZE = 50_000
+
+# Natural key of every table, the conflict target of the upserts
+UPSERT_KEYS = {
+    "companies": "company_id",
+    "warning_letters": "link",
+    "eudra_non_compliance_reports": "report_number",
+}
+
+# Lookup indexes, dropped before a load and created again once the rows are in
+SECONDARY_INDEXES = {
+    "warning_letters_company_id_idx": ("warning_letters", "company_id"),
+    "eudra_non_compliance_reports_company_id_idx": ("eudra_non_compliance_reports", "company_id"),
+}
+
+# Snapshots of the scraped tables as last loaded, for loading only what changed since
+LETTERS_SNAPSHOT_SOURCE = "database_warning_letters"
+NCR_SNAPSHOT_SOURCE = "database_eudra_ncr"
+
+# Table column -> column of the scraped warning letters
+WARNING_LETTER_COLUMNS = {
+    "posted_date": "Posted Date",
+    "letter_issue_date": "Letter Issue Date",
+    "issuing_office": "Issuing Office",
+    "subject": "Subject",
+    "response_letter": "Response Letter",
+    "closeout_letter": "Closeout Letter",
+    "excerpt": "Excerpt",
+    "link": "Link",
+    "delivery_method": "Delivery Method",
+    "reference_number": "Reference #",
+    "product": "Product",
+    "violations": "Violations",
+    "company_id": "company_id",
+}
+
+# Table column -> column of the EudraGMDP non-compliance reports
+EUDRA_COLUMNS = {
+    "report_number": "Report Number",
+    "eudragmdp_document_reference_number": "EudraGMDP Document Reference Number",
+    "wda_api_reg_no": "WDA No./API Reg.No.",
+    "oms_organisation_id": "OMS Organisation Identifier",
+    "oms_location_id": "OMS Location Identifier",
+    "inspection_end_date": "Inspection End Date",
+    "issue_date": "Issue Date",
+    "company_id": "company_id",
+}
+
+
+def schema_statements(path=SCHEMA_PATH):
+    """
+    Read the CREATE TABLE statements of the schema file (its example INSERTs
+    are skipped) and adapt them to SQLite: SERIAL keys become INTEGER PRIMARY
+    KEY, which SQLite numbers automatically like a Postgres sequence.
+    :param path: Path of create_tables.sql.
+    :return: List of SQL statements.
+    """
+    with open(path, encoding="utf-8") as f:
+        sql = re.sub(r"--[^\n]*", "", f.read())
+    statements = []
+    for statement in sql.split(";"):
+        statement = statement.strip()
+        if statement.upper().startswith("CREATE TABLE"):
+            statement = re.sub(r"^CREATE TABLE", "CREATE TABLE IF NOT EXISTS", statement, flags=re.IGNORECASE)
+            statements.append(re.sub(r"\bSERIAL PRIMARY KEY\b", "INTEGER PRIMARY KEY", statement))
+    return statements
+
+
+def open_database(path=DATABASE_PATH, schema_path=SCHEMA_PATH):
+    """
+    Open (or create) the SQLite database with the tables of create_tables.sql
+    and the unique indexes of the upsert keys.
+    :param path: Path of the database file.
+    :param schema_path: Path of create_tables.sql.
+    :return: sqlite3 connection.
+    """
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # With WAL, NORMAL only syncs at checkpoints: a crash can lose the last transactions, never corrupt the file
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    for statement in schema_statements(schema_path):
+        conn.execute(statement)
+    for table, key in UPSERT_KEYS.items():
+        if key != "company_id":
+            conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {table}_{key}_key ON {table} ({key})")
+    conn.commit()
+    return conn
+
+
+def drop_secondary_indexes(conn):
+    for index in SECONDARY_INDEXES:
+        conn.execute(f"DROP INDEX IF EXISTS {index}")
+    conn.commit()
+
+
+def create_secondary_indexes(conn):
+    for index, (table, column) in SECONDARY_INDEXES.items():
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {index} ON {table} ({column})")
+    conn.commit()
+
+
+def upsert_statement(table, columns, key):
+    """
+    INSERT ... ON CONFLICT DO UPDATE statement, valid for SQLite and Postgres
+    (with %s placeholders instead of ? for psycopg).
+    :return: SQL string.
+    """
+    updates = ", ".join(f"{column} = excluded.{column}" for column in columns if column != key)
+    return (f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+            f"ON CONFLICT ({key}) DO UPDATE SET {updates}")
+
+
+def _rows(df):
+    # Tuples of Python values with None for missing values, as the sqlite3 driver expects
+    columns = [column.astype(object).where(column.notna(), None).tolist() for _, column in df.items()]
+    return zip(*columns)
+
+
+def load_table(conn, table, df, key=None, batch_size=LOAD_BATCH_SIZE):
+    """
+    Upsert the rows of a DataFrame into a table, in batches of executemany
+    calls within a single transaction. Rows sharing a key keep the last one
+    (Postgres rejects a batch updating the same row twice).
+    :param conn: Connection returned by open_database.
+    :param table: Table name.
+    :param df: DataFrame whose columns are columns of the table.
+    :param key: Conflict target (default: UPSERT_KEYS[table]).
+    :param batch_size: Rows per executemany call.
+    :return: Number of rows loaded.
+    """
+    key = key or UPSERT_KEYS[table]
+    missing_key = df[key].isna()
+    if missing_key.any():
+        print(f"Skipping {int(missing_key.sum())} rows of {table} without {key}")
+    df = df[~missing_key].drop_duplicates(key, keep="last")
+    statement = upsert_statement(table, list(df.columns), key)
+    with conn:
+        for start in range(0, len(df), batch_size):
+            conn.executemany(statement, _rows(df.iloc[start:start + batch_size]))
+    return len(df)
+
+
+def delete_rows(conn, table, keys):
+    """
+    Delete rows of a table by their upsert key.
+    :param conn: Connection returned by open_database.
+    :param table: Table name.
+    :param keys: Values of the key of the rows to delete.
+    :return: Number of rows deleted.
+    """
+    key = UPSERT_KEYS[table]
+    keys = list(keys)
+    n_deleted = 0
+    with conn:
+        for batch in parameter_batches(keys):
+            n_deleted += conn.execute(f"DELETE FROM {table} WHERE {key} IN ({','.join('?' * len(batch))})",
+                                      batch).rowcount
+    return n_deleted
+
+
+def _iso_dates(values, date_format):
+    # Dates repeat a lot: every distinct string is only parsed once
+    codes, uniques = pd.factorize(values)
+    iso = pd.to_datetime(pd.Series(uniques, dtype=object), format=date_format, errors="coerce").dt.strftime("%Y-%m-%d")
+    # Code -1 (missing value) picks the trailing None
+    return pd.Series(np.append(iso.to_numpy(dtype=object), None)[codes], index=values.index)
+
+
+def _table_frame(df, columns):
+    # Select and rename the source columns, missing ones are left empty
+    return pd.DataFrame({column: df[source] if source in df.columns else None for column, source in columns.items()},
+                        index=df.index)
+
+
+def warning_letter_rows(warning_letters_df):
+    """
+    Map resolved warning letters to the warning_letters table.
+    :param warning_letters_df: Scraped letters with a company_id column.
+    :return: DataFrame with the table columns, dates as YYYY-MM-DD.
+    """
+    rows = _table_frame(warning_letters_df, WARNING_LETTER_COLUMNS)
+    for column in ["posted_date", "letter_issue_date"]:
+        rows[column] = _iso_dates(rows[column], "%m/%d/%Y")
+    return rows
+
+
+def eudra_rows(eudra_df):
+    """
+    Map resolved non-compliance reports to the eudra_non_compliance_reports table.
+    :param eudra_df: Scraped reports with a company_id column.
+    :return: DataFrame with the table columns, dates as YYYY-MM-DD.
+    """
+    rows = _table_frame(eudra_df, EUDRA_COLUMNS)
+    rows["eudragmdp_document_reference_number"] = rows["eudragmdp_document_reference_number"].astype("string")
+    for column in ["inspection_end_date", "issue_date"]:
+        rows[column] = _iso_dates(rows[column], "%Y-%m-%d")
+    return rows
+
+
+def read_companies(conn):
+    """
+    :return: DataFrame with the companies table of the database.
+    """
+    return pd.read_sql_query(f"SELECT {', '.join(COMPANY_COLUMNS)} FROM companies", conn)
+
+
+def load_pipeline_outputs(conn, companies_df, warning_letters_df=None, eudra_df=None, batch_size=LOAD_BATCH_SIZE):
+    """
+    Load the resolved outputs of cross_reference_datasets.py: the companies
+    first (the other tables reference them), then the letters and reports.
+    The lookup indexes are only built once all the rows are in.
+    :param conn: Connection returned by open_database.
+    :param companies_df: Companies table.
+    :param warning_letters_df: Warning letters with a company_id column.
+    :param eudra_df: Non-compliance reports with a company_id column.
+    :param batch_size: Rows per executemany call.
+    :return: Dictionary with the number of rows loaded per table.
+    """
+    drop_secondary_indexes(conn)
+    loaded = {"companies": load_table(conn, "companies", companies_df[COMPANY_COLUMNS], batch_size=batch_size)}
+    if warning_letters_df is not None:
+        loaded["warning_letters"] = load_table(conn, "warning_letters", warning_letter_rows(warning_letters_df),
+                                               batch_size=batch_size)
+    if eudra_df is not None:
+        loaded["eudra_non_compliance_reports"] = load_table(conn, "eudra_non_compliance_reports",
+                                                            eudra_rows(eudra_df), batch_size=batch_size)
+    create_secondary_indexes(conn)
+    conn.execute("ANALYZE")
+    conn.commit()
+    return loaded
+
+
+# Function to map the company info of the letter scraper to the fields of the companies table
+def scraped_company_info(company_info):
+    if isinstance(company_info, str):
+        company_info = ast.literal_eval(company_info)
+    address = ", ".join(part for part in [company_info.get("address_line1"), company_info.get("address_line2")]
+                        if part and part != "Not found")
+    return {
+        # The scraped name is followed by the MARCS-CMS number on the next lines
+        "company_name": (company_info.get("company_name") or "").split("\n")[0].strip(),
+        "address": address or company_info.get("address"),
+        "locality": company_info.get("locality"),
+        "region": company_info.get("administrative_area", company_info.get("region")),
+        "postal_code": company_info.get("postal_code"),
+        "country": company_info.get("country"),
+    }
+
+
+def load_scraped_datasets(conn, letters_path=WARNING_LETTERS_CSV, ncr_path=NCR_CSV, workers=1, cache_path=None,
+                          snapshots=None):
+    """
+    Resolve the scraped letters and reports against the companies already in
+    the database, then load them.
+    :param snapshots: Optional connection from change_detection.open_snapshot_store.
+                      Only the rows inserted or updated since the last load are
+                      then resolved and loaded, and deleted rows are removed.
+    :return: Dictionary with the number of rows loaded per table.
+    """
+    companies_df = read_companies(conn)
+    n_existing = len(companies_df)
+    warning_letters_df = pd.read_csv(letters_path)
+    eudra_df = pd.read_csv(ncr_path, dtype=str)
+    if snapshots is not None:
+        letter_changes = diff_snapshot(snapshots, LETTERS_SNAPSHOT_SOURCE, warning_letters_df, "Link", letter_key)
+        eudra_changes = diff_snapshot(snapshots, NCR_SNAPSHOT_SOURCE, eudra_df, "Report Number")
+        print(f"Warning letters: {change_counts(letter_changes)}, reports: {change_counts(eudra_changes)}")
+        deleted_letters = letter_changes[CHANGE_COLUMN] == DELETED
+        deleted_reports = eudra_changes[CHANGE_COLUMN] == DELETED
+        delete_rows(conn, "warning_letters", letter_changes.loc[deleted_letters, "Link"].dropna())
+        delete_rows(conn, "eudra_non_compliance_reports", eudra_changes.loc[deleted_reports, "Report Number"].dropna())
+        warning_letters_df = letter_changes[~deleted_letters].reset_index(drop=True)
+        eudra_df = eudra_changes[~deleted_reports].reset_index(drop=True)
+
+    # Only the rows to load are resolved
+    if len(warning_letters_df):
+        warning_letters_df["Company Info"] = warning_letters_df["Company Info"].map(scraped_company_info)
+        warning_letters_df, companies_df = cross_reference_warning_letters(warning_letters_df, companies_df, workers,
+                                                                           cache_path)
+    else:
+        warning_letters_df = None
+    if len(eudra_df):
+        eudra_df, companies_df = cross_reference_eudra(eudra_df, companies_df, workers, cache_path)
+    else:
+        eudra_df = None
+    # Existing companies come first and are left as they are
+    loaded = load_pipeline_outputs(conn, companies_df.iloc[n_existing:], warning_letters_df, eudra_df)
+
+    if snapshots is not None:
+        commit_snapshot(snapshots, LETTERS_SNAPSHOT_SOURCE, letter_changes)
+        commit_snapshot(snapshots, NCR_SNAPSHOT_SOURCE, eudra_changes)
+    return loaded
+
+
+def synthetic_letters(n_rows, n_companies=10_000, seed=0):
+    """
+    Generate resolved warning letters and their companies for the benchmark.
+    :return: (companies DataFrame, warning letters DataFrame).
+    """
+    rng = np.random.default_rng(seed)
+    company_ids = [str(uuid.UUID(int=int(value))) for value in rng.integers(0, 2 ** 62, n_companies)]
+    companies_df = pd.DataFrame({column: None for column in COMPANY_COLUMNS}, index=range(n_companies))
+    companies_df["company_id"] = company_ids
+    companies_df["company_name"] = [f"Company {number}" for number in range(n_companies)]
+    dates = pd.Timestamp("2015-01-01") + pd.to_timedelta(rng.integers(0, 3650, n_rows), unit="D")
+    warning_letters_df = pd.DataFrame({
+        "Posted Date": dates.strftime("%m/%d/%Y"),
+        "Letter Issue Date": dates.strftime("%m/%d/%Y"),
+        "Issuing Office": "Center for Drug Evaluation and Research (CDER)",
+        "Subject": "CGMP/Finished Pharmaceuticals/Adulterated",
+        "Link": [f"https://www.fda.gov/warning-letters/letter-{number}" for number in range(n_rows)],
+        "Delivery Method": "VIA Electronic Mail",
+        "Reference #": [f"320-{number}" for number in range(n_rows)],
+        "Product": "Drugs",
+        "Violations": "Failure to establish laboratory controls",
+        "company_id": np.array(company_ids, dtype=object)[rng.integers(0, n_companies, n_rows)],
+    })
+    return companies_df, warning_letters_df
+
+
+def benchmark_loading(n_rows=1_000_000, baseline_rows=20_000):
+    """
+    Compare row-by-row inserts committed one at a time (as sqllite_code.py
+    does) with the bulk loader, for a first load and for a reload where every
+    row is an update.
+    :return: DataFrame with the rows per second of each method.
+    """
+    companies_df, warning_letters_df = synthetic_letters(n_rows)
+    rows = warning_letter_rows(warning_letters_df)
+    folder = tempfile.mkdtemp()
+    results = []
+    try:
+        # Default journal and synchronous settings, indexes maintained on every insert
+        conn = sqlite3.connect(os.path.join(folder, "baseline.db"))
+        for statement in schema_statements():
+            conn.execute(statement)
+        create_secondary_indexes(conn)
+        load_table(conn, "companies", companies_df)
+        statement = f"INSERT INTO warning_letters ({', '.join(rows.columns)}) VALUES ({', '.join('?' * rows.shape[1])})"
+        start = time.perf_counter()
+        for row in _rows(rows.iloc[:baseline_rows]):
+            conn.execute(statement, row)
+            conn.commit()
+        results.append({"method": "row by row", "rows": baseline_rows, "seconds": time.perf_counter() - start})
+        conn.close()
+
+        conn = open_database(os.path.join(folder, "bulk.db"))
+        for label in ["bulk load", "bulk upsert (all updates)"]:
+            start = time.perf_counter()
+            loaded = load_pipeline_outputs(conn, companies_df, warning_letters_df)
+            results.append({"method": label, "rows": loaded["warning_letters"] + loaded["companies"],
+                            "seconds": time.perf_counter() - start})
+        assert conn.execute("SELECT COUNT(*) FROM warning_letters").fetchone()[0] == n_rows
+        conn.close()
+    finally:
+        shutil.rmtree(folder)
+    results = pd.DataFrame(results)
+    results["rows_per_second"] = results["rows"] / results["seconds"]
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the resolved pipeline outputs into the SQLite database")
+    parser.add_argument("--database", default=DATABASE_PATH, help="SQLite database file")
+    parser.add_argument("--letters", default=WARNING_LETTERS_CSV, help="Scraped warning letters CSV")
+    parser.add_argument("--ncr", default=NCR_CSV, help="Scraped EudraGMDP non-compliance reports CSV")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes used for the resolution")
+    parser.add_argument("--cache", default=None, help="Resolution cache database")
+    parser.add_argument("--changes-only", nargs="?", const=SNAPSHOT_PATH, default=None,
+                        help="Only load the rows changed since the last load, tracked in this snapshot database")
+    parser.add_argument("--benchmark", type=int, nargs="?", const=1_000_000, default=None,
+                        help="Benchmark the loader with this many synthetic letters instead")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        print(benchmark_loading(args.benchmark))
+        raise SystemExit
+
+    conn = open_database(args.database)
+    snapshots = open_snapshot_store(args.changes_only) if args.changes_only else None
+    print(load_scraped_datasets(conn, args.letters, args.ncr, args.workers, args.cache, snapshots))
+    for table in UPSERT_KEYS:
+        print(f"{table}: {conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]} rows")
+    conn.close()
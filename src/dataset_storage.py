@@ -0,0 +1,125 @@
+import os
+
+import pandas as pd
+
+from record_schema import apply_record_schema, apply_window_schema
+
+DATA_FOLDER = "../data/historical_ds/"
+
+# Partitioned Parquet datasets (directories)
+HISTORICAL_RECORDS_PARQUET = DATA_FOLDER + "historical_records.parquet"
+SLIDING_WINDOW_PARQUET = DATA_FOLDER + "sliding_window_supplier_data.parquet"
+
+# Low-cardinality string columns stored with dictionary encoding
+HISTORICAL_CATEGORICAL_COLUMNS = [
+    "supplier_id", "severity_level", "category_of_violation", "root_cause_category", "affected_product",
+    "process_involved", "tone_of_letter", "resolution_status",
+]
+SLIDING_WINDOW_CATEGORICAL_COLUMNS = ["supplier_id"]
+
+DATE_FORMAT = "%Y-%m-%d"
+MONTH_FORMAT = "%Y-%m"
+
+
+def _with_categoricals(df, columns):
+    # Categorical columns are written as Parquet dictionary-encoded columns
+    df = df.copy()
+    for column in columns:
+        if column in df.columns:
+            df[column] = df[column].astype("category")
+    return df
+
+
+def _sorted_categories(df):
+    # Each file of a dataset has its own dictionary, sort the merged categories so
+    # grouping and sorting by a categorical column give the same order as strings
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].cat.set_categories(df[column].cat.categories.sort_values())
+    return df
+
+
+def write_historical_records(historical_df, path=HISTORICAL_RECORDS_PARQUET, chunk_name=None):
+    """
+    Write the historical records as Parquet, partitioned by record month.
+    Partitions present in historical_df replace the stored ones, unless a
+    chunk_name is given: the records are then added to the partitions, which
+    lets a large history be streamed chunk by chunk.
+    :param historical_df: DataFrame with the historical records.
+    :param path: Root directory of the dataset.
+    :param chunk_name: Optional unique name of the files written for this chunk.
+    """
+    df = _with_categoricals(historical_df, HISTORICAL_CATEGORICAL_COLUMNS)
+    df["record_date"] = pd.to_datetime(df["record_date"])
+    df["record_month"] = df["record_date"].dt.strftime(MONTH_FORMAT)
+    if chunk_name is None:
+        options = {"existing_data_behavior": "delete_matching"}
+    else:
+        options = {"existing_data_behavior": "overwrite_or_ignore", "basename_template": chunk_name + "-{i}.parquet"}
+    df.to_parquet(path, engine="pyarrow", partition_cols=["record_month"], index=False, **options)
+
+
+def write_sliding_windows(sliding_window_df, path=SLIDING_WINDOW_PARQUET):
+    """
+    Write the sliding-window dataset as Parquet, partitioned by analysis_start.
+    Windows present in sliding_window_df replace the stored ones.
+    :param sliding_window_df: DataFrame returned by sliding_window_aggregate.
+    :param path: Root directory of the dataset.
+    """
+    df = _with_categoricals(sliding_window_df, SLIDING_WINDOW_CATEGORICAL_COLUMNS)
+    df["analysis_start"] = pd.to_datetime(df["analysis_start"]).dt.strftime(DATE_FORMAT)
+    df.to_parquet(path, engine="pyarrow", partition_cols=["analysis_start"], index=False,
+                  existing_data_behavior="delete_matching")
+
+
+def read_historical_records(path=HISTORICAL_RECORDS_PARQUET, columns=None, start_date=None, end_date=None):
+    """
+    Read the historical records, optionally only some columns and dates.
+    Month partitions outside [start_date, end_date) are not read at all, and
+    the date filter is pushed down to the Parquet row groups.
+    :param path: Root directory of the dataset.
+    :param columns: Columns to load (default: all).
+    :param start_date: Only records on or after this date.
+    :param end_date: Only records before this date.
+    :return: DataFrame with the historical records.
+    """
+    filters = []
+    if start_date is not None:
+        start_date = pd.Timestamp(start_date)
+        filters += [("record_month", ">=", start_date.strftime(MONTH_FORMAT)), ("record_date", ">=", start_date)]
+    if end_date is not None:
+        end_date = pd.Timestamp(end_date)
+        filters += [("record_month", "<=", end_date.strftime(MONTH_FORMAT)), ("record_date", "<", end_date)]
+    df = pd.read_parquet(path, engine="pyarrow", columns=columns, filters=filters or None)
+    if columns is None or "record_month" not in columns:
+        df = df.drop(columns="record_month", errors="ignore")
+    return apply_record_schema(_sorted_categories(df))
+
+
+def read_sliding_windows(path=SLIDING_WINDOW_PARQUET, columns=None, analysis_starts=None):
+    """
+    Read the sliding-window dataset, optionally only some columns and windows.
+    :param path: Root directory of the dataset.
+    :param columns: Columns to load (default: all).
+    :param analysis_starts: Dates of the windows to load (default: all); only
+                            their partitions are read.
+    :return: DataFrame with the sliding-window data.
+    """
+    filters = None
+    if analysis_starts is not None:
+        filters = [("analysis_start", "in", [pd.Timestamp(date).strftime(DATE_FORMAT) for date in analysis_starts])]
+    df = pd.read_parquet(path, engine="pyarrow", columns=columns, filters=filters)
+    if "analysis_start" in df.columns:
+        df["analysis_start"] = pd.to_datetime(df["analysis_start"].astype(str), format=DATE_FORMAT)
+    return apply_window_schema(_sorted_categories(df))
+
+
+def list_analysis_starts(path=SLIDING_WINDOW_PARQUET):
+    """
+    List the windows stored in the sliding-window dataset, from the partition
+    directories only.
+    :param path: Root directory of the dataset.
+    :return: Sorted list of analysis_start timestamps.
+    """
+    prefix = "analysis_start="
+    return sorted(pd.Timestamp(name[len(prefix):]) for name in os.listdir(path) if name.startswith(prefix))
@@ -1,6 +1,9 @@
 import pandas as pd
 import numpy as np
 
+from dataset_storage import write_sliding_windows
+from sliding_window import sliding_window_aggregate
+
 # Set random seed for reproducibility
 np.random.seed(42)
 
@@ -26,69 +29,9 @@ analysis_window_size = pd.DateOffset(months=12)  # 12-month analysis window
 prediction_window_size = pd.DateOffset(months=6)  # 6-month prediction window
 step_size = pd.DateOffset(months=3)  # 3-month step (overlap of 9 months)
 
-# Define the start and end dates for sliding windows
-start_date = historical_data["record_date"].min()
-end_date = historical_data["record_date"].max()
-
-# Initialize an empty list to store aggregated data for each window
-sliding_window_data = []
-
-# Perform sliding window aggregation
-current_start = start_date
-while current_start + analysis_window_size + prediction_window_size <= end_date:
-    # Define the current analysis and prediction windows
-    analysis_start = current_start
-    analysis_end = current_start + analysis_window_size
-    prediction_start = analysis_end
-    prediction_end = analysis_end + prediction_window_size
-
-    # Filter data for the analysis window
-    analysis_window_data = historical_data[
-        (historical_data["record_date"] >= analysis_start) &
-        (historical_data["record_date"] < analysis_end)
-    ]
-
-    # Filter data for the prediction window
-    prediction_window_data = historical_data[
-        (historical_data["record_date"] >= prediction_start) &
-        (historical_data["record_date"] < prediction_end)
-    ]
-
-    # Aggregate features for the analysis window
-    aggregated_data = analysis_window_data.groupby("supplier_id").agg(
-        total_warnings=("severity_level", "count"),
-        critical_issues=("severity_level", lambda x: (x == "Critical").sum()),
-        moderate_issues=("severity_level", lambda x: (x == "Moderate").sum()),
-        minor_issues=("severity_level", lambda x: (x == "Minor").sum()),
-        safety_violations=("category_of_violation", lambda x: (x == "Safety").sum()),
-        quality_violations=("category_of_violation", lambda x: (x == "Quality").sum()),
-        documentation_violations=("category_of_violation", lambda x: (x == "Documentation").sum()),
-        regulatory_violations=("category_of_violation", lambda x: (x == "Regulatory").sum()),
-        unresolved_issues=("resolution_status", lambda x: (x == "Unresolved").sum()),
-        follow_up_actions=("follow_up_actions", "sum"),
-        avg_length_of_letter=("length_of_letter", "mean"),
-        avg_deadline_for_resolution=("deadline_for_resolution", "mean"),
-    ).reset_index()
-
-    # Add window metadata
-    aggregated_data["analysis_start"] = analysis_start
-    aggregated_data["analysis_end"] = analysis_end
-    aggregated_data["prediction_start"] = prediction_start
-    aggregated_data["prediction_end"] = prediction_end
-
-    # Define the target variable for each supplier
-    aggregated_data["ncr_or_warning_letter"] = aggregated_data["supplier_id"].isin(
-        prediction_window_data[prediction_window_data["ncr_or_warning_letter"] == 1]["supplier_id"]
-    ).astype(int)
-
-    # Append the aggregated data for this window
-    sliding_window_data.append(aggregated_data)
-
-    # Move the window forward by the step size
-    current_start += step_size
-
-# Combine all sliding window data into a single DataFrame
-final_sliding_window_data = pd.concat(sliding_window_data, ignore_index=True)
+# Aggregate every sliding window in one pass over the sorted history
+final_sliding_window_data = sliding_window_aggregate(historical_data, analysis_window_size, prediction_window_size,
+                                                     step_size)
 
 # Display the first few rows of the sliding window data
 print(final_sliding_window_data.head())
@@ -96,4 +39,5 @@ print(final_sliding_window_data.head())
 # Save to CSV for further use
 DATA_FOLDER = "../data/historical_ds/"
 final_sliding_window_data.to_csv(DATA_FOLDER + "sliding_window_supplier_data_with_target.csv", index=False)
+write_sliding_windows(final_sliding_window_data)
 print(final_sliding_window_data["ncr_or_warning_letter"].value_counts())
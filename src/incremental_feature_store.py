@@ -0,0 +1,308 @@
+import os
+import shutil
+import tempfile
+import time
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+import pandas as pd
+
+from change_detection import CHANGE_COLUMN, DELETED, INSERTED, ROW_KEY_COLUMN, change_counts, commit_snapshot, \
+    diff_snapshot, open_snapshot_store, stored_rows
+from feature_aggregation import COUNT_FEATURES, SUM_FEATURES, MEAN_FEATURES, FEATURE_COLUMNS
+from sliding_window import WINDOW_COLUMNS, sliding_window_aggregate
+
+# Window parameters of generate_historical_dataset_and_aggregate_with_sliding_window.py
+ANALYSIS_WINDOW_SIZE = pd.DateOffset(months=12)
+PREDICTION_WINDOW_SIZE = pd.DateOffset(months=6)
+STEP_SIZE = pd.DateOffset(months=3)
+
+# Layout of the running counters of a (supplier, window): total_warnings, the count features,
+# the sum features, a (sum, count) pair per mean feature, then the number of records
+_COUNT_OFFSET = 1
+_SUM_OFFSET = _COUNT_OFFSET + len(COUNT_FEATURES)
+_MEAN_OFFSET = _SUM_OFFSET + len(SUM_FEATURES)
+_RECORDS_OFFSET = _MEAN_OFFSET + 2 * len(MEAN_FEATURES)
+N_COUNTERS = _RECORDS_OFFSET + 1
+
+
+class IncrementalFeatureStore:
+    """
+    Sliding-window features kept up to date record by record.
+    Every (supplier, window) holds running counters of its analysis window and
+    the number of flagged records in its prediction window. A new record only
+    updates the few windows containing its date, instead of aggregating the
+    whole history again. Windows start at origin and follow each other every
+    step_size, as in sliding_window_aggregate.
+    """
+
+    def __init__(self, origin, analysis_window_size=ANALYSIS_WINDOW_SIZE,
+                 prediction_window_size=PREDICTION_WINDOW_SIZE, step_size=STEP_SIZE):
+        self.analysis_window_size = analysis_window_size
+        self.prediction_window_size = prediction_window_size
+        self.step_size = step_size
+        # Bounds of the windows opened so far, in order
+        self.windows = []
+        self.analysis_starts = []
+        self.analysis_ends = []
+        self.prediction_ends = []
+        self._open_window(pd.Timestamp(origin))
+        self.last_record_date = None
+        # (supplier_id, window) -> counters of the analysis window
+        self.counters = {}
+        # (supplier_id, window) -> flagged records in the prediction window
+        self.targets = {}
+        # supplier_id -> latest window with records in its analysis window
+        self.latest_window = {}
+
+    @classmethod
+    def from_history(cls, historical_data, **window_sizes):
+        """
+        Build a store from a whole history, windows starting at its first record.
+        :param historical_data: DataFrame with the historical records.
+        :return: IncrementalFeatureStore.
+        """
+        store = cls(pd.to_datetime(historical_data["record_date"]).min(), **window_sizes)
+        store.apply_records(historical_data)
+        return store
+
+    def _open_window(self, analysis_start):
+        analysis_end = analysis_start + self.analysis_window_size
+        prediction_end = analysis_end + self.prediction_window_size
+        self.windows.append((analysis_start, analysis_end, analysis_end, prediction_end))
+        self.analysis_starts.append(analysis_start)
+        self.analysis_ends.append(analysis_end)
+        self.prediction_ends.append(prediction_end)
+
+    def _open_windows_until(self, date):
+        # Same cumulative steps as window_bounds
+        while self.analysis_starts[-1] + self.step_size <= date:
+            self._open_window(self.analysis_starts[-1] + self.step_size)
+
+    def _record_counters(self, record):
+        counters = [0] * N_COUNTERS
+        counters[0] = int(pd.notna(record["severity_level"]))
+        for offset, (source, value) in enumerate(COUNT_FEATURES.values(), _COUNT_OFFSET):
+            counters[offset] = int(record[source] == value)
+        for offset, column in enumerate(SUM_FEATURES.values(), _SUM_OFFSET):
+            counters[offset] = 0 if pd.isna(record[column]) else record[column]
+        for position, column in enumerate(MEAN_FEATURES.values()):
+            if pd.notna(record[column]):
+                counters[_MEAN_OFFSET + 2 * position] = record[column]
+                counters[_MEAN_OFFSET + 2 * position + 1] = 1
+        counters[_RECORDS_OFFSET] = 1
+        return counters
+
+    def apply_records(self, records, sign=1):
+        """
+        Apply new historical records as deltas.
+        :param records: DataFrame with the historical records (ncr_or_warning_letter included).
+        :param sign: 1 to add the records, -1 to retract records applied before.
+        :return: Set of (supplier_id, analysis_start) whose features or target changed.
+        """
+        dates = pd.to_datetime(records["record_date"])
+        if len(records) and dates.min() < self.analysis_starts[0]:
+            raise ValueError(f"Records dated before the first window ({self.analysis_starts[0].date()})")
+        affected = set()
+        for record, date in zip(records.to_dict(orient="records"), dates):
+            self._open_windows_until(date)
+            supplier_id = record["supplier_id"]
+            counters = self._record_counters(record)
+
+            # Analysis windows containing the date: start <= date < end
+            for window in range(bisect_right(self.analysis_ends, date), bisect_right(self.analysis_starts, date)):
+                key = (supplier_id, window)
+                stored = self.counters.setdefault(key, [0] * N_COUNTERS)
+                for i, value in enumerate(counters):
+                    stored[i] += sign * value
+                # A window exists while it has records, whatever its feature values (float sums
+                # may not come back to exactly 0 after a retraction)
+                if stored[_RECORDS_OFFSET] == 0:
+                    del self.counters[key]
+                self._update_latest(supplier_id, window)
+                affected.add((supplier_id, self.analysis_starts[window]))
+
+            # Prediction windows containing the date: analysis_end <= date < prediction_end
+            if record["ncr_or_warning_letter"] == 1:
+                for window in range(bisect_right(self.prediction_ends, date), bisect_right(self.analysis_ends, date)):
+                    key = (supplier_id, window)
+                    self.targets[key] = self.targets.get(key, 0) + sign
+                    if self.targets[key] == 0:
+                        del self.targets[key]
+                    affected.add((supplier_id, self.analysis_starts[window]))
+
+            if self.last_record_date is None or date > self.last_record_date:
+                self.last_record_date = date
+        return affected
+
+    def apply_changes(self, conn, source, records, key_column):
+        """
+        Bring the store up to date with a new version of the historical records:
+        only the records inserted, updated or deleted since the last snapshot of
+        the source are applied. The former version of updated and deleted
+        records is retracted, the new version of inserted and updated ones is
+        added, then the snapshot moves forward. The snapshot must hold the
+        records the store was built from.
+        :param conn: Connection returned by change_detection.open_snapshot_store.
+        :param source: Snapshot source of the records.
+        :param records: DataFrame with the whole new version of the historical records.
+        :param key_column: Column holding the unique reference of a record.
+        :return: (delta returned by diff_snapshot, set of (supplier_id, analysis_start) whose features
+                 or target changed).
+        """
+        changes = diff_snapshot(conn, source, records, key_column)
+        former = stored_rows(conn, source, changes.loc[changes[CHANGE_COLUMN] != INSERTED, ROW_KEY_COLUMN])
+        affected = set()
+        if len(former):
+            affected |= self.apply_records(former, sign=-1)
+        affected |= self.apply_records(changes[changes[CHANGE_COLUMN] != DELETED])
+        commit_snapshot(conn, source, changes)
+        return changes, affected
+
+    def _update_latest(self, supplier_id, window):
+        latest = self.latest_window.get(supplier_id, -1)
+        if (supplier_id, window) in self.counters:
+            if window > latest:
+                self.latest_window[supplier_id] = window
+        elif window == latest:
+            # The latest window was emptied by a retraction, look for the previous one
+            while window >= 0 and (supplier_id, window) not in self.counters:
+                window -= 1
+            if window >= 0:
+                self.latest_window[supplier_id] = window
+            else:
+                del self.latest_window[supplier_id]
+
+    def _features(self, counters):
+        features = counters[:_MEAN_OFFSET]
+        for position in range(len(MEAN_FEATURES)):
+            total, count = counters[_MEAN_OFFSET + 2 * position:_MEAN_OFFSET + 2 * position + 2]
+            features.append(total / count if count else np.nan)
+        return features
+
+    def features(self, supplier_id, analysis_start):
+        """
+        Feature vector of a supplier for one window.
+        :return: pd.Series with the FEATURE_COLUMNS, or None if the supplier has no records in the window.
+        """
+        analysis_start = pd.Timestamp(analysis_start)
+        window = bisect_left(self.analysis_starts, analysis_start)
+        if window == len(self.analysis_starts) or self.analysis_starts[window] != analysis_start:
+            return None
+        counters = self.counters.get((supplier_id, window))
+        if counters is None:
+            return None
+        return pd.Series(self._features(counters), index=FEATURE_COLUMNS)
+
+    def latest_features(self, supplier_id):
+        """
+        Feature vector of the latest window with records of a supplier, in constant time.
+        :return: pd.Series with the supplier_id, FEATURE_COLUMNS, WINDOW_COLUMNS and
+                 ncr_or_warning_letter (the target may still change while the
+                 prediction window is not over), or None for an unknown supplier.
+        """
+        window = self.latest_window.get(supplier_id)
+        if window is None:
+            return None
+        values = ([supplier_id] + self._features(self.counters[(supplier_id, window)]) + list(self.windows[window]) +
+                  [int(self.targets.get((supplier_id, window), 0) > 0)])
+        return pd.Series(values, index=["supplier_id"] + FEATURE_COLUMNS + WINDOW_COLUMNS + ["ncr_or_warning_letter"])
+
+    def to_dataframe(self):
+        """
+        Export the complete windows (prediction window over by the last record),
+        in the same layout and order as sliding_window_aggregate.
+        :return: DataFrame with one row per (window, supplier with records in the analysis window).
+        """
+        columns = ["supplier_id"] + FEATURE_COLUMNS + WINDOW_COLUMNS + ["ncr_or_warning_letter"]
+        if self.last_record_date is None:
+            return pd.DataFrame(columns=columns)
+        n_complete = bisect_right(self.prediction_ends, self.last_record_date)
+        keys = sorted((window, supplier_id) for supplier_id, window in self.counters if window < n_complete)
+        rows = [[supplier_id] + self._features(self.counters[(supplier_id, window)]) + list(self.windows[window]) +
+                [int(self.targets.get((supplier_id, window), 0) > 0)] for window, supplier_id in keys]
+        result = pd.DataFrame(rows, columns=columns)
+        for column in WINDOW_COLUMNS:
+            result[column] = pd.to_datetime(result[column])
+        return result
+
+
+if __name__ == "__main__":
+    # Parity with sliding_window_aggregate when the history arrives in increments
+    rng = np.random.default_rng(42)
+    n_records = 20_000
+    historical_data = pd.DataFrame({
+        "supplier_id": rng.choice([f"S{i}" for i in range(1, 1001)], n_records),
+        "record_date": pd.Timestamp("2021-01-01") + pd.to_timedelta(np.sort(rng.integers(0, 4 * 365, n_records)),
+                                                                        unit="D"),
+        "severity_level": rng.choice(["Minor", "Moderate", "Critical"], n_records),
+        "category_of_violation": rng.choice(["Safety", "Quality", "Documentation", "Regulatory"], n_records),
+        "resolution_status": rng.choice(["Resolved", "Pending", "Unresolved"], n_records),
+        "follow_up_actions": rng.choice([0, 1], n_records),
+        "length_of_letter": rng.integers(100, 1000, n_records),
+        "deadline_for_resolution": rng.integers(1, 30, n_records),
+        "ncr_or_warning_letter": rng.choice([0, 1], n_records),
+    })
+    initial = int(n_records * 0.8)
+    store = IncrementalFeatureStore.from_history(historical_data.iloc[:initial])
+
+    start = time.perf_counter()
+    for position in range(initial, n_records):
+        store.apply_records(historical_data.iloc[position:position + 1])
+    delta_seconds = (time.perf_counter() - start) / (n_records - initial)
+
+    start = time.perf_counter()
+    expected = sliding_window_aggregate(historical_data, ANALYSIS_WINDOW_SIZE, PREDICTION_WINDOW_SIZE, STEP_SIZE)
+    full_seconds = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(store.to_dataframe(), expected, check_dtype=False)
+    print(f"Identical sliding windows ({len(expected)} rows) after {n_records - initial} single-record deltas")
+    print(f"  per new record: delta {delta_seconds * 1e3:.2f}ms, full recompute {full_seconds * 1e3:.0f}ms")
+
+    # A window whose only record has no severity, no known category and no numeric values still exists,
+    # and disappears once that record is retracted
+    empty_record = pd.DataFrame({"supplier_id": ["S_empty"], "record_date": [historical_data["record_date"].iloc[0]],
+                                 "severity_level": [np.nan], "category_of_violation": ["Other"],
+                                 "resolution_status": ["Other"], "follow_up_actions": [np.nan],
+                                 "length_of_letter": [np.nan], "deadline_for_resolution": [np.nan],
+                                 "ncr_or_warning_letter": [0]})
+    store.apply_records(empty_record)
+    with_empty = pd.concat([historical_data, empty_record], ignore_index=True)
+    pd.testing.assert_frame_equal(store.to_dataframe(), sliding_window_aggregate(
+        with_empty, ANALYSIS_WINDOW_SIZE, PREDICTION_WINDOW_SIZE, STEP_SIZE), check_dtype=False)
+    store.apply_records(empty_record, sign=-1)
+    pd.testing.assert_frame_equal(store.to_dataframe(), expected, check_dtype=False)
+    print("  identical windows after adding then retracting a record without feature values")
+
+    # A new version of the history only costs its delta against the last snapshot of the records
+    folder = tempfile.mkdtemp()
+    try:
+        snapshots = open_snapshot_store(os.path.join(folder, "snapshots.db"))
+        history = historical_data.assign(record_id=[f"R{i}" for i in range(n_records)])
+        store = IncrementalFeatureStore.from_history(history)
+        commit_snapshot(snapshots, "records", diff_snapshot(snapshots, "records", history, "record_id"))
+        # 1% of the records are updated, 1% deleted (never the first one, which sets the windows) and 1% inserted
+        n_changed = n_records // 100
+        changed = rng.choice(np.arange(1, n_records), 2 * n_changed, replace=False)
+        new_history = history.copy()
+        new_history.loc[changed[:n_changed], "severity_level"] = "Critical"
+        new_history.loc[changed[:n_changed], "ncr_or_warning_letter"] = 1 - new_history.loc[changed[:n_changed],
+                                                                                             "ncr_or_warning_letter"]
+        inserted = history.sample(n_changed, random_state=0).assign(record_id=[f"N{i}" for i in range(n_changed)])
+        new_history = pd.concat([new_history.drop(changed[n_changed:]), inserted], ignore_index=True)
+
+        start = time.perf_counter()
+        changes, affected = store.apply_changes(snapshots, "records", new_history, "record_id")
+        changes_seconds = time.perf_counter() - start
+        snapshots.close()
+    finally:
+        shutil.rmtree(folder)
+    pd.testing.assert_frame_equal(store.to_dataframe(), sliding_window_aggregate(
+        new_history, ANALYSIS_WINDOW_SIZE, PREDICTION_WINDOW_SIZE, STEP_SIZE), check_dtype=False)
+    print(f"  identical windows after a new version of the history: {change_counts(changes)} applied in "
+          f"{changes_seconds:.2f}s, {len(affected)} (supplier, window) pairs changed")
+
+    start = time.perf_counter()
+    for supplier_id in historical_data["supplier_id"].unique():
+        store.latest_features(supplier_id)
+    print(f"  latest feature vector: {(time.perf_counter() - start) / 1000 * 1e6:.0f}us per supplier")
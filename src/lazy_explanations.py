@@ -0,0 +1,103 @@
+import threading
+import time
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import shap
+
+from shap_store import explain_rows
+from supplier_index import build_supplier_index, window_rows
+
+# Default number of rows explained for the global views
+GLOBAL_SAMPLE_SIZE = 2000
+
+# Number of (supplier, window) explanations kept in memory
+SUPPLIER_CACHE_SIZE = 256
+
+
+def stratified_sample(labels, sample_size, seed=42):
+    """
+    Draw a sample of row positions keeping the proportion of every label.
+    :param labels: Array-like with the label of every row (e.g. the target).
+    :param sample_size: Number of rows of the sample.
+    :param seed: Random seed.
+    :return: Sorted array of row positions.
+    """
+    codes, uniques = pd.factorize(pd.Series(labels), use_na_sentinel=False)
+    if sample_size >= len(codes):
+        return np.arange(len(codes))
+    rng = np.random.default_rng(seed)
+    counts = np.bincount(codes, minlength=len(uniques))
+    # Proportional allocation, the rounding remainder goes to the largest fractions
+    quotas = counts * sample_size / len(codes)
+    allocated = np.floor(quotas).astype(np.int64)
+    remainder = sample_size - allocated.sum()
+    allocated[np.argsort(allocated - quotas)[:remainder]] += 1
+    positions = [rng.choice(np.flatnonzero(codes == code), size, replace=False)
+                 for code, size in enumerate(allocated) if size > 0]
+    return np.sort(np.concatenate(positions))
+
+
+def to_explanation(values, base_values, X_rows):
+    """
+    Wrap positive-class SHAP values in a shap Explanation.
+    :return: shap.Explanation.
+    """
+    return shap.Explanation(values, base_values, data=X_rows.values, feature_names=list(X_rows.columns))
+
+
+def make_supplier_explainer(explainer, data, X, supplier_rows=None, cache_size=SUPPLIER_CACHE_SIZE):
+    """
+    Build a memoized function explaining only the rows of one supplier and window.
+    :param explainer: shap.TreeExplainer of the model.
+    :param data: Sliding-window DataFrame (supplier_id and analysis_start columns).
+    :param X: DataFrame with the model features, same rows as data.
+    :param supplier_rows: Index returned by build_supplier_index (built if not given).
+    :param cache_size: Number of explanations kept in the LRU cache.
+    :return: Function (supplier_id, analysis_start) -> shap.Explanation of the matching rows.
+    """
+    if supplier_rows is None:
+        supplier_rows = build_supplier_index(data)
+    analysis_starts = pd.to_datetime(data["analysis_start"]).to_numpy()
+
+    @lru_cache(maxsize=cache_size)
+    def explain_supplier(supplier_id, analysis_start):
+        rows = window_rows(supplier_rows, analysis_starts, supplier_id, analysis_start)
+        values, base_values = explain_rows(explainer, X.iloc[rows])
+        return to_explanation(values, base_values, X.iloc[rows])
+
+    return explain_supplier
+
+
+def explain_sample(explainer, X, positions):
+    """
+    Explain a sample of rows for the global views.
+    :param explainer: shap.TreeExplainer of the model.
+    :param X: DataFrame with the model features.
+    :param positions: Row positions to explain.
+    :return: shap.Explanation of the sample.
+    """
+    values, base_values = explain_rows(explainer, X.iloc[positions])
+    return to_explanation(values, base_values, X.iloc[positions])
+
+
+def start_background_explanation(explainer, X):
+    """
+    Explain every row in a background thread.
+    :param explainer: shap.TreeExplainer of the model.
+    :param X: DataFrame with the model features.
+    :return: Dictionary with the "thread", and the "explanation" and "seconds"
+             once the thread is done.
+    """
+    job = {"explanation": None, "seconds": None}
+
+    def run():
+        start = time.perf_counter()
+        values, base_values = explain_rows(explainer, X)
+        job["explanation"] = to_explanation(values, base_values, X)
+        job["seconds"] = time.perf_counter() - start
+
+    job["thread"] = threading.Thread(target=run, daemon=True)
+    job["thread"].start()
+    return job
@@ -0,0 +1,291 @@
+import argparse
+import email.utils
+import glob
+import hashlib
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+MANIFEST_FN = "download_manifest.json"
+
+# The manifest is saved every MANIFEST_SAVE_EVERY letters or MANIFEST_SAVE_SECONDS, and at the end of a run
+MANIFEST_SAVE_EVERY = 200
+MANIFEST_SAVE_SECONDS = 10.0
+
+# Concurrency and politeness defaults
+MAX_WORKERS = 8
+REQUESTS_PER_SECOND = 4.0  # Per host
+REQUEST_TIMEOUT = (10, 60)  # Connect and read timeouts in seconds
+
+# Retries with exponential backoff
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0  # Seconds before the first retry, doubled at every attempt
+BACKOFF_MAX = 60.0
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class HostRateLimiter:
+    """
+    Space the requests sent to each host by at least 1 / requests_per_second,
+    across all the threads sharing the limiter.
+    """
+
+    def __init__(self, requests_per_second=REQUESTS_PER_SECOND):
+        self.interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self.next_slot = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def make_session(pool_size=MAX_WORKERS):
+    """
+    Create a requests session whose connection pool is shared by all the workers.
+    :param pool_size: Maximum number of connections kept per host.
+    :return: requests.Session.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def load_manifest(path):
+    """
+    Load the download manifest: URL -> {filename, etag, last_modified, sha256, status, updated_at}.
+    :param path: Path of the manifest JSON file.
+    :return: Dictionary (empty if the manifest does not exist yet).
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, path):
+    # Write to a temporary file first so an interrupted run never leaves a truncated manifest
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(temporary_path, path)
+
+
+def _retry_delay(attempt, response=None, backoff_base=BACKOFF_BASE):
+    # Retry-After (in seconds) wins over the exponential backoff, jitter spreads the retries of the workers
+    if response is not None and response.headers.get("Retry-After", "").isdigit():
+        return min(float(response.headers["Retry-After"]), BACKOFF_MAX)
+    return min(backoff_base * 2 ** attempt, BACKOFF_MAX) * random.uniform(0.5, 1.0)
+
+
+def fetch_with_retry(session, url, rate_limiter, headers=None, max_retries=MAX_RETRIES, timeout=REQUEST_TIMEOUT,
+                     params=None, backoff_base=BACKOFF_BASE):
+    """
+    GET a URL, retrying connection errors and retryable status codes with
+    exponential backoff.
+    :param backoff_base: Seconds before the first retry, doubled at every attempt.
+    :return: requests.Response (status 200 or 304); raises the last error after max_retries.
+    """
+    for attempt in range(max_retries + 1):
+        rate_limiter.wait(url)
+        try:
+            response = session.get(url, params=params, headers=headers, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == max_retries:
+                raise
+            time.sleep(_retry_delay(attempt, backoff_base=backoff_base))
+            continue
+        if response.status_code in RETRY_STATUS_CODES and attempt < max_retries:
+            time.sleep(_retry_delay(attempt, response, backoff_base))
+            continue
+        response.raise_for_status()
+        return response
+
+
+def download_letter(session, rate_limiter, url, path, entry=None, revalidate=False, backoff_base=BACKOFF_BASE):
+    """
+    Download one letter, skipping it when the file is already there.
+    :param session: Shared requests session.
+    :param rate_limiter: Shared HostRateLimiter.
+    :param url: URL of the letter.
+    :param path: Output file.
+    :param entry: Manifest entry of a previous download of the URL.
+    :param revalidate: Ask the server whether a downloaded letter changed (conditional GET)
+                       instead of skipping it.
+    :param backoff_base: Seconds before the first retry, doubled at every attempt.
+    :return: (status, manifest entry) with status "downloaded", "not_modified" or "skipped".
+    """
+    exists = entry is not None and entry.get("filename") == os.path.basename(path) and os.path.exists(path)
+    if exists and not revalidate:
+        return "skipped", entry
+
+    headers = {}
+    if exists:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    response = fetch_with_retry(session, url, rate_limiter, headers, backoff_base=backoff_base)
+    if response.status_code == 304:
+        return "not_modified", dict(entry, updated_at=datetime.now().isoformat(timespec="seconds"))
+
+    temporary_path = path + ".part"
+    with open(temporary_path, "wb") as file:
+        file.write(response.content)
+    os.replace(temporary_path, path)
+    return "downloaded", {
+        "filename": os.path.basename(path),
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "sha256": hashlib.sha256(response.content).hexdigest(),
+        "status": "downloaded",
+        "updated_at": datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+def download_letters(jobs, download_dir, max_workers=MAX_WORKERS, requests_per_second=REQUESTS_PER_SECOND,
+                     revalidate=False, session=None, backoff_base=BACKOFF_BASE):
+    """
+    Download letters concurrently with a bounded thread pool, one pooled session,
+    a per-host rate limit and a manifest making interrupted runs resumable.
+    :param jobs: List of (url, filename) tuples.
+    :param download_dir: Output directory, also holding the manifest.
+    :param max_workers: Number of concurrent downloads.
+    :param requests_per_second: Rate limit per host.
+    :param revalidate: Send conditional requests for letters already downloaded instead of skipping them.
+    :param session: Optional requests session (default: a new pooled session).
+    :param backoff_base: Seconds before the first retry, doubled at every attempt.
+    :return: Dictionary with the number of letters per status (downloaded, not_modified, skipped, failed).
+    """
+    os.makedirs(download_dir, exist_ok=True)
+    manifest_path = os.path.join(download_dir, MANIFEST_FN)
+    manifest = load_manifest(manifest_path)
+    manifest_lock = threading.Lock()
+    session = session or make_session(max_workers)
+    rate_limiter = HostRateLimiter(requests_per_second)
+    counts = {"downloaded": 0, "not_modified": 0, "skipped": 0, "failed": 0}
+    # Letters not saved in the manifest yet, and time of the last save
+    unsaved = {"letters": 0, "saved_at": time.monotonic()}
+
+    def run(job):
+        url, filename = job
+        try:
+            status, entry = download_letter(session, rate_limiter, url, os.path.join(download_dir, filename),
+                                            manifest.get(url), revalidate, backoff_base)
+        except Exception as e:
+            print(f"Error downloading warning letter from {url}: {e}")
+            status, entry = "failed", dict(manifest.get(url, {}), status="failed")
+        with manifest_lock:
+            counts[status] += 1
+            if status != "skipped":
+                manifest[url] = entry
+                unsaved["letters"] += 1
+                # An interrupted run only loses the entries since the last save: those letters are downloaded again
+                if (unsaved["letters"] >= MANIFEST_SAVE_EVERY or
+                        time.monotonic() - unsaved["saved_at"] >= MANIFEST_SAVE_SECONDS):
+                    save_manifest(manifest, manifest_path)
+                    unsaved.update(letters=0, saved_at=time.monotonic())
+
+    try:
+        with ThreadPoolExecutor(max_workers) as executor:
+            list(executor.map(run, jobs))
+    finally:
+        with manifest_lock:
+            if unsaved["letters"]:
+                save_manifest(manifest, manifest_path)
+    return counts
+
+
+def serve_letters(folder, port=0, failure_rate=0.0):
+    """
+    Local stand-in for the FDA site serving the HTML files of a folder at
+    /<filename>, with ETag/Last-Modified support and optional random 503 errors.
+    :param folder: Folder with the files to serve.
+    :param port: Port to listen on (0: any free port).
+    :param failure_rate: Probability of answering 503 to a request.
+    :return: (server, base URL); call server.shutdown() to stop it.
+    """
+
+    class LetterHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            path = os.path.join(folder, os.path.basename(self.path))
+            if random.random() < failure_rate:
+                self.send_response(503)
+                self.send_header("Retry-After", "0")
+                self.end_headers()
+                return
+            if not os.path.isfile(path):
+                self.send_response(404)
+                self.end_headers()
+                return
+            with open(path, "rb") as f:
+                content = f.read()
+            etag = '"' + hashlib.sha256(content).hexdigest()[:16] + '"'
+            last_modified = email.utils.formatdate(os.path.getmtime(path), usegmt=True)
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(content)))
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), LetterHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+if __name__ == "__main__":
+    # Download the sample letters from a local stand-in server with failures, then resume and revalidate
+    parser = argparse.ArgumentParser(description="Exercise the letter downloader against a local server")
+    parser.add_argument("--source", default="../data/warning_letters", help="Folder with the letters to serve")
+    parser.add_argument("--copies", type=int, default=20, help="Times every sample letter is served")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="Concurrent downloads")
+    parser.add_argument("--rate", type=float, default=200.0, help="Requests per second")
+    parser.add_argument("--failure-rate", type=float, default=0.2, help="Share of requests answered with 503")
+    args = parser.parse_args()
+
+    served_dir = tempfile.mkdtemp()
+    download_dir = tempfile.mkdtemp()
+    samples = sorted(glob.glob(os.path.join(args.source, "*.html")))
+    for copy in range(args.copies):
+        for sample in samples:
+            shutil.copy(sample, os.path.join(served_dir, f"{copy}_{os.path.basename(sample)}"))
+    server, base_url = serve_letters(served_dir, failure_rate=args.failure_rate)
+    jobs = [(f"{base_url}/{name}", name) for name in sorted(os.listdir(served_dir))]
+    try:
+        for label, revalidate in [("first run", False), ("resumed run", False), ("revalidation", True)]:
+            start = time.perf_counter()
+            # The stand-in server asks for no wait (Retry-After: 0), connection errors are retried almost at once
+            counts = download_letters(jobs, download_dir, args.workers, args.rate, revalidate, backoff_base=0.01)
+            print(f"{label}: {counts} in {time.perf_counter() - start:.2f}s")
+    finally:
+        server.shutdown()
+        shutil.rmtree(served_dir)
+        shutil.rmtree(download_dir)
@@ -0,0 +1,198 @@
+import argparse
+import glob
+import os
+import re
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import pandas as pd
+from bs4 import BeautifulSoup
+
+from violation_extractor import find_violations, violation_headers, violations_text
+
+# Faster lxml backend when installed, pure-Python html.parser otherwise
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+METADATA_LABELS = ["Delivery Method:", "Reference #:", "Product:", "Issuing Office:"]
+
+# Letters parsed and written per chunk
+PARSE_CHUNK_SIZE = 500
+
+# The letter and its metadata live in the <article> element, the og:title meta tag is the company name fallback
+ARTICLE_START = re.compile(r"<article\b", re.IGNORECASE)
+ARTICLE_END = re.compile(r"</article\s*>", re.IGNORECASE)
+OG_TITLE_META = re.compile(r"<meta\b[^>]*property=[\"']og:title[\"'][^>]*>", re.IGNORECASE)
+
+
+def article_html(html):
+    """
+    Cut the article subtree (and the og:title meta tag) out of a letter page,
+    so the parser skips the navigation, scripts and footer.
+    :param html: Whole HTML page.
+    :return: HTML fragment to parse, or the whole page if it has no <article>.
+    """
+    start = ARTICLE_START.search(html)
+    end = None
+    for end in ARTICLE_END.finditer(html):
+        pass
+    if start is None or end is None or end.end() <= start.start():
+        return html
+    og_title = OG_TITLE_META.search(html, 0, start.start())
+    return (og_title.group(0) if og_title else "") + html[start.start():end.end()]
+
+
+def letter_soup(file_path, parser=HTML_PARSER, article_only=True):
+    """
+    Parse a warning letter HTML file.
+    :param file_path: Path to the HTML file.
+    :param parser: BeautifulSoup parser backend.
+    :param article_only: Only parse the article subtree.
+    :return: BeautifulSoup.
+    """
+    with open(file_path, 'r', encoding='utf-8') as file:
+        html = file.read()
+    return BeautifulSoup(article_html(html) if article_only else html, parser)
+
+
+def extract_letter_metadata(soup):
+    """
+    Extract metadata, company information and violations from a parsed letter.
+    :param soup: BeautifulSoup of the letter.
+    :return: A dictionary containing metadata and letter text.
+    """
+    # Extract metadata
+    metadata = {}
+
+    for label in METADATA_LABELS:
+        element = soup.find('dt', string=label)
+        if element:
+            metadata[label.strip(":")] = element.find_next('dd').text.strip()
+        else:
+            metadata[label.strip(":")] = None
+
+    # Extract company information (adapted for different structures)
+    company_info = {}
+    # Try finding company name
+    company_name = soup.find("h1", {"class": "text-center content-title"})
+    if company_name:
+        company_info["company_name"] = company_name.text.strip()
+    else:
+        company_info["company_name"] = soup.find("meta", {"property": "og:title"})["content"].split(" - ")[0]
+
+    # Try finding recipient name
+    recipient = soup.find("div", {"class": "field--name-field-recipient-name"})
+    if recipient:
+        company_info["recipient_name"] = recipient.find("div", {"class": "field--item"}).text.strip()
+    else:
+        company_info["recipient_name"] = "Not found"
+
+    # Extract address details
+    address_fields = ["address-line1", "address-line2", "locality", "administrative-area", "postal-code", "country"]
+    for field in address_fields:
+        tag = soup.find("span", {"class": field})
+        company_info[field.replace("-", "_")] = tag.text.strip() if tag else "Not found"
+
+    metadata["Company Info"] = company_info
+
+    # Extract violations (different structures)
+    metadata["Violations"] = violations_text(find_violations(violation_headers(soup)))
+    return metadata
+
+
+def parse_letter_file(file_path, parser=HTML_PARSER, article_only=True):
+    """
+    Parse one letter file, for the workers of parse_letters.
+    :return: Metadata dictionary, with None values if the file could not be parsed.
+    """
+    try:
+        return extract_letter_metadata(letter_soup(file_path, parser, article_only))
+    except Exception as e:
+        print(f"Error processing file {file_path}: {e}")
+        return {key: None for key in METADATA_LABELS}
+
+
+def parse_letters(paths, workers=None, parser=HTML_PARSER, chunk_size=PARSE_CHUNK_SIZE):
+    """
+    Parse letter files over a process pool, chunk by chunk, so only one chunk
+    of results is held in memory at a time.
+    :param paths: List of HTML file paths.
+    :param workers: Number of worker processes (default: number of CPUs).
+    :param parser: BeautifulSoup parser backend.
+    :param chunk_size: Number of letters per chunk.
+    :return: Iterator of metadata DataFrames, one per chunk, in the order of paths.
+    """
+    n_workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(n_workers) as executor:
+        for start in range(0, len(paths), chunk_size):
+            chunk = paths[start:start + chunk_size]
+            yield pd.DataFrame(list(executor.map(parse_letter_file, chunk, repeat(parser),
+                                                 chunksize=max(1, len(chunk) // (4 * n_workers)))))
+
+
+def write_parsed_letters(paths, output_path, workers=None, parser=HTML_PARSER, chunk_size=PARSE_CHUNK_SIZE):
+    """
+    Parse letter files and append the metadata to a CSV file chunk by chunk.
+    :param paths: List of HTML file paths.
+    :param output_path: Output CSV file.
+    :return: Number of letters written.
+    """
+    n_written = 0
+    for metadata_df in parse_letters(paths, workers, parser, chunk_size):
+        metadata_df.to_csv(output_path, mode="w" if n_written == 0 else "a", header=n_written == 0, index=False)
+        n_written += len(metadata_df)
+    return n_written
+
+
+def synthetic_corpus(folder, n_letters, source_dir="../data/warning_letters"):
+    """
+    Build a corpus of n_letters files by cycling through the sample letters.
+    :return: List of the file paths.
+    """
+    samples = sorted(glob.glob(os.path.join(source_dir, "*.html")))
+    paths = []
+    for number in range(n_letters):
+        path = os.path.join(folder, f"warning_letter_{number + 1}.html")
+        shutil.copy(samples[number % len(samples)], path)
+        paths.append(path)
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the letter parsing pipeline on a synthetic corpus")
+    parser.add_argument("--letters", type=int, default=10_000, help="Letters in the synthetic corpus")
+    parser.add_argument("--baseline-letters", type=int, default=500,
+                        help="Letters parsed by the serial full-document baseline")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes")
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    try:
+        paths = synthetic_corpus(folder, args.letters)
+
+        # Serial baseline: full document with html.parser, as main() used to do
+        baseline_paths = paths[:args.baseline_letters]
+        start = time.perf_counter()
+        baseline_df = pd.DataFrame([parse_letter_file(path, "html.parser", article_only=False)
+                                    for path in baseline_paths])
+        baseline_rate = len(baseline_paths) / (time.perf_counter() - start)
+        baseline_df.to_csv(os.path.join(folder, "baseline.csv"), index=False)
+
+        start = time.perf_counter()
+        n_written = write_parsed_letters(paths, os.path.join(folder, "metadata.csv"), args.workers)
+        pipeline_rate = n_written / (time.perf_counter() - start)
+
+        with open(os.path.join(folder, "baseline.csv"), encoding="utf-8") as f:
+            expected = f.read()
+        with open(os.path.join(folder, "metadata.csv"), encoding="utf-8") as f:
+            parsed = f.read(len(expected))
+        print(f"{args.letters} letters, parser {HTML_PARSER}, same output as the baseline: {parsed == expected}")
+        print(f"  serial html.parser: {baseline_rate:.0f} letters/s, pipeline: {pipeline_rate:.0f} letters/s")
+    finally:
+        shutil.rmtree(folder)
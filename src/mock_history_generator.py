@@ -0,0 +1,129 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from dataset_storage import write_historical_records
+
+# Values drawn for the categorical columns of the historical records
+RECORD_CHOICES = {
+    "severity_level": ["Minor", "Moderate", "Critical"],
+    "category_of_violation": ["Safety", "Quality", "Documentation", "Regulatory"],
+    "root_cause_category": ["Human Error", "Process Failure", "Equipment Malfunction"],
+    "corrective_actions_suggested": [0, 1],  # 0 = No, 1 = Yes
+    "affected_product": ["Product A", "Product B", "Product C", "Product D"],
+    "process_involved": ["Packaging", "Testing", "Shipping", "Manufacturing"],
+    "tone_of_letter": ["Formal", "Urgent", "Warning"],
+    "resolution_status": ["Resolved", "Pending", "Unresolved"],
+    "follow_up_actions": [0, 1],  # 0 = No, 1 = Yes
+}
+
+# Columns of historical_records_data_with_dates.csv, in order
+RECORD_COLUMNS = [
+    "supplier_id", "record_date", "severity_level", "category_of_violation", "root_cause_category",
+    "corrective_actions_suggested", "affected_product", "process_involved", "tone_of_letter", "length_of_letter",
+    "deadline_for_resolution", "resolution_status", "follow_up_actions",
+]
+
+CURRENT_DATE = pd.Timestamp("2025-01-01")
+
+# Default number of suppliers generated and written per chunk
+CHUNK_SUPPLIERS = 20_000
+
+
+def _draw(choices, size, rng):
+    # Draw a whole column at once from a list of choices
+    return np.asarray(choices, dtype=object if isinstance(choices[0], str) else np.int64)[
+        rng.integers(0, len(choices), size)]
+
+
+def generate_history_chunk(supplier_numbers, records_per_supplier, rng, current_date=CURRENT_DATE):
+    """
+    Generate the historical records of a batch of suppliers, every column
+    being drawn as a whole array.
+    :param supplier_numbers: Array with the numbers of the suppliers (S<number>).
+    :param records_per_supplier: Array with the number of records of each supplier.
+    :param rng: numpy Generator.
+    :param current_date: Records are dated in the 2 years before this date.
+    :return: DataFrame with the RECORD_COLUMNS.
+    """
+    n_records = int(np.sum(records_per_supplier))
+    supplier_ids = np.array([f"S{number}" for number in supplier_numbers], dtype=object)
+    days_before = rng.integers(1, 730, n_records)  # Random date in the past 2 years
+    records = {
+        "supplier_id": np.repeat(supplier_ids, records_per_supplier),
+        "record_date": pd.Timestamp(current_date) - pd.to_timedelta(days_before, unit="D"),
+    }
+    for column, choices in RECORD_CHOICES.items():
+        records[column] = _draw(choices, n_records, rng)
+    records["length_of_letter"] = rng.integers(100, 1000, n_records)  # Length of the letter in words
+    records["deadline_for_resolution"] = rng.integers(1, 30, n_records)  # Days to resolve the issue
+    return pd.DataFrame(records, columns=RECORD_COLUMNS)
+
+
+def records_per_supplier_counts(n_suppliers, rng, min_records=5, max_records=50, n_records=None):
+    """
+    Draw the number of records of every supplier.
+    :param n_suppliers: Number of suppliers.
+    :param rng: numpy Generator.
+    :param min_records: Minimum number of records per supplier.
+    :param max_records: Maximum number of records per supplier (exclusive).
+    :param n_records: Optional total number of records, spread uniformly over the suppliers.
+    :return: Array with the number of records of each supplier.
+    """
+    if n_records is not None:
+        return rng.multinomial(n_records, np.full(n_suppliers, 1 / n_suppliers))
+    return rng.integers(min_records, max_records, n_suppliers)
+
+
+def iter_history_chunks(n_suppliers, records_per_supplier, rng, chunk_suppliers=CHUNK_SUPPLIERS,
+                        current_date=CURRENT_DATE):
+    """
+    Generate the historical records chunk by chunk, chunk_suppliers suppliers at a time.
+    :return: Iterator of DataFrames.
+    """
+    for start in range(0, n_suppliers, chunk_suppliers):
+        stop = min(start + chunk_suppliers, n_suppliers)
+        yield generate_history_chunk(np.arange(start + 1, stop + 1), records_per_supplier[start:stop], rng,
+                                     current_date)
+
+
+def write_mock_history(path, n_suppliers, records_per_supplier, rng, chunk_suppliers=CHUNK_SUPPLIERS):
+    """
+    Stream a mock history to disk, one chunk in memory at a time.
+    :param path: Output CSV file, or partitioned Parquet directory if it ends with .parquet.
+    :param n_suppliers: Number of suppliers.
+    :param records_per_supplier: Array with the number of records of each supplier.
+    :param rng: numpy Generator.
+    :param chunk_suppliers: Number of suppliers generated per chunk.
+    :return: Number of records written.
+    """
+    n_written = 0
+    for chunk_number, chunk in enumerate(iter_history_chunks(n_suppliers, records_per_supplier, rng, chunk_suppliers)):
+        if path.endswith(".parquet"):
+            write_historical_records(chunk, path, chunk_name=f"chunk-{chunk_number:05d}")
+        else:
+            chunk.to_csv(path, mode="w" if n_written == 0 else "a", header=n_written == 0, index=False)
+        n_written += len(chunk)
+    return n_written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a large mock history of supplier records")
+    parser.add_argument("--suppliers", type=int, default=1000, help="Number of suppliers")
+    parser.add_argument("--records", type=int, default=None,
+                        help="Total number of records (default: 5 to 49 records per supplier)")
+    parser.add_argument("--chunk-suppliers", type=int, default=CHUNK_SUPPLIERS,
+                        help="Number of suppliers generated and written per chunk")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed")
+    parser.add_argument("--output", default=os.path.join("..", "data", "historical_ds", "mock_history.csv"),
+                        help="Output CSV file, or partitioned Parquet directory if it ends with .parquet")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    counts = records_per_supplier_counts(args.suppliers, rng, n_records=args.records)
+    start = time.perf_counter()
+    n_written = write_mock_history(args.output, args.suppliers, counts, rng, args.chunk_suppliers)
+    print(f"{n_written} records written to {args.output} in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,234 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score, roc_auc_score
+from sklearn.model_selection import ParameterSampler, TimeSeriesSplit
+
+from dataset_storage import SLIDING_WINDOW_PARQUET, read_sliding_windows
+from feature_aggregation import FEATURE_COLUMNS
+from record_schema import SLIDING_WINDOW_CSV, read_sliding_window_csv
+
+MODEL_PATH = "../models/supplier_warning_model.pkl"
+TRAINING_LOG_PATH = "../models/training_log.csv"
+TARGET_COLUMN = "ncr_or_warning_letter"
+
+# Cross-validation and model settings of model_training.ipynb
+N_SPLITS = 5
+RANDOM_STATE = 42
+BASELINE_PARAMS = {"n_estimators": 100}
+
+# Hyperparameter space of the randomized search of model_training.ipynb
+PARAM_DISTRIBUTIONS = {
+    "n_estimators": [50, 100, 200, 300, 400],
+    "max_depth": [None, 10, 20, 30, 40],
+    "min_samples_split": [2, 5, 10],
+    "min_samples_leaf": [1, 2, 4],
+    "max_features": ["sqrt", "log2", None],
+}
+
+METRICS = ["accuracy", "precision", "recall", "f1", "roc_auc"]
+
+# Arrays of the training data, attached once per worker process from shared memory
+_shared = {}
+
+
+def load_training_data(path=None):
+    """
+    Load the sliding-window dataset in temporal order and split the model features from the target.
+    :param path: CSV file or Parquet directory (default: Parquet if present, else CSV).
+    :return: (X, y) with X a DataFrame of the FEATURE_COLUMNS and y the target Series.
+    """
+    if path is None:
+        path = SLIDING_WINDOW_PARQUET if os.path.exists(SLIDING_WINDOW_PARQUET) else SLIDING_WINDOW_CSV
+    data = read_sliding_windows(path) if os.path.isdir(path) else read_sliding_window_csv(path)
+    # Sort the data by the analysis window start date to maintain temporal order
+    data = data.sort_values(by="analysis_start", kind="stable")
+    return data[FEATURE_COLUMNS], data[TARGET_COLUMN]
+
+
+def fold_bounds(n_rows, n_splits=N_SPLITS):
+    """
+    List the folds of TimeSeriesSplit. On rows in temporal order every fold
+    trains on a prefix of the rows and tests on the block that follows, so a
+    fold is fully described by two positions.
+    :return: List of (train_stop, test_stop) positions: train on [0, train_stop), test on [train_stop, test_stop).
+    """
+    bounds = []
+    for train_index, test_index in TimeSeriesSplit(n_splits=n_splits).split(np.zeros((n_rows, 1))):
+        bounds.append((int(train_index[-1]) + 1, int(test_index[-1]) + 1))
+    return bounds
+
+
+def fold_metrics(y_test, y_pred, y_pred_proba):
+    """
+    :return: Dictionary with the METRICS of the predictions of a fold (roc_auc is NaN
+             when the test fold holds a single class).
+    """
+    metrics = {
+        "accuracy": accuracy_score(y_test, y_pred),
+        "precision": precision_score(y_test, y_pred, zero_division=0),
+        "recall": recall_score(y_test, y_pred, zero_division=0),
+        "f1": f1_score(y_test, y_pred, zero_division=0),
+    }
+    metrics["roc_auc"] = roc_auc_score(y_test, y_pred_proba) if len(np.unique(y_test)) > 1 else np.nan
+    return metrics
+
+
+def share_arrays(arrays):
+    """
+    Copy arrays into shared memory blocks, so worker processes read them
+    without the arrays being pickled to each of them.
+    :param arrays: Dictionary of name -> numpy array.
+    :return: (blocks, specs): the SharedMemory blocks, to close and unlink once
+             done, and the name -> (block name, shape, dtype) specs to attach them.
+    """
+    blocks, specs = [], {}
+    for name, array in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        specs[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, specs
+
+
+def _attach_arrays(specs):
+    # Worker initializer: map the shared arrays once per process
+    for name, (block_name, shape, dtype) in specs.items():
+        # Pool workers share the resource tracker of the parent, which unlinks the blocks
+        block = shared_memory.SharedMemory(name=block_name)
+        _shared[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        _shared[name + "_block"] = block
+
+
+def _fit_fold(candidate, params, fold, train_stop, test_stop):
+    # Fit and evaluate one (candidate, fold) on the shared arrays: the fold matrices are views, not copies
+    X, y = _shared["X"], _shared["y"]
+    model = RandomForestClassifier(random_state=RANDOM_STATE, n_jobs=1, **params)
+    start = time.perf_counter()
+    model.fit(X[:train_stop], y[:train_stop])
+    fit_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    y_pred_proba = model.predict_proba(X[train_stop:test_stop])[:, 1]
+    y_pred = model.classes_[(y_pred_proba > 0.5).astype(int)]
+    predict_seconds = time.perf_counter() - start
+    return dict(candidate=candidate, fold=fold, train_rows=train_stop, test_rows=test_stop - train_stop,
+                fit_seconds=fit_seconds, predict_seconds=predict_seconds, worker=os.getpid(),
+                **fold_metrics(y[train_stop:test_stop], y_pred, y_pred_proba), params=params)
+
+
+def parallel_search(X, y, candidates, n_splits=N_SPLITS, n_workers=None):
+    """
+    Cross-validate hyperparameter candidates over time-series folds, every
+    (candidate, fold) pair being fitted concurrently in a process pool. The
+    features (as float32, what the trees are fitted on) and the target are
+    put once in shared memory and every fold is a slice of them.
+    :param X: Features in temporal order.
+    :param y: Target in temporal order.
+    :param candidates: List of RandomForestClassifier parameter dictionaries.
+    :param n_splits: Number of TimeSeriesSplit folds.
+    :param n_workers: Number of worker processes (default: number of CPUs).
+    :return: DataFrame with one row per (candidate, fold): fit/predict times, metrics and parameters.
+    """
+    blocks, specs = share_arrays({"X": np.ascontiguousarray(X, dtype=np.float32), "y": np.asarray(y)})
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_attach_arrays, initargs=(specs,)) as pool:
+            # The longest fits (most trees, largest folds) are submitted first to keep all workers busy
+            tasks = sorted(((candidate, params, fold, train_stop, test_stop)
+                            for candidate, params in enumerate(candidates)
+                            for fold, (train_stop, test_stop) in enumerate(fold_bounds(len(X), n_splits))),
+                           key=lambda task: -task[1].get("n_estimators", 100) * task[3])
+            rows = []
+            for future in as_completed([pool.submit(_fit_fold, *task) for task in tasks]):
+                rows.append(future.result())
+                row = rows[-1]
+                print(f"  candidate {row['candidate']} fold {row['fold']}: fit {row['fit_seconds']:.2f}s, "
+                      f"predict {row['predict_seconds']:.2f}s, recall {row['recall']:.3f}, "
+                      f"roc_auc {row['roc_auc']:.3f} ({len(rows)}/{len(tasks)})")
+            log = pd.DataFrame(rows)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return log.sort_values(["candidate", "fold"], ignore_index=True)
+
+
+def summarize_search(log, scoring="recall"):
+    """
+    Average the metrics of every candidate over its folds.
+    :param log: DataFrame returned by parallel_search.
+    :param scoring: Metric ranking the candidates.
+    :return: DataFrame with one row per candidate, best first.
+    """
+    summary = log.groupby("candidate").agg(
+        **{metric: (metric, "mean") for metric in METRICS},
+        fit_seconds=("fit_seconds", "sum"), predict_seconds=("predict_seconds", "sum"), params=("params", "first"))
+    return summary.sort_values(scoring, ascending=False, kind="stable")
+
+
+def cross_validate_reference(X, y, params, n_splits=N_SPLITS):
+    """
+    Sequential cross-validation of one candidate, as in model_training.ipynb.
+    :return: DataFrame with the metrics of every fold.
+    """
+    rows = []
+    for train_index, test_index in TimeSeriesSplit(n_splits=n_splits).split(X):
+        X_train, X_test = X.iloc[train_index], X.iloc[test_index]
+        y_train, y_test = y.iloc[train_index], y.iloc[test_index]
+        model = RandomForestClassifier(random_state=RANDOM_STATE, **params)
+        model.fit(X_train, y_train)
+        rows.append(fold_metrics(y_test, model.predict(X_test), model.predict_proba(X_test)[:, 1]))
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time-series cross-validation and hyperparameter search")
+    parser.add_argument("--data", default=None, help="Sliding-window CSV file or Parquet directory")
+    parser.add_argument("--n-iter", type=int, default=20, help="Candidates sampled from PARAM_DISTRIBUTIONS "
+                                                               "(0: only the baseline model)")
+    parser.add_argument("--n-splits", type=int, default=N_SPLITS, help="Time-series folds")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: number of CPUs)")
+    parser.add_argument("--scoring", default="recall", choices=METRICS, help="Metric ranking the candidates")
+    parser.add_argument("--log", default=TRAINING_LOG_PATH, help="CSV file of the per-fold log")
+    parser.add_argument("--save-model", nargs="?", const=MODEL_PATH, default=None,
+                        help=f"Refit the best candidate on all rows and save it (default path: {MODEL_PATH})")
+    parser.add_argument("--check", action="store_true", help="Compare the baseline with the sequential notebook loop")
+    args = parser.parse_args()
+
+    X, y = load_training_data(args.data)
+    candidates = [BASELINE_PARAMS] + list(ParameterSampler(PARAM_DISTRIBUTIONS, args.n_iter,
+                                                           random_state=RANDOM_STATE))
+    print(f"{len(X)} rows, {len(candidates)} candidates x {args.n_splits} folds on {args.workers or os.cpu_count()} "
+          f"workers")
+
+    start = time.perf_counter()
+    log = parallel_search(X, y, candidates, args.n_splits, args.workers)
+    search_seconds = time.perf_counter() - start
+    os.makedirs(os.path.dirname(args.log) or ".", exist_ok=True)
+    log.to_csv(args.log, index=False)
+    summary = summarize_search(log, args.scoring)
+    print(f"Search done in {search_seconds:.1f}s ({log['fit_seconds'].sum() + log['predict_seconds'].sum():.1f}s "
+          f"of fit/predict), per-fold log saved to {args.log}")
+    with pd.option_context("display.width", 160, "display.max_columns", None, "display.max_colwidth", 80):
+        print(summary.head(10).round(3))
+
+    if args.check:
+        # The parallel folds give the same metrics as the sequential loop of the notebook
+        start = time.perf_counter()
+        expected = cross_validate_reference(X, y, BASELINE_PARAMS, args.n_splits)
+        sequential_seconds = time.perf_counter() - start
+        pd.testing.assert_frame_equal(log.loc[log["candidate"] == 0, METRICS].reset_index(drop=True), expected)
+        print(f"Identical baseline metrics, sequential loop {sequential_seconds:.1f}s")
+
+    if args.save_model:
+        best_params = summary["params"].iloc[0]
+        final_model = RandomForestClassifier(random_state=RANDOM_STATE, **best_params).fit(X, y)
+        os.makedirs(os.path.dirname(args.save_model) or ".", exist_ok=True)
+        joblib.dump(final_model, args.save_model)
+        print(f"Final model {best_params} saved to {args.save_model}")
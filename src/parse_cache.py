@@ -0,0 +1,173 @@
+import hashlib
+import json
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from urllib.parse import urlparse
+
+import pandas as pd
+
+from letter_downloader import MANIFEST_FN, load_manifest
+from letter_parsing import PARSE_CHUNK_SIZE, parse_letter_file
+from sqlite_helpers import parameter_batches
+
+# Default location of the cache database
+PARSE_CACHE_PATH = "../data/warning_letters/parse_cache.db"
+
+# Bump when the extraction changes, so cached results of the former extraction are parsed again
+PARSER_VERSION = 1
+
+KEY_COLUMN = "letter_key"
+
+
+def letter_key(url):
+    """
+    Stable key of a letter: the last segment of its URL (the FDA slug ends with
+    the letter number and date), or a hash of the URL if it has no path.
+    :param url: URL of the letter.
+    :return: Key string.
+    """
+    slug = urlparse(url).path.rstrip("/").rsplit("/", 1)[-1]
+    return slug or hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+
+def letter_filename(url):
+    """
+    :return: File name of a downloaded letter, derived from its stable key.
+    """
+    return f"warning_letter_{letter_key(url)}.html"
+
+
+def letter_path(url, download_dir, manifest=None, legacy_index=None):
+    """
+    Find the downloaded file of a letter: the file recorded for the URL in the
+    download manifest, else the file named after its key, else the former
+    positional name warning_letter_<index + 1>.html.
+    :param url: URL of the letter.
+    :param download_dir: Download directory.
+    :param manifest: Download manifest (see letter_downloader.load_manifest).
+    :param legacy_index: Row index of the letter in the table, for files downloaded before keys.
+    :return: Path of the file (may not exist).
+    """
+    entry = (manifest or {}).get(url)
+    if entry and entry.get("filename"):
+        return os.path.join(download_dir, entry["filename"])
+    path = os.path.join(download_dir, letter_filename(url))
+    if not os.path.exists(path) and legacy_index is not None:
+        legacy_path = os.path.join(download_dir, f"warning_letter_{legacy_index + 1}.html")
+        if os.path.exists(legacy_path):
+            return legacy_path
+    return path
+
+
+def open_parse_cache(path=PARSE_CACHE_PATH):
+    """
+    Open (or create) the SQLite database holding the parsed letters.
+    :param path: Path of the database file.
+    :return: sqlite3 connection.
+    """
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS parsed_letters (
+        letter_key TEXT PRIMARY KEY,
+        content_hash TEXT NOT NULL,
+        parser_version INTEGER NOT NULL,
+        metadata TEXT NOT NULL,
+        updated_at TEXT
+    )
+    """)
+    conn.commit()
+    return conn
+
+
+def content_hash(path):
+    """
+    :return: sha256 hex digest of a file, None if it does not exist.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def lookup_parsed(conn, keys):
+    """
+    Fetch the cached results of some letters.
+    :param conn: Connection returned by open_parse_cache.
+    :param keys: List of letter keys.
+    :return: Dictionary of letter key to (content_hash, metadata dictionary), for the current PARSER_VERSION.
+    """
+    cached = {}
+    unique_keys = list(set(keys))
+    for batch in parameter_batches(unique_keys):
+        cursor = conn.execute(
+            "SELECT letter_key, content_hash, metadata FROM parsed_letters "
+            f"WHERE parser_version = ? AND letter_key IN ({','.join('?' * len(batch))})", [PARSER_VERSION] + batch)
+        for key, stored_hash, metadata in cursor:
+            cached[key] = (stored_hash, json.loads(metadata))
+    return cached
+
+
+def store_parsed(conn, results):
+    """
+    Insert or replace parsed letters.
+    :param conn: Connection returned by open_parse_cache.
+    :param results: List of (letter_key, content_hash, metadata dictionary) tuples.
+    """
+    updated_at = datetime.now().isoformat(timespec="seconds")
+    conn.executemany(
+        "INSERT OR REPLACE INTO parsed_letters (letter_key, content_hash, parser_version, metadata, updated_at) "
+        "VALUES (?, ?, ?, ?, ?)",
+        [(key, digest, PARSER_VERSION, json.dumps(metadata), updated_at) for key, digest, metadata in results])
+    conn.commit()
+
+
+def parse_letters_cached(letters, conn, workers=None, chunk_size=PARSE_CHUNK_SIZE):
+    """
+    Parse letters chunk by chunk, skipping the letters whose file content did
+    not change since it was cached under the same key.
+    :param letters: List of (letter_key, path) tuples.
+    :param conn: Connection returned by open_parse_cache.
+    :param workers: Number of worker processes for the letters to parse.
+    :param chunk_size: Number of letters per chunk.
+    :return: Iterator of (metadata DataFrame with a letter_key column, number of letters parsed) per chunk.
+    """
+    executor = None
+    try:
+        for start in range(0, len(letters), chunk_size):
+            chunk = letters[start:start + chunk_size]
+            cached = lookup_parsed(conn, [key for key, _ in chunk])
+            metadata = {}
+            to_parse = []
+            for key, path in chunk:
+                digest = content_hash(path)
+                if digest is not None and key in cached and cached[key][0] == digest:
+                    metadata[key] = cached[key][1]
+                else:
+                    to_parse.append((key, path, digest))
+
+            if to_parse:
+                # The pool is only started once a letter has to be parsed
+                executor = executor or ProcessPoolExecutor(workers)
+                parsed = executor.map(parse_letter_file, [path for _, path, _ in to_parse])
+                for (key, _, _), letter_metadata in zip(to_parse, parsed):
+                    metadata[key] = letter_metadata
+                # Missing or unreadable files are not cached, they are parsed again on the next run
+                store_parsed(conn, [(key, digest, metadata[key]) for key, _, digest in to_parse
+                                    if digest is not None and "Company Info" in metadata[key]])
+
+            metadata_df = pd.DataFrame([metadata[key] for key, _ in chunk])
+            metadata_df.insert(0, KEY_COLUMN, [key for key, _ in chunk])
+            yield metadata_df, len(to_parse)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def load_download_manifest(download_dir):
+    """
+    :return: Download manifest of a directory (empty if none).
+    """
+    return load_manifest(os.path.join(download_dir, MANIFEST_FN))
@@ -0,0 +1,194 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+HISTORICAL_RECORDS_CSV = "../data/historical_ds/historical_records_data_with_dates.csv"
+SLIDING_WINDOW_CSV = "../data/historical_ds/sliding_window_supplier_data_with_target.csv"
+
+# Supplier ids are interned: stored as integer codes into the sorted list of ids
+ID_COLUMN = "supplier_id"
+
+# Categorical columns of the historical records, with their fixed category order
+RECORD_CATEGORIES = {
+    "severity_level": ["Minor", "Moderate", "Critical"],
+    "category_of_violation": ["Safety", "Quality", "Documentation", "Regulatory"],
+    "root_cause_category": ["Human Error", "Process Failure", "Equipment Malfunction"],
+    "affected_product": ["Product A", "Product B", "Product C", "Product D"],
+    "process_involved": ["Packaging", "Testing", "Shipping", "Manufacturing"],
+    "tone_of_letter": ["Formal", "Urgent", "Warning"],
+    "resolution_status": ["Resolved", "Pending", "Unresolved"],
+}
+
+# Integer columns of the historical records and their dtype
+RECORD_INTEGERS = {
+    "corrective_actions_suggested": "int8",
+    "length_of_letter": "int16",
+    "deadline_for_resolution": "int16",
+    "follow_up_actions": "int8",
+    "ncr_or_warning_letter": "int8",
+}
+RECORD_DATES = ["record_date"]
+
+# Sliding-window dataset: the counts are int16, the target int8, the means stay float64
+WINDOW_COUNT_DTYPE = "int16"
+WINDOW_INTEGERS = {"ncr_or_warning_letter": "int8"}
+WINDOW_DATES = ["analysis_start", "analysis_end", "prediction_start", "prediction_end"]
+
+
+def _small_integers(values, dtype):
+    # Cast to the schema dtype, or to the smallest integer dtype holding the values if they do not fit
+    if values.isna().any():
+        return values
+    info = np.iinfo(dtype)
+    if len(values) and (values.min() < info.min or values.max() > info.max):
+        warnings.warn(f"{values.name} does not fit in {dtype}, downcasting to the smallest integer dtype instead")
+        return pd.to_numeric(values, downcast="integer")
+    return values.astype(dtype)
+
+
+def _fixed_categories(values, categories):
+    # Values outside the schema are kept, as extra categories after the fixed ones
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        present = list(values.cat.categories)
+    else:
+        present = pd.unique(values.dropna()).tolist()
+    extra = sorted(value for value in present if value not in categories)
+    return pd.Categorical(values, categories=list(categories) + extra)
+
+
+def intern_ids(values):
+    """
+    Intern supplier ids: a categorical whose categories are the sorted unique
+    ids, so each row only holds an integer code and grouping or sorting by
+    the column gives the same order as the strings.
+    :param values: Series of ids.
+    :return: Categorical Series.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.cat.remove_unused_categories()
+        return values.cat.set_categories(values.cat.categories.sort_values())
+    return values.astype(pd.CategoricalDtype(sorted(pd.unique(values.dropna()))))
+
+
+def apply_record_schema(df):
+    """
+    Give the historical records their compact dtypes: interned supplier ids,
+    categoricals with the fixed category order of RECORD_CATEGORIES, int8/int16
+    integers and parsed dates. Columns missing from df are skipped.
+    :param df: DataFrame with historical records.
+    :return: Typed copy of the DataFrame.
+    """
+    df = df.copy()
+    if ID_COLUMN in df.columns:
+        df[ID_COLUMN] = intern_ids(df[ID_COLUMN])
+    for column, categories in RECORD_CATEGORIES.items():
+        if column in df.columns:
+            df[column] = _fixed_categories(df[column], categories)
+    for column, dtype in RECORD_INTEGERS.items():
+        if column in df.columns:
+            df[column] = _small_integers(df[column], dtype)
+    for column in RECORD_DATES:
+        if column in df.columns:
+            df[column] = pd.to_datetime(df[column])
+    return df
+
+
+def apply_window_schema(df, parse_dates=True):
+    """
+    Give the sliding-window dataset its compact dtypes: interned supplier ids,
+    int16 counts, int8 target and parsed window dates. Columns missing from
+    df are skipped.
+    :param df: DataFrame with sliding-window rows (or feature rows to score).
+    :param parse_dates: Parse the window dates (off to pass them through as read).
+    :return: Typed copy of the DataFrame.
+    """
+    df = df.copy()
+    if ID_COLUMN in df.columns:
+        df[ID_COLUMN] = intern_ids(df[ID_COLUMN])
+    for column in df.columns:
+        if column in WINDOW_INTEGERS:
+            df[column] = _small_integers(df[column], WINDOW_INTEGERS[column])
+        elif pd.api.types.is_integer_dtype(df[column].dtype):
+            df[column] = _small_integers(df[column], WINDOW_COUNT_DTYPE)
+    for column in WINDOW_DATES:
+        if column in df.columns and parse_dates:
+            df[column] = pd.to_datetime(df[column])
+    return df
+
+
+def read_historical_csv(path=HISTORICAL_RECORDS_CSV, **kwargs):
+    """
+    Read historical records from CSV straight into the compact dtypes (the
+    string columns are never materialized as Python strings).
+    :param path: CSV file.
+    :param kwargs: Other read_csv arguments (chunksize is not supported).
+    :return: Typed DataFrame.
+    """
+    dtypes = {column: "category" for column in [ID_COLUMN] + list(RECORD_CATEGORIES)}
+    return apply_record_schema(pd.read_csv(path, dtype=dtypes, **kwargs))
+
+
+def read_sliding_window_csv(path=SLIDING_WINDOW_CSV, **kwargs):
+    """
+    Read the sliding-window dataset from CSV with the compact dtypes.
+    :param path: CSV file.
+    :return: Typed DataFrame.
+    """
+    return apply_window_schema(pd.read_csv(path, dtype={ID_COLUMN: "category"}, **kwargs))
+
+
+def memory_report(frames):
+    """
+    Compare the memory footprint of several versions of a table.
+    :param frames: Dictionary of label -> DataFrame, the first one being the baseline.
+    :return: DataFrame of bytes per column (deep) for each version, with a total
+             row and the reduction factor of each version over the baseline.
+    """
+    report = pd.DataFrame({label: df.memory_usage(index=False, deep=True) for label, df in frames.items()})
+    report.loc["total"] = report.sum()
+    baseline = report.columns[0]
+    for label in report.columns[1:]:
+        report[f"{label} reduction"] = report[baseline] / report[label]
+    return report
+
+
+if __name__ == "__main__":
+    # Memory of the stored history and of a large mock history, default read_csv dtypes vs the schema
+    from mock_history_generator import records_per_supplier_counts, write_mock_history
+
+    parser = argparse.ArgumentParser(description="Report the memory saved by the typed schema")
+    parser.add_argument("--records", type=int, default=3_000_000, help="Records of the mock history")
+    args = parser.parse_args()
+
+    pd.set_option("display.width", 160)
+    pd.set_option("display.max_columns", None)
+    pd.set_option("display.float_format", "{:,.1f}".format)
+    folder = tempfile.mkdtemp()
+    try:
+        rng = np.random.default_rng(42)
+        mock_path = os.path.join(folder, "mock_history.csv")
+        n_suppliers = max(1, args.records // 27)
+        counts = records_per_supplier_counts(n_suppliers, rng, n_records=args.records)
+        write_mock_history(mock_path, n_suppliers, counts, rng)
+        for label, path in [("stored history", HISTORICAL_RECORDS_CSV), ("mock history", mock_path)]:
+            default = pd.read_csv(path)
+            start = time.perf_counter()
+            typed = read_historical_csv(path)
+            seconds = time.perf_counter() - start
+            # Reading straight into the schema gives the same frame as converting a default read
+            pd.testing.assert_frame_equal(typed, apply_record_schema(default))
+            object_strings = default.astype({column: object for column in default.columns
+                                             if not pd.api.types.is_numeric_dtype(default[column].dtype)})
+            report = memory_report({"object strings": object_strings, "read_csv": default, "schema": typed})
+            print(f"\n{label}: {len(typed)} records, typed read in {seconds:.1f}s, bytes per column:")
+            print(report)
+            reduction = report.loc["total", "read_csv"] / report.loc["total", "schema"]
+            print(f"  schema vs read_csv defaults: {reduction:.1f}x")
+    finally:
+        shutil.rmtree(folder)
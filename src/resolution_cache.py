@@ -0,0 +1,107 @@
+import hashlib
+import sqlite3
+from datetime import datetime
+
+from similarity_engine import FIELD_WEIGHTS
+from sqlite_helpers import parameter_batches
+
+# Default location of the cache database
+RESOLUTION_CACHE_PATH = "../data/resolution_cache.db"
+
+# company_id stored for a record that matched none of its candidate companies
+NO_MATCH = ""
+
+
+def open_resolution_cache(path=RESOLUTION_CACHE_PATH):
+    """
+    Open (or create) the SQLite database holding the match decisions.
+    :param path: Path of the database file.
+    :return: sqlite3 connection.
+    """
+    conn = sqlite3.connect(path, timeout=30)
+    # WAL lets the workers of a parallel run read while another one writes
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS match_decisions (
+        record_hash TEXT PRIMARY KEY,
+        block_hash TEXT NOT NULL,
+        company_id TEXT NOT NULL,
+        score REAL,
+        updated_at TEXT
+    )
+    """)
+    conn.commit()
+    return conn
+
+
+def _hash(values):
+    return hashlib.sha256("\x1f".join(values).encode("utf-8")).hexdigest()
+
+
+def record_hashes(block):
+    """
+    Hash every record of a normalized block.
+    :param block: Normalized block, see similarity_engine.normalize_block.
+    :return: List of hex digests, one per record.
+    """
+    return [_hash(values) for values in zip(*(block[field] for field in FIELD_WEIGHTS))]
+
+
+def block_hash(company_hashes, positions, threshold):
+    """
+    Hash the candidate companies of a record. The decision of a previous run
+    is only valid while this hash does not change.
+    :param company_hashes: Hash of the candidate companies by row position (see company_hashes).
+    :param positions: Candidate row positions of the record.
+    :param threshold: Similarity threshold of the run.
+    :return: Hex digest.
+    """
+    return _hash([str(threshold)] + [company_hashes[position] for position in positions])
+
+
+def company_hashes(registry, positions):
+    """
+    Hash some companies of a registry, company_id included. Only the
+    candidates of the records being resolved are hashed, so the cost follows
+    the size of the delta, not the size of the registry.
+    :param registry: CompanyRegistry.
+    :param positions: Row positions of the companies to hash.
+    :return: Dictionary of row position to hex digest.
+    """
+    positions = sorted(positions)
+    block = registry.normalized_block(positions)
+    return {position: _hash([str(registry.company_id(position)), *values])
+            for position, *values in zip(positions, *(block[field] for field in FIELD_WEIGHTS))}
+
+
+def lookup_decisions(conn, hashes):
+    """
+    Fetch the stored decisions of some records.
+    :param conn: Connection returned by open_resolution_cache.
+    :param hashes: List of record hashes.
+    :return: Dictionary of record hash to (block_hash, company_id, score).
+    """
+    decisions = {}
+    unique_hashes = list(set(hashes))
+    for batch in parameter_batches(unique_hashes):
+        cursor = conn.execute(
+            "SELECT record_hash, block_hash, company_id, score FROM match_decisions "
+            f"WHERE record_hash IN ({','.join('?' * len(batch))})", batch)
+        for record_hash, stored_block_hash, company_id, score in cursor:
+            decisions[record_hash] = (stored_block_hash, company_id, score)
+    return decisions
+
+
+def store_decisions(conn, decisions):
+    """
+    Insert or replace match decisions.
+    :param conn: Connection returned by open_resolution_cache.
+    :param decisions: List of (record_hash, block_hash, company_id, score) tuples, company_id
+                      being NO_MATCH for a record that matched none of its candidates.
+    """
+    updated_at = datetime.now().isoformat(timespec="seconds")
+    conn.executemany(
+        "INSERT OR REPLACE INTO match_decisions (record_hash, block_hash, company_id, score, updated_at) "
+        "VALUES (?, ?, ?, ?, ?)",
+        [(*decision, updated_at) for decision in decisions])
+    conn.commit()
@@ -0,0 +1,371 @@
+import argparse
+import io
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import joblib
+import numpy as np
+import pandas as pd
+import requests
+
+from feature_aggregation import FEATURE_COLUMNS
+from record_schema import SLIDING_WINDOW_CSV, apply_window_schema
+
+MODEL_PATH = "../models/supplier_warning_model.pkl"
+COMPRESSED_MODEL_PATH = "../models/supplier_warning_model_compressed.joblib"
+
+# Columns copied from the input rows to the scores when present
+ID_COLUMNS = ["supplier_id", "analysis_start"]
+
+# Upper bounds of the Low and Medium risk bands
+RISK_BANDS = [(0.3, "Low Risk"), (0.7, "Medium Risk")]
+
+# Micro-batching of concurrent requests
+MAX_BATCH_ROWS = 4096
+MAX_WAIT_SECONDS = 0.005
+
+DEFAULT_PORT = 8765
+
+
+def risk_bands(probabilities):
+    """
+    Categorize risk levels by the RISK_BANDS thresholds.
+    :param probabilities: Array of risk probabilities.
+    :return: Array with the risk band of every probability.
+    """
+    probabilities = np.asarray(probabilities)
+    return np.select([probabilities < bound for bound, _ in RISK_BANDS], [band for _, band in RISK_BANDS],
+                     default="High Risk")
+
+
+# Categorize the risk level of a single probability
+def categorize_risk(prob):
+    return str(risk_bands([prob])[0])
+
+
+def load_model(path=MODEL_PATH):
+    """
+    Load the fitted model, either the pickle of the training notebook or the
+    compressed pickle written by export_compressed_model.
+    :param path: Path of the model file.
+    :return: Fitted model.
+    """
+    return joblib.load(path)
+
+
+def export_compressed_model(model, path=COMPRESSED_MODEL_PATH, compress=3):
+    """
+    Write the model as a zlib-compressed joblib pickle. The model itself is
+    unchanged (same trees, same predictions); the file is smaller than the
+    plain pickle and is loaded with the same load_model.
+    :param model: Fitted model.
+    :param path: Output path.
+    :param compress: joblib compression level.
+    :return: Size of the artifact in bytes.
+    """
+    joblib.dump(model, path, compress=compress)
+    return os.path.getsize(path)
+
+
+def read_feature_rows(source, data_format=None):
+    """
+    Read a batch of feature rows, with the compact dtypes of the sliding-window
+    schema (the ID columns are passed through as read).
+    :param source: Path of a file, or the raw bytes of a request body.
+    :param data_format: "csv", "parquet" or "json" (default: from the file extension).
+    :return: DataFrame.
+    """
+    if data_format is None:
+        data_format = os.path.splitext(source)[1].lstrip(".").lower()
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    if data_format == "csv":
+        rows = pd.read_csv(source)
+    elif data_format == "parquet":
+        rows = pd.read_parquet(source)
+    elif data_format == "json":
+        # Either a list of records or a {"rows": [...]} object
+        if hasattr(source, "read"):
+            payload = json.load(source)
+        else:
+            with open(source) as f:
+                payload = json.load(f)
+        rows = pd.DataFrame(payload["rows"] if isinstance(payload, dict) else payload)
+    else:
+        raise ValueError(f"Unsupported format: {data_format}")
+    return apply_window_schema(rows, parse_dates=False)
+
+
+def feature_matrix(rows):
+    """
+    Select the model features of a batch of rows, in training order, as
+    float64. Rows are validated here, so a bad request is rejected on its own
+    instead of failing the micro-batch it would be scored in.
+    :param rows: DataFrame with at least the FEATURE_COLUMNS.
+    :return: DataFrame with the FEATURE_COLUMNS.
+    """
+    missing = [column for column in FEATURE_COLUMNS if column not in rows.columns]
+    if missing:
+        raise ValueError(f"Missing feature columns: {missing}")
+    features = {}
+    for column in FEATURE_COLUMNS:
+        try:
+            features[column] = pd.to_numeric(rows[column]).astype(np.float64)
+        except (ValueError, TypeError):
+            raise ValueError(f"Non-numeric values in feature column {column}")
+        if np.isinf(features[column].to_numpy()).any():
+            raise ValueError(f"Infinite values in feature column {column}")
+    return pd.DataFrame(features, index=rows.index)
+
+
+def score_rows(model, rows):
+    """
+    Score a batch of rows with a single predict_proba call.
+    :param model: Fitted model.
+    :param rows: DataFrame with the FEATURE_COLUMNS (and optionally ID_COLUMNS).
+    :return: DataFrame with the ID_COLUMNS present, risk_probability and risk_category.
+    """
+    probabilities = model.predict_proba(feature_matrix(rows))[:, 1]
+    scores = rows[[column for column in ID_COLUMNS if column in rows.columns]].copy()
+    scores["risk_probability"] = probabilities
+    scores["risk_category"] = risk_bands(probabilities)
+    return scores.reset_index(drop=True)
+
+
+class MicroBatcher:
+    """
+    Merge the rows of concurrent requests into single predict_proba calls.
+    A worker thread takes the pending requests, up to max_batch_rows rows or
+    max_wait seconds after the first one, scores them together and hands
+    every request its slice of the probabilities.
+    """
+
+    def __init__(self, model, max_batch_rows=MAX_BATCH_ROWS, max_wait=MAX_WAIT_SECONDS):
+        self.model = model
+        self.max_batch_rows = max_batch_rows
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.batch_sizes = []
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, features):
+        """
+        Queue a feature matrix for scoring.
+        :param features: DataFrame with the FEATURE_COLUMNS.
+        :return: Future with the array of risk probabilities.
+        """
+        future = Future()
+        self.requests.put((features, future))
+        return future
+
+    def predict(self, features):
+        return self.submit(features).result()
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            n_rows = len(batch[0][0])
+            deadline = time.perf_counter() + self.max_wait
+            while n_rows < self.max_batch_rows:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                n_rows += len(batch[-1][0])
+            try:
+                probabilities = self.model.predict_proba(pd.concat([features for features, _ in batch]))[:, 1]
+            except Exception:
+                # Score the requests one by one, so only the request causing the error fails
+                for features, future in batch:
+                    try:
+                        future.set_result(self.model.predict_proba(features)[:, 1])
+                    except Exception as e:
+                        future.set_exception(e)
+                continue
+            self.batch_sizes.append(n_rows)
+            offsets = np.cumsum([0] + [len(features) for features, _ in batch])
+            for (_, future), start, stop in zip(batch, offsets[:-1], offsets[1:]):
+                future.set_result(probabilities[start:stop])
+
+
+# Request body format from the Content-Type header
+CONTENT_FORMATS = {"text/csv": "csv", "application/json": "json", "application/vnd.apache.parquet": "parquet",
+                   "application/octet-stream": "parquet"}
+
+
+def make_handler(batcher):
+    """
+    Build the HTTP handler of the scoring endpoint:
+    POST /score with a CSV, JSON or Parquet body returns the scores as JSON records,
+    GET /health returns the status and the micro-batching statistics.
+    """
+
+    class ScoringHandler(BaseHTTPRequestHandler):
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != "/health":
+                self._send_json(404, {"error": "Not found"})
+                return
+            sizes = batcher.batch_sizes
+            self._send_json(200, {"status": "ok", "batches": len(sizes),
+                                  "mean_batch_rows": float(np.mean(sizes)) if sizes else 0.0})
+
+        def do_POST(self):
+            if self.path != "/score":
+                self._send_json(404, {"error": "Not found"})
+                return
+            content_type = self.headers.get("Content-Type", "application/json").split(";")[0].strip()
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                rows = read_feature_rows(body, CONTENT_FORMATS.get(content_type, "json"))
+                probabilities = batcher.predict(feature_matrix(rows))
+            except Exception as e:
+                self._send_json(400, {"error": str(e)})
+                return
+            scores = rows[[column for column in ID_COLUMNS if column in rows.columns]].astype(str)
+            scores["risk_probability"] = probabilities
+            scores["risk_category"] = risk_bands(probabilities)
+            self._send_json(200, {"scores": scores.to_dict(orient="records")})
+
+        def log_message(self, format, *args):
+            # Keep the console quiet under load
+            pass
+
+    return ScoringHandler
+
+
+def start_server(model, port=DEFAULT_PORT, host="127.0.0.1", max_batch_rows=MAX_BATCH_ROWS,
+                 max_wait=MAX_WAIT_SECONDS):
+    """
+    Start the scoring endpoint in a background thread.
+    :return: (server, batcher); call server.shutdown() to stop it.
+    """
+    batcher = MicroBatcher(model, max_batch_rows, max_wait)
+    server = ThreadingHTTPServer((host, port), make_handler(batcher))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, batcher
+
+
+def _latency_summary(latencies, n_rows, seconds):
+    latencies = np.asarray(latencies) * 1e3
+    return (f"{n_rows / seconds:,.0f} rows/s, p50 {np.percentile(latencies, 50):.1f}ms, "
+            f"p99 {np.percentile(latencies, 99):.1f}ms")
+
+
+def benchmark_scoring(model, data, request_rows=(1, 100), clients=8, n_requests=400, port=DEFAULT_PORT):
+    """
+    Measure the throughput and latency of the scoring paths on a dataset:
+    a single batch score_rows call, then concurrent HTTP clients sending
+    small requests micro-batched by the endpoint.
+    :param model: Fitted model.
+    :param data: DataFrame with the FEATURE_COLUMNS (e.g. the sliding-window dataset).
+    :param request_rows: Numbers of rows per HTTP request to try.
+    :param clients: Number of concurrent clients.
+    :param n_requests: Number of requests per configuration.
+    :param port: Port of the local endpoint.
+    """
+    start = time.perf_counter()
+    score_rows(model, data)
+    seconds = time.perf_counter() - start
+    print(f"Batch score_rows: {len(data)} rows in {seconds:.3f}s ({len(data) / seconds:,.0f} rows/s)")
+
+    server, batcher = start_server(model, port)
+    url = f"http://127.0.0.1:{port}/score"
+    # One pooled session per client thread
+    sessions = threading.local()
+    try:
+        for rows_per_request in request_rows:
+            rng = np.random.default_rng(42)
+            bodies = [data.iloc[rng.integers(0, len(data), rows_per_request)].to_csv(index=False).encode("utf-8")
+                      for _ in range(n_requests)]
+
+            def send(body):
+                if not hasattr(sessions, "session"):
+                    sessions.session = requests.Session()
+                sent = time.perf_counter()
+                response = sessions.session.post(url, data=body, headers={"Content-Type": "text/csv"})
+                response.raise_for_status()
+                return time.perf_counter() - sent
+
+            batcher.batch_sizes.clear()
+            start = time.perf_counter()
+            with ThreadPoolExecutor(clients) as executor:
+                latencies = list(executor.map(send, bodies))
+            seconds = time.perf_counter() - start
+            print(f"HTTP, {clients} clients x {rows_per_request} rows/request: "
+                  f"{_latency_summary(latencies, n_requests * rows_per_request, seconds)}, "
+                  f"{np.mean(batcher.batch_sizes):.1f} rows per predict_proba call")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score supplier feature rows with the risk model")
+    parser.add_argument("--model", default=MODEL_PATH, help="Path of the fitted model")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    score_parser = commands.add_parser("score", help="Score a CSV, Parquet or JSON file")
+    score_parser.add_argument("input", help="Input file with the feature rows")
+    score_parser.add_argument("--output", default=None, help="Output CSV file (default: print)")
+
+    serve_parser = commands.add_parser("serve", help="Start the local HTTP endpoint")
+    serve_parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port to listen on")
+    serve_parser.add_argument("--max-batch-rows", type=int, default=MAX_BATCH_ROWS,
+                              help="Maximum rows per predict_proba call")
+    serve_parser.add_argument("--max-wait-ms", type=float, default=MAX_WAIT_SECONDS * 1e3,
+                              help="Time waited for more requests before scoring a batch")
+
+    benchmark_parser = commands.add_parser("benchmark", help="Throughput and latency on the sliding-window dataset")
+    benchmark_parser.add_argument("--data", default=SLIDING_WINDOW_CSV, help="Sliding-window CSV file")
+    benchmark_parser.add_argument("--clients", type=int, default=8, help="Concurrent HTTP clients")
+    benchmark_parser.add_argument("--requests", type=int, default=400, help="Requests per configuration")
+    benchmark_parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port of the local endpoint")
+
+    export_parser = commands.add_parser("export", help="Write the model as a compressed pickle")
+    export_parser.add_argument("--output", default=COMPRESSED_MODEL_PATH, help="Output path")
+    args = parser.parse_args()
+
+    # The model is loaded once for the whole command
+    start = time.perf_counter()
+    model = load_model(args.model)
+    print(f"Model loaded in {time.perf_counter() - start:.2f}s")
+
+    if args.command == "score":
+        scores = score_rows(model, read_feature_rows(args.input))
+        if args.output:
+            scores.to_csv(args.output, index=False)
+            print(f"{len(scores)} rows scored to {args.output}")
+        else:
+            print(scores.to_string(index=False))
+    elif args.command == "serve":
+        server, _ = start_server(model, args.port, max_batch_rows=args.max_batch_rows,
+                                 max_wait=args.max_wait_ms / 1e3)
+        print(f"Scoring endpoint on http://127.0.0.1:{args.port}/score (Ctrl+C to stop)")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+    elif args.command == "benchmark":
+        benchmark_scoring(model, pd.read_csv(args.data), clients=args.clients, n_requests=args.requests,
+                          port=args.port)
+    elif args.command == "export":
+        size = export_compressed_model(model, args.output)
+        print(f"Compressed model written to {args.output} ({size / 1e6:.1f} MB, "
+              f"plain pickle {os.path.getsize(args.model) / 1e6:.1f} MB)")
@@ -1,14 +1,76 @@
+import argparse
+import csv
+import html
 import os
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import chain
+from urllib.parse import parse_qs
 
 import requests
 from bs4 import BeautifulSoup
 import pandas as pd
+from lxml import etree
 from pandas.core.interchange.dataframe_protocol import DataFrame
 
+from change_detection import SNAPSHOT_PATH, commit_snapshot, diff_snapshot, open_snapshot_store, write_changes
+
 EUDRA_GMDP_NCR = "https://eudragmdp.ema.europa.eu/inspections/gmpc/searchGMPNonCompliance.do"
 DOWNLOAD_DIR = "data/NCR"
 MOCK_HTML_PATH = "data/mock/EUDRA_NCR.html"
 
+# Snapshot of the reports, to find the reports added, changed or removed since the last scraping
+NCR_SNAPSHOT_SOURCE = "eudra_ncr"
+
+# PrimeFaces ids of the search form and of its results data table
+FORM_ID = "gdpDraftForm"
+RESULTS_TABLE_ID = "gdpDraftForm:resultsDataTable"
+VIEW_STATE_NAME = "javax.faces.ViewState"
+
+# Rows requested per result page, and bytes read at a time from a page
+PAGE_ROWS = 100
+STREAM_CHUNK_BYTES = 64 * 1024
+
+
+def parse_results_table(html_content):
+    """
+    Parse the results table of a whole page with BeautifulSoup.
+    :param html_content: HTML of a results page.
+    :return: DataFrame with the rows of the table (empty without the results div), None if the div has no table.
+    """
+    # Parse the HTML content using BeautifulSoup
+    soup = BeautifulSoup(html_content, 'html.parser')
+
+    # Find the containing div
+    div = soup.find("div", {"id": RESULTS_TABLE_ID, "class": "ui-datatable ui-widget stable"})
+    if not div:
+        return pd.DataFrame()
+
+    # Locate the table inside the div
+    table = div.find("table")
+
+    # Find the table using the correct ID and class
+    #table = soup.find("table", {"id": "gdpDraftForm:resultsDataTable", "class": "ui-datatable ui-widget stable"})
+
+    if not table:
+        print("No table found on the webpage.")
+        return None
+
+    data = []
+    # Extract headers
+    headers = [th.get_text(strip=True) for th in table.find_all("th")]
+
+    for row in table.find_all("tr")[1:]:  # Skip the header row
+        cols = row.find_all("td")
+        data.append([col.get_text(strip=True) for col in cols])
+
+    # Convert to DataFrame
+    return pd.DataFrame(data, columns=headers)
+
+
 def scrape_eudra_non_compliance_reports(source='request'):
     """
     Scrape non-compliance reports from the Eudra GMDP database.
@@ -30,47 +92,332 @@ def scrape_eudra_non_compliance_reports(source='request'):
         with open('../' + MOCK_HTML_PATH, 'r', encoding='utf-8') as file:
             html_content = file.read()
 
-    # Parse the HTML content using BeautifulSoup
-    soup = BeautifulSoup(html_content, 'html.parser')
+    df = parse_results_table(html_content)
+    if df is not None and len(df.columns):
+        # Save the data to a CSV file
+        df.to_csv('..' + os.sep + DOWNLOAD_DIR + os.sep + "eudra_non_compliance_reports.csv", index=False)
+        print("Non-compliance reports saved to eudra_non_compliance_reports.csv")
 
-    # Find the containing div
-    div = soup.find("div", {"id": "gdpDraftForm:resultsDataTable", "class": "ui-datatable ui-widget stable"})
+    return df
 
-    if div:
-        # Locate the table inside the div
-        table = div.find("table")
 
-    # Find the table using the correct ID and class
-    #table = soup.find("table", {"id": "gdpDraftForm:resultsDataTable", "class": "ui-datatable ui-widget stable"})
+def _cell_text(cell):
+    # Same text as BeautifulSoup's get_text(strip=True): every string stripped, comments skipped
+    return "".join(text.strip() for text in cell.itertext())
 
-        if not table:
-            print("No table found on the webpage.")
-            return None
 
-        data = []
-        # Extract headers
-        headers = [th.get_text(strip=True) for th in table.find_all("th")]
+def iter_table_rows(chunks, page_state=None, fragment=False, table_id=RESULTS_TABLE_ID):
+    """
+    Parse the results table of a page incrementally: the HTML is fed to a
+    pull parser chunk by chunk and every row is yielded, then freed, as soon
+    as its closing tag is read, so the page is never held as a whole tree.
+    :param chunks: Iterable of HTML bytes (or str) chunks.
+    :param page_state: Optional dictionary receiving the JSF view state of the page ("view_state").
+    :param fragment: The chunks are the rows of the table only, as in a PrimeFaces partial response.
+    :param table_id: Id of the element holding the table.
+    :return: Iterator of (is_header, list of cell texts).
+    """
+    parser = etree.HTMLPullParser(events=("start", "end"))
+    depth = 0
+    if fragment:
+        parser.feed(f'<div id="{table_id}"><table><tbody>')
+    # None closes the parser, which flushes the elements left open
+    for chunk in chain(chunks, [None]):
+        if chunk is None:
+            parser.close()
+        else:
+            parser.feed(chunk)
+        for event, element in parser.read_events():
+            if event == "start":
+                if element.get("id") == table_id:
+                    depth += 1
+                continue
+            if element.get("id") == table_id:
+                depth -= 1
+            elif element.tag == "input" and element.get("name") == VIEW_STATE_NAME and page_state is not None:
+                page_state["view_state"] = element.get("value")
+            elif element.tag == "tr" and depth > 0:
+                cells = [cell for cell in element if cell.tag in ("td", "th")]
+                if cells and "ui-datatable-empty-message" not in (element.get("class") or ""):
+                    yield any(cell.tag == "th" for cell in cells), [_cell_text(cell) for cell in cells]
+                # Free the row and the rows before it
+                element.clear(keep_tail=True)
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
 
-        for row in table.find_all("tr")[1:]:  # Skip the header row
-            cols = row.find_all("td")
-            data.append([col.get_text(strip=True) for col in cols])
 
-        # Convert to DataFrame
-        df = pd.DataFrame(data, columns=headers)
+def _file_chunks(path):
+    with open(path, "rb") as file:
+        while True:
+            chunk = file.read(STREAM_CHUNK_BYTES)
+            if not chunk:
+                return
+            yield chunk
 
-        # Save the data to a CSV file
-        df.to_csv('..' + os.sep + DOWNLOAD_DIR + os.sep + "eudra_non_compliance_reports.csv", index=False)
-        print("Non-compliance reports saved to eudra_non_compliance_reports.csv")
 
-    return df
+def saved_pages(paths):
+    """
+    Result pages saved to disk, e.g. MOCK_HTML_PATH, for offline runs.
+    :param paths: List of saved HTML pages, in page order.
+    :return: Iterator of (chunks, is_fragment) per page.
+    """
+    for path in paths:
+        yield _file_chunks(path), False
 
 
+def pagination_form(first, rows, view_state):
+    """
+    Form of the PrimeFaces AJAX request for one page of the results table.
+    :return: Dictionary of form fields.
+    """
+    return {
+        "javax.faces.partial.ajax": "true",
+        "javax.faces.source": RESULTS_TABLE_ID,
+        "javax.faces.partial.execute": RESULTS_TABLE_ID,
+        "javax.faces.partial.render": RESULTS_TABLE_ID,
+        f"{RESULTS_TABLE_ID}_pagination": "true",
+        f"{RESULTS_TABLE_ID}_first": str(first),
+        f"{RESULTS_TABLE_ID}_rows": str(rows),
+        FORM_ID: FORM_ID,
+        VIEW_STATE_NAME: view_state,
+    }
+
+
+def partial_response_rows(chunks, page_state):
+    """
+    Read the table rows of a PrimeFaces partial response (XML with the HTML
+    of the rows in CDATA sections) and the view state it sends back.
+    :return: HTML of the rows of one page.
+    """
+    parser = etree.XMLPullParser(events=("end",))
+    rows_html = ""
+    for chunk in chunks:
+        parser.feed(chunk)
+        for _, element in parser.read_events():
+            if element.tag == "update" and element.get("id") == RESULTS_TABLE_ID:
+                rows_html = element.text or ""
+            elif element.tag == "update" and VIEW_STATE_NAME in (element.get("id") or ""):
+                page_state["view_state"] = element.text
+            element.clear()
+    parser.close()
+    return rows_html
+
+
+def fetch_result_pages(session, page_state, url=EUDRA_GMDP_NCR, page_rows=PAGE_ROWS):
+    """
+    Walk the result pages of the search: the first page is the search page
+    itself, the next ones are requested like the PrimeFaces paginator does,
+    until a page comes back with fewer rows than requested.
+    :param session: requests session keeping the JSF session cookie.
+    :param page_state: Dictionary shared with iter_table_rows: view state and rows read on the last page.
+    :return: Iterator of (chunks, is_fragment) per page.
+    """
+    response = session.get(url, stream=True)
+    response.raise_for_status()
+    yield response.iter_content(STREAM_CHUNK_BYTES), False
+
+    first = page_state["rows"]
+    while page_state.get("view_state") and page_state["rows"] > 0:
+        response = session.post(url, data=pagination_form(first, page_rows, page_state["view_state"]),
+                                headers={"Faces-Request": "partial/ajax"}, stream=True)
+        response.raise_for_status()
+        yield [partial_response_rows(response.iter_content(STREAM_CHUNK_BYTES), page_state)], True
+        if page_state["rows"] < page_rows:
+            return
+        first += page_state["rows"]
+
+
+def stream_eudra_non_compliance_reports(output_path, source="request", mock_paths=None, url=EUDRA_GMDP_NCR,
+                                        page_rows=PAGE_ROWS, session=None):
+    """
+    Scrape the non-compliance reports page by page, appending the rows to the
+    output CSV as they are parsed. Memory stays bounded by one page whatever
+    the size of the result set.
+    :param output_path: Output CSV file (same columns as scrape_eudra_non_compliance_reports).
+    :param source: 'request' to walk the pages of the site, 'mock_html' to read saved pages.
+    :param mock_paths: Saved pages for 'mock_html' (default: MOCK_HTML_PATH).
+    :param url: Search page URL.
+    :param page_rows: Rows requested per page.
+    :param session: Optional requests session.
+    :return: Number of rows written.
+    """
+    page_state = {"rows": 0}
+    if source == "request":
+        pages = fetch_result_pages(session or requests.Session(), page_state, url, page_rows)
+    else:
+        pages = saved_pages(mock_paths or ['../' + MOCK_HTML_PATH])
+
+    n_written = 0
+    headers = None
+    with open(output_path, "w", encoding="utf-8", newline="") as file:
+        # Same quoting and line endings as DataFrame.to_csv
+        writer = csv.writer(file, lineterminator="\n")
+        for chunks, fragment in pages:
+            page_state["rows"] = 0
+            for is_header, cells in iter_table_rows(chunks, page_state, fragment):
+                if is_header:
+                    if headers is None:
+                        headers = cells
+                        writer.writerow(headers)
+                    continue
+                writer.writerow(cells)
+                page_state["rows"] += 1
+            n_written += page_state["rows"]
+            file.flush()
+    return n_written
+
+
+def save_report_changes(output_path, snapshot_path=SNAPSHOT_PATH):
+    """
+    Save the reports inserted, updated or deleted since the last run next to
+    the reports CSV, and move the snapshot of the reports forward.
+    :param output_path: Reports CSV written by the scraper.
+    :param snapshot_path: Snapshot database.
+    :return: DataFrame of the changed reports.
+    """
+    snapshots = open_snapshot_store(snapshot_path)
+    reports_df = pd.read_csv(output_path, dtype=str)
+    changes = diff_snapshot(snapshots, NCR_SNAPSHOT_SOURCE, reports_df, "Report Number")
+    write_changes(changes, output_path.replace(".csv", "_changes.csv"))
+    commit_snapshot(snapshots, NCR_SNAPSHOT_SOURCE, changes)
+    snapshots.close()
+    return changes
+
+
+def mock_results_page(headers, rows, view_state="mock-view-state"):
+    """
+    HTML of a results page with the PrimeFaces markup of the site.
+    :param headers: Column titles.
+    :param rows: List of lists of cell values.
+    :return: HTML string.
+    """
+    header_html = "".join(f'<th class="ui-state-default" role="columnheader"><span class="ui-column-title">'
+                          f'{html.escape(header)}</span></th>' for header in headers)
+    return (f'<!DOCTYPE html>\n<html><head><meta charset="UTF-8"><title>EudraGMDP</title></head><body>\n'
+            f'<form id="{FORM_ID}" name="{FORM_ID}" method="post">\n'
+            f'<div id="{RESULTS_TABLE_ID}" class="ui-datatable ui-widget stable">'
+            f'<div class="ui-datatable-tablewrapper"><table role="grid">'
+            f'<thead id="{RESULTS_TABLE_ID}_head"><tr role="row">{header_html}</tr></thead>\n'
+            f'<tbody id="{RESULTS_TABLE_ID}_data" class="ui-datatable-data ui-widget-content">\n'
+            f'{mock_rows_html(rows)}</tbody></table></div></div>\n'
+            f'<input type="hidden" name="{VIEW_STATE_NAME}" id="j_id1:{VIEW_STATE_NAME}:0" value="{view_state}" />\n'
+            f'</form></body></html>\n')
+
+
+def mock_rows_html(rows, first=0):
+    return "".join(f'<tr data-ri="{first + number}" class="ui-widget-content" role="row">'
+                   + "".join(f'<td role="gridcell">{html.escape(str(value))}</td>' for value in row) + "</tr>\n"
+                   for number, row in enumerate(rows))
+
+
+def mock_records(n_rows, sample_path="../" + DOWNLOAD_DIR + "/eudra_non_compliance_reports.csv"):
+    """
+    Build n_rows reports by cycling through the saved reports with new report numbers.
+    :return: (headers, list of rows).
+    """
+    sample = pd.read_csv(sample_path, dtype=str, keep_default_na=False)
+    rows = []
+    for number in range(n_rows):
+        row = list(sample.iloc[number % len(sample)])
+        row[0] = f"{row[0]}-{number}"
+        rows.append(row)
+    return list(sample.columns), rows
+
+
+def serve_mock_eudra(headers, rows, initial_rows=10, port=0):
+    """
+    Local stand-in for the EudraGMDP search: GET returns the first page,
+    POSTs with the PrimeFaces pagination fields return partial responses.
+    :return: (server, URL); call server.shutdown() to stop it.
+    """
+
+    class EudraHandler(BaseHTTPRequestHandler):
+
+        def _send(self, status, content=b"", content_type="text/html"):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            self._send(200, mock_results_page(headers, rows[:initial_rows]).encode("utf-8"))
+
+        def do_POST(self):
+            form = parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8"))
+            if form.get(VIEW_STATE_NAME) != ["mock-view-state"]:
+                self._send(500)
+                return
+            first = int(form[f"{RESULTS_TABLE_ID}_first"][0])
+            page = rows[first:first + int(form[f"{RESULTS_TABLE_ID}_rows"][0])]
+            content = (f"<?xml version='1.0' encoding='UTF-8'?>\n<partial-response id=\"j_id1\"><changes>"
+                       f"<update id=\"{RESULTS_TABLE_ID}\"><![CDATA[{mock_rows_html(page, first)}]]></update>"
+                       f"<update id=\"j_id1:{VIEW_STATE_NAME}:0\"><![CDATA[mock-view-state]]></update>"
+                       f"</changes></partial-response>")
+            self._send(200, content.encode("utf-8"), "text/xml")
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), EudraHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/searchGMPNonCompliance.do"
 
 
 if __name__=="__main__":
-    # Run the scraper
-    non_compliance_data = scrape_eudra_non_compliance_reports(source='mock_html')
+    parser = argparse.ArgumentParser(description="Scrape the EudraGMDP non-compliance reports")
+    parser.add_argument("--stream", action="store_true", help="Stream the result pages to the CSV page by page")
+    parser.add_argument("--source", default="mock_html", choices=["request", "mock_html"])
+    parser.add_argument("--mock-pages", nargs="*", default=None, help="Saved result pages to read, in order")
+    parser.add_argument("--changes", action="store_true",
+                        help="Save the reports inserted, updated or deleted since the last run")
+    parser.add_argument("--demo-rows", type=int, default=0,
+                        help="Stream this many reports from a local stand-in server and from saved pages instead")
+    args = parser.parse_args()
+
+    if args.demo_rows:
+        headers, rows = mock_records(args.demo_rows)
+        folder = tempfile.mkdtemp()
+        server, url = serve_mock_eudra(headers, rows)
+        try:
+            start = time.perf_counter()
+            n_written = stream_eudra_non_compliance_reports(os.path.join(folder, "served.csv"), url=url)
+            print(f"Stand-in server: {n_written} rows in {time.perf_counter() - start:.2f}s")
+
+            # Saved pages: the streamed CSV matches the BeautifulSoup parsing of every page
+            paths = []
+            for first in range(0, len(rows), PAGE_ROWS):
+                paths.append(os.path.join(folder, f"EUDRA_NCR_{len(paths) + 1}.html"))
+                with open(paths[-1], "w", encoding="utf-8") as f:
+                    f.write(mock_results_page(headers, rows[first:first + PAGE_ROWS]))
+            start = time.perf_counter()
+            n_written = stream_eudra_non_compliance_reports(os.path.join(folder, "saved.csv"), "mock_html", paths)
+            stream_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            expected = pd.concat([parse_results_table(open(path, encoding="utf-8").read()) for path in paths],
+                                 ignore_index=True)
+            dom_seconds = time.perf_counter() - start
+            streamed = pd.read_csv(os.path.join(folder, "saved.csv"), dtype=str, keep_default_na=False)
+            served = pd.read_csv(os.path.join(folder, "served.csv"), dtype=str, keep_default_na=False)
+            print(f"Saved pages: {n_written} rows, same rows as BeautifulSoup: {streamed.equals(expected)}, "
+                  f"same rows as the server: {served.equals(expected)}")
+            print(f"  streaming {n_written / stream_seconds:.0f} rows/s, "
+                  f"BeautifulSoup {n_written / dom_seconds:.0f} rows/s")
+        finally:
+            server.shutdown()
+            shutil.rmtree(folder)
+    elif args.stream:
+        output_path = '..' + os.sep + DOWNLOAD_DIR + os.sep + "eudra_non_compliance_reports.csv"
+        n_written = stream_eudra_non_compliance_reports(output_path, args.source, args.mock_pages)
+        print(f"{n_written} non-compliance reports saved to eudra_non_compliance_reports.csv")
+        if args.changes:
+            save_report_changes(output_path)
+    else:
+        # Run the scraper
+        non_compliance_data = scrape_eudra_non_compliance_reports(source=args.source)
 
-    # Display the scraped data
-    if non_compliance_data is not None:
-        print(non_compliance_data.head())
\ No newline at end of file
+        # Display the scraped data
+        if non_compliance_data is not None:
+            print(non_compliance_data.head())
+            if args.changes and len(non_compliance_data.columns):
+                save_report_changes('..' + os.sep + DOWNLOAD_DIR + os.sep + "eudra_non_compliance_reports.csv")
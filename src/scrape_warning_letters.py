@@ -1,3 +1,4 @@
+import argparse
 import re
 
 import requests
@@ -7,6 +8,13 @@ import os
 from bs4 import BeautifulSoup
 import pandas as pd
 
+from change_detection import CHANGE_COLUMN, DELETED, commit_snapshot, diff_snapshot, open_snapshot_store, \
+    write_changes
+from letter_downloader import MAX_WORKERS, download_letters
+from letter_parsing import PARSE_CHUNK_SIZE, extract_letter_metadata, letter_soup
+from parse_cache import (KEY_COLUMN, letter_filename, letter_key, letter_path, load_download_manifest,
+                         open_parse_cache, parse_letters_cached)
+
 
 # URL of the FDA Warning Letters page
 FDA_WARNING_LETTERS_URL = "https://www.fda.gov/inspections-compliance-enforcement-and-criminal-investigations/compliance-actions-and-activities/warning-letters?search_api_fulltext=&search_api_fulltext_issuing_office=&field_letter_issue_datetime=All&field_change_date_closeout_letter=&field_change_date_response_letter=&field_change_date_2=All&field_letter_issue_datetime_2=&export=yes"
@@ -14,8 +22,10 @@ FDA_WARNING_LETTERS_URL = "https://www.fda.gov/inspections-compliance-enforcemen
 # Directory to save downloaded letters
 DATA_DIR = "../data/warning_letters"
 WARNING_LETTER_TABLE_FN = "warning_letters_table.csv"
+WARNING_LETTER_CHANGES_FN = "warning_letters_table_changes.csv"
 
-METADATA_LABELS = ["Delivery Method:", "Reference #:", "Product:", "Issuing Office:"]
+# Snapshot of the table, to find the letters added, changed or removed since the last refresh
+TABLE_SNAPSHOT_SOURCE = "warning_letters_table"
 
 def scrape_warning_letters_table(url):
     """
@@ -65,29 +75,19 @@ def scrape_warning_letters_table(url):
         print(f"Error scraping warning letters: {e}")
         return None
 
-def download_warning_letters(df, download_dir):
+def download_warning_letters(df, download_dir, max_workers=MAX_WORKERS, revalidate=False):
     """
     Download the warning letters from the links in the DataFrame.
+    Files are named after the stable letter key (see parse_cache.letter_key).
+    Letters are fetched concurrently over a pooled session with per-host rate
+    limiting and retries; letters listed in the download manifest are skipped
+    (or revalidated with conditional requests), so a failed run can be resumed.
     """
-    if not os.path.exists(download_dir):
-        os.makedirs(download_dir)
-
-    for index, row in df.iterrows():
-        link = row['Link']
-        if link:
-            try:
-                # Get the content of the warning letter
-                response = requests.get(link)
-                response.raise_for_status()
-
-                # Save the warning letter as an HTML file
-                filename = os.path.join(download_dir, f"warning_letter_{index + 1}.html")
-                with open(filename, 'wb') as file:
-                    file.write(response.content)
-                print(f"Downloaded: {filename}")
-
-            except Exception as e:
-                print(f"Error downloading warning letter from {link}: {e}")
+    jobs = [(link, letter_filename(link)) for link in df['Link'] if pd.notna(link)]
+    counts = download_letters(jobs, download_dir, max_workers=max_workers, revalidate=revalidate)
+    print(f"Warning letters: {counts['downloaded']} downloaded, {counts['not_modified']} not modified, "
+          f"{counts['skipped']} already downloaded, {counts['failed']} failed")
+    return counts
 
 
 def extract_metadata_and_text_from_html(file_path):
@@ -97,103 +97,69 @@ def extract_metadata_and_text_from_html(file_path):
     :return: A dictionary containing metadata and letter text.
     """
     try:
-        # Open and parse the HTML file
-        with open(file_path, 'r', encoding='utf-8') as file:
-            soup = BeautifulSoup(file, 'html.parser')
-
-        # Extract metadata
-        metadata = {}
-
-        for label in METADATA_LABELS:
-            element = soup.find('dt', string=label)
-            if element:
-                metadata[label.strip(":")] = element.find_next('dd').text.strip()
-            else:
-                metadata[label.strip(":")] = None
-
-        # Extract company information
-        '''company_info = {
-            "recipient_name": soup.find("div", {"class": "field--name-field-recipient-name"}).find("div", {
-                "class": "field--item"}).text.strip(),
-            "recipient_title": soup.find("div", {"class": "field--name-field-recipient-title"}).find("div", {
-                "class": "field--item"}).text.strip(),
-            "company_name": soup.find("h1", {"class": "text-center content-title"}).contents[0].strip(),
-            "address": soup.find("span", {"class": "address-line1"}).text.strip(),
-            "locality": soup.find("span", {"class": "locality"}).text.strip(),
-            "region": soup.find("span", {"class": "administrative-area"}).text.strip(),
-            "postal_code": soup.find("span", {"class": "postal-code"}).text.strip(),
-            "country": soup.find("span", {"class": "country"}).text.strip()
-        }'''
-        # Extract company information (adapted for different structures)
-        company_info = {}
-        # Try finding company name
-        company_name = soup.find("h1", {"class": "text-center content-title"})
-        if company_name:
-            company_info["company_name"] = company_name.text.strip()
-        else:
-            company_info["company_name"] = soup.find("meta", {"property": "og:title"})["content"].split(" - ")[0]
-
-        # Try finding recipient name
-        recipient = soup.find("div", {"class": "field--name-field-recipient-name"})
-        if recipient:
-            company_info["recipient_name"] = recipient.find("div", {"class": "field--item"}).text.strip()
-        else:
-            company_info["recipient_name"] = "Not found"
-
-        # Extract address details
-        address_fields = ["address-line1", "address-line2", "locality", "administrative-area", "postal-code", "country"]
-        for field in address_fields:
-            tag = soup.find("span", {"class": field})
-            company_info[field.replace("-", "_")] = tag.text.strip() if tag else "Not found"
-
-        metadata["Company Info"] = company_info
-
-        # Extract violations (different structures)
-        violations = []
-        violation_patterns = [
-            r"fail.* to .*?\.?",  # Matches phrases like "failure to maintain records."
-            r"deviat.* to .*?\.?",
-            r"inadequat.* .*?\.?",  # Matches phrases like "inadequate documentation."
-            r"lack of .*?\.?",  # Matches phrases like "lack of access controls."
-        ]
-        for header in soup.find_all(["strong", "b"]):
-            for pattern in violation_patterns:
-                matches = re.findall(pattern, header.text, re.IGNORECASE)
-                violations.extend(matches)
-
-        metadata["Violations"] = ';'.join(violations)
-        return metadata
-
+        return extract_letter_metadata(letter_soup(file_path))
     except Exception as e:
         print(f"Error processing file {file_path}: {e}")
         return None
 
 
+def refresh_warning_letters_table(file_path, max_workers=MAX_WORKERS):
+    """
+    Scrape the table again and only download the letters that are new or
+    whose row changed since the last refresh. The delta is saved next to the
+    table for the downstream steps.
+    :param file_path: Path of the table CSV.
+    :return: The scraped table, None if the scraping failed.
+    """
+    warning_letters_df = scrape_warning_letters_table(FDA_WARNING_LETTERS_URL)
+    if warning_letters_df is None:
+        return None
+    warning_letters_df.to_csv(file_path)
+
+    snapshots = open_snapshot_store()
+    changes = diff_snapshot(snapshots, TABLE_SNAPSHOT_SOURCE, warning_letters_df, "Link", letter_key)
+    download_warning_letters(changes[changes[CHANGE_COLUMN] != DELETED], DATA_DIR, max_workers, revalidate=True)
+    write_changes(changes, DATA_DIR + os.sep + WARNING_LETTER_CHANGES_FN)
+    # The snapshot only moves forward once the letters of the delta are downloaded
+    commit_snapshot(snapshots, TABLE_SNAPSHOT_SOURCE, changes)
+    snapshots.close()
+    return warning_letters_df
+
+
 # Defining main function
-def main():
+def main(workers=None, chunk_size=PARSE_CHUNK_SIZE, refresh=False):
     # Scrape the warning letters table and save the data
     file_path = DATA_DIR + os.sep + WARNING_LETTER_TABLE_FN
-    if os.path.exists(file_path):
+    if os.path.exists(file_path) and not refresh:
         warning_letters_df =  pd.read_csv(file_path)
     else:
-        warning_letters_df = scrape_warning_letters_table(FDA_WARNING_LETTERS_URL)
-        warning_letters_df.to_csv(file_path)
-
-    # Add metadata and letter text to the DataFrame
-    metadata_list = []
-    for i, row in warning_letters_df.iterrows():
-        html_file_path = DATA_DIR + os.sep + 'warning_letter_' + str(i + 1) + '.html'
-        metadata = extract_metadata_and_text_from_html(html_file_path)
-        if metadata:
-            metadata_list.append(metadata)
-        else:
-            metadata_list.append({key: None for key in METADATA_LABELS})
-    # Merge metadata with the original DataFrame
-    metadata_df = pd.DataFrame(metadata_list)
-    final_df = pd.concat([warning_letters_df, metadata_df], axis=1)
-
-    # Save the final DataFrame to a CSV file
-    final_df.to_csv(DATA_DIR + os.sep + "warning_letters_with_metadata.csv", index=False)
+        warning_letters_df = refresh_warning_letters_table(file_path)
+        if warning_letters_df is None:
+            return
+
+    # Find the file of every letter by its stable key, rows without a link keep their former positional file
+    manifest = load_download_manifest(DATA_DIR)
+    letters = [(letter_key(link), letter_path(link, DATA_DIR, manifest, i)) if pd.notna(link) else
+               (f"row_{i + 1}", DATA_DIR + os.sep + 'warning_letter_' + str(i + 1) + '.html')
+               for i, link in enumerate(warning_letters_df['Link'])]
+    keys = pd.Series([key for key, _ in letters])
+
+    # Parse the letters that changed since the last run and write them with the table rows chunk by chunk
+    output_path = DATA_DIR + os.sep + "warning_letters_with_metadata.csv"
+    conn = open_parse_cache()
+    start = 0
+    n_parsed = 0
+    for metadata_df, n_chunk_parsed in parse_letters_cached(letters, conn, workers, chunk_size):
+        table_chunk = warning_letters_df.iloc[start:start + len(metadata_df)].reset_index(drop=True)
+        # Merge metadata with the original DataFrame, joined by letter key rather than by position
+        metadata_df = metadata_df.drop_duplicates(KEY_COLUMN).set_index(KEY_COLUMN)
+        metadata_df = metadata_df.reindex(keys.iloc[start:start + len(table_chunk)]).reset_index(drop=True)
+        final_df = pd.concat([table_chunk, metadata_df], axis=1)
+        final_df.to_csv(output_path, mode="w" if start == 0 else "a", header=start == 0, index=False)
+        start += len(table_chunk)
+        n_parsed += n_chunk_parsed
+    conn.close()
+    print(f"{n_parsed} letters parsed, {len(letters) - n_parsed} unchanged letters read from the parse cache")
     print("Warning letters with metadata saved to warning_letters_with_metadata.csv")
 
 def trend_analysis(warning_letters_df):
@@ -219,7 +185,14 @@ def trend_analysis(warning_letters_df):
 
 
 if __name__=="__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Scrape the FDA warning letters and parse their metadata")
+    parser.add_argument("--refresh", action="store_true",
+                        help="Scrape the table again even if it was saved, and write the letters added, changed or "
+                             "removed since the last refresh")
+    parser.add_argument("--workers", type=int, default=None, help="Parsing worker processes (default: number of CPUs)")
+    parser.add_argument("--chunk-size", type=int, default=PARSE_CHUNK_SIZE, help="Letters parsed per chunk")
+    args = parser.parse_args()
+    main(args.workers, args.chunk_size, args.refresh)
     #trend analysis
     # Load the warning letters data
     '''try:
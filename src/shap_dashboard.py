@@ -1,3 +1,5 @@
+import os
+
 import streamlit as st
 import shap
 import pandas as pd
@@ -10,10 +12,22 @@ import joblib
 from shap import TreeExplainer, Explanation
 from shap.plots import waterfall
 
+from dataset_storage import SLIDING_WINDOW_PARQUET, read_sliding_windows
+from record_schema import SLIDING_WINDOW_CSV, read_sliding_window_csv
+from lazy_explanations import (GLOBAL_SAMPLE_SIZE, explain_sample, make_supplier_explainer,
+                                start_background_explanation, stratified_sample)
+from risk_scoring import risk_bands
+from shap_store import (MODEL_PATH, dataset_hash, fill_shap_store, model_hash, open_shap_store, store_explanation,
+                        store_path)
+from supplier_index import build_supplier_index
+
 # Load dataset
 @st.cache_data
 def load_data():
-    return pd.read_csv("../data/historical_ds/sliding_window_supplier_data_with_target.csv")  # Update with actual file path
+    # Prefer the partitioned Parquet dataset, fall back to the CSV export
+    if os.path.exists(SLIDING_WINDOW_PARQUET):
+        return read_sliding_windows()
+    return read_sliding_window_csv(SLIDING_WINDOW_CSV)  # Update with actual file path
 
 # Load data
 data = load_data()
@@ -28,7 +42,7 @@ y = data["ncr_or_warning_letter"]
 def load_model():
     # model = xgb.XGBClassifier(use_label_encoder=False, eval_metric="logloss")
     # model.fit(X, y)
-    model = joblib.load("../models/supplier_warning_model.pkl")
+    model = joblib.load(MODEL_PATH)
     return model
 
 model = load_model()
@@ -36,50 +50,109 @@ model = load_model()
 # Compute SHAP values
 @st.cache_resource
 def compute_shap():
+    # Memory-map the values precomputed by shap_store.py and only explain the rows missing from the store
     explainer = shap.Explainer(model, X)
-    shap_values = explainer(X)
-    exp = Explanation(shap_values.values[:, :, 1],
-                      shap_values.base_values[:, 1],
-                      data=X.values,
-                      feature_names=X.columns)
-    return shap_values, explainer, exp
+    store = open_shap_store(store_path(model_hash(MODEL_PATH), dataset_hash(X)), len(X), X.columns)
+    fill_shap_store(store, explainer, X)
+    exp = store_explanation(store, X)
+    return explainer, exp
 
-shap_values, explainer, explanation = compute_shap()
+# Row positions of every supplier, sorted by window
+@st.cache_resource
+def load_supplier_index():
+    return build_supplier_index(data)
+
+supplier_rows = load_supplier_index()
+
+# Lazy mode: a TreeExplainer only explains the selected supplier and a sample of rows for the global views
+@st.cache_resource
+def load_lazy_explainer():
+    explainer = TreeExplainer(model)
+    return explainer, make_supplier_explainer(explainer, data, X, supplier_rows)
+
+@st.cache_resource
+def compute_sample_shap(sample_size):
+    return explain_sample(load_lazy_explainer()[0], X, stratified_sample(y, sample_size))
+
+@st.cache_resource
+def start_full_shap():
+    return start_background_explanation(load_lazy_explainer()[0], X)
+
+# Predict the risk of every row once, not on every rerun
+@st.cache_data
+def predict_risk():
+    return model.predict_proba(X)[:, 1]
+
+explanation_mode = st.sidebar.radio("Explanation mode:", ["Lazy", "Precomputed store"])
+if explanation_mode == "Precomputed store":
+    explainer, explanation = compute_shap()
 
 # ======================== STREAMLIT DASHBOARD ========================
 st.title("📊 Supplier Risk Analysis Dashboard")
 
 # Select a supplier for individual analysis
-supplier_ids = data["supplier_id"].tolist()
+supplier_ids = list(supplier_rows)
 selected_supplier = st.selectbox("Select a Supplier:", supplier_ids)
 
-# Get selected supplier index
-supplier_index = data[data["supplier_id"] == selected_supplier].index[0]
+# Select one of the supplier's windows, the latest by default
+rows = supplier_rows[selected_supplier]
+window_starts = pd.to_datetime(data["analysis_start"].iloc[rows]).dt.strftime("%Y-%m-%d").tolist()
+window = st.selectbox("Select an Analysis Window (start):", range(len(rows)), index=len(rows) - 1,
+                      format_func=lambda position: window_starts[position])
+supplier_index = rows[window]
 
 # Display supplier risk probability
-risk_prob = model.predict_proba(X.iloc[[supplier_index]])[:, 1][0]
+risk_prob = predict_risk()[supplier_index]
 st.metric(label="🔴 Predicted Risk Probability", value=f"{risk_prob:.2%}")
 
+# ======================== RISK TREND ========================
+st.subheader("📈 Risk Trend Across Windows")
+
+trend = pd.DataFrame({"analysis_start": pd.to_datetime(data["analysis_start"].iloc[rows]).to_numpy(),
+                      "risk_probability": predict_risk()[rows]})
+fig = px.line(trend, x="analysis_start", y="risk_probability", markers=True,
+              title=f"Predicted Risk Probability of {selected_supplier}",
+              labels={"analysis_start": "Analysis window start", "risk_probability": "Risk probability"})
+st.plotly_chart(fig)
+
 # ======================== SHAP WATERFALL PLOT ========================
 st.subheader("📌 Risk Breakdown (SHAP Waterfall Plot)")
 
 fig, ax = plt.subplots(figsize=(10, 6))
-waterfall(explanation[supplier_index])
+if explanation_mode == "Lazy":
+    explain_supplier = load_lazy_explainer()[1]
+    waterfall(explain_supplier(selected_supplier, data["analysis_start"].iloc[supplier_index])[0])
+else:
+    waterfall(explanation[supplier_index])
 # shap.waterfall_plot(shap_values[supplier_index], max_display=10)
 st.pyplot(fig)
 
 # ======================== SHAP SUMMARY PLOT ========================
 st.subheader("🌍 Feature Importance Across All Suppliers")
 
+if explanation_mode == "Lazy":
+    sample_size = int(st.sidebar.number_input("Rows explained for the global views:", min_value=1, max_value=len(X),
+                                              value=min(GLOBAL_SAMPLE_SIZE, len(X)), step=100))
+    global_explanation = compute_sample_shap(sample_size)
+    if st.sidebar.checkbox("Upgrade the global views to all rows (computed in the background)"):
+        full_shap = start_full_shap()
+        if full_shap["explanation"] is not None:
+            global_explanation = full_shap["explanation"]
+        else:
+            st.info(f"Explaining all {len(X)} rows in the background, showing a stratified sample of "
+                    f"{sample_size} rows meanwhile. Rerun to refresh.")
+else:
+    global_explanation = explanation
+
 fig, ax = plt.subplots(figsize=(10, 6))
-shap.summary_plot(shap_values[:,:,1], X, show=False)
+shap.summary_plot(global_explanation, show=False)
 st.pyplot(fig)
 
 # ======================== GLOBAL FEATURE IMPORTANCE ========================
 st.subheader("🔎 Global Feature Impact")
 
 # Convert SHAP values into DataFrame
-shap_df = pd.DataFrame(shap_values.values[:,:,1], columns=X.columns)
+shap_df = pd.DataFrame(global_explanation.values, columns=X.columns)
 shap_mean = shap_df.abs().mean().sort_values(ascending=False)
 
 # Plot feature importance with Plotly
@@ -97,16 +170,7 @@ st.plotly_chart(fig)
 st.subheader("📊 Risk Segmentation of Suppliers")
 
 # Categorize risk levels
-def categorize_risk(prob):
-    if prob < 0.3:
-        return "Low Risk"
-    elif prob < 0.7:
-        return "Medium Risk"
-    else:
-        return "High Risk"
-
-data["risk_category"] = model.predict_proba(X)[:, 1]
-data["risk_category"] = data["risk_category"].apply(categorize_risk)
+data["risk_category"] = risk_bands(predict_risk())
 
 fig = px.histogram(data, x="risk_category", title="Supplier Risk Distribution", color="risk_category")
 st.plotly_chart(fig)
@@ -0,0 +1,186 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+import shap
+
+from dataset_storage import SLIDING_WINDOW_PARQUET, read_sliding_windows
+from record_schema import SLIDING_WINDOW_CSV, read_sliding_window_csv
+
+SHAP_STORE_FOLDER = "../data/shap_store/"
+MODEL_PATH = "../models/supplier_warning_model.pkl"
+
+# Columns of the sliding-window dataset that are not model features
+NON_FEATURE_COLUMNS = ["supplier_id", "ncr_or_warning_letter", "analysis_start", "analysis_end",
+                       "prediction_start", "prediction_end"]
+
+# Number of rows explained and flushed to disk at a time
+SHAP_CHUNK_ROWS = 5000
+
+
+def model_hash(model_path):
+    """
+    Hash a model from the bytes of its file on disk. Unlike the pickle of the
+    loaded estimator, they do not change with the library or pickle versions,
+    so the same model file always finds its store.
+    :param model_path: Path of the model file.
+    :return: Hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(model_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def dataset_hash(X):
+    """
+    Hash the feature matrix, column names and row order included. The SHAP
+    values depend on the whole dataset (it is the explainer background), so
+    any change gives a new store.
+    :param X: DataFrame with the model features.
+    :return: Hex digest.
+    """
+    digest = hashlib.sha256("\x1f".join(map(str, X.columns)).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(X, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def store_path(model_digest, dataset_digest, folder=SHAP_STORE_FOLDER):
+    """
+    Directory of the store of a model and dataset.
+    :return: Path of the directory.
+    """
+    return os.path.join(folder, f"{model_digest[:16]}-{dataset_digest[:16]}")
+
+
+def open_shap_store(path, n_rows=None, feature_names=None):
+    """
+    Memory-map a SHAP store, creating it if it does not exist yet.
+    The store holds the SHAP values of the positive class (values.npy),
+    the base values (base_values.npy) and which rows are already computed
+    (computed.npy), so only the missing rows have to be explained.
+    :param path: Directory of the store, see store_path.
+    :param n_rows: Number of rows of the dataset (needed to create the store).
+    :param feature_names: Feature names (needed to create the store).
+    :return: Dictionary with the memory-mapped arrays and the feature names.
+    """
+    meta_path = os.path.join(path, "meta.json")
+    if not os.path.exists(meta_path):
+        if n_rows is None or feature_names is None:
+            print(f"No SHAP store found at {path}")
+            return None
+        os.makedirs(path, exist_ok=True)
+        shape = (n_rows, len(feature_names))
+        np.lib.format.open_memmap(os.path.join(path, "values.npy"), mode="w+", dtype=np.float64, shape=shape).flush()
+        np.lib.format.open_memmap(os.path.join(path, "base_values.npy"), mode="w+", dtype=np.float64,
+                                  shape=(n_rows,)).flush()
+        np.lib.format.open_memmap(os.path.join(path, "computed.npy"), mode="w+", dtype=np.bool_,
+                                  shape=(n_rows,)).flush()
+        # The metadata is written last, a store without it is incomplete and recreated
+        with open(meta_path, "w") as f:
+            json.dump({"n_rows": n_rows, "feature_names": list(feature_names)}, f)
+
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return {
+        "path": path,
+        "feature_names": meta["feature_names"],
+        "values": np.load(os.path.join(path, "values.npy"), mmap_mode="r+"),
+        "base_values": np.load(os.path.join(path, "base_values.npy"), mmap_mode="r+"),
+        "computed": np.load(os.path.join(path, "computed.npy"), mmap_mode="r+"),
+    }
+
+
+def missing_rows(store):
+    """
+    :return: Row positions of the store without SHAP values yet.
+    """
+    return np.flatnonzero(~store["computed"])
+
+
+def explain_rows(explainer, X_rows):
+    """
+    Explain some rows and keep the positive class.
+    :param explainer: SHAP explainer of the model.
+    :param X_rows: DataFrame with the rows to explain.
+    :return: (values, base_values) arrays of the positive class.
+    """
+    explanation = explainer(X_rows)
+    values = np.asarray(explanation.values)
+    base_values = np.asarray(explanation.base_values)
+    # Classifiers explained per class give (rows, features, classes)
+    if values.ndim == 3:
+        values, base_values = values[:, :, 1], base_values[:, 1]
+    return values, np.broadcast_to(base_values, (len(X_rows),))
+
+
+def fill_shap_store(store, explainer, X, chunk_rows=SHAP_CHUNK_ROWS):
+    """
+    Compute the SHAP values of the rows missing from the store, chunk by
+    chunk, flushing every chunk so an interrupted run resumes where it stopped.
+    :param store: Store returned by open_shap_store.
+    :param explainer: SHAP explainer of the model.
+    :param X: DataFrame with the model features, same rows as the store.
+    :param chunk_rows: Number of rows explained at a time.
+    :return: Number of rows computed.
+    """
+    rows = missing_rows(store)
+    for start in range(0, len(rows), chunk_rows):
+        chunk = rows[start:start + chunk_rows]
+        values, base_values = explain_rows(explainer, X.iloc[chunk])
+        store["values"][chunk] = values
+        store["base_values"][chunk] = base_values
+        store["values"].flush()
+        store["base_values"].flush()
+        store["computed"][chunk] = True
+        store["computed"].flush()
+    return len(rows)
+
+
+def store_explanation(store, X):
+    """
+    Build the shap Explanation of the whole dataset on top of the memory-mapped values.
+    :param store: Store returned by open_shap_store, fully computed.
+    :param X: DataFrame with the model features.
+    :return: shap.Explanation.
+    """
+    return shap.Explanation(store["values"], store["base_values"], data=X.values,
+                            feature_names=store["feature_names"])
+
+
+def load_features(path=None):
+    """
+    Load the sliding-window dataset and split the model features.
+    :param path: CSV file or Parquet directory (default: Parquet if present, else CSV).
+    :return: (data, X) DataFrames.
+    """
+    if path is None:
+        path = SLIDING_WINDOW_PARQUET if os.path.exists(SLIDING_WINDOW_PARQUET) else SLIDING_WINDOW_CSV
+    data = read_sliding_windows(path) if os.path.isdir(path) else read_sliding_window_csv(path)
+    return data, data.drop(columns=NON_FEATURE_COLUMNS)
+
+
+if __name__ == "__main__":
+    # Offline precomputation of the SHAP values used by shap_dashboard.py
+    parser = argparse.ArgumentParser(description="Precompute the SHAP values of the sliding-window dataset")
+    parser.add_argument("--model", default=MODEL_PATH, help="Path of the fitted model")
+    parser.add_argument("--data", default=None, help="Sliding-window CSV file or Parquet directory")
+    parser.add_argument("--store-folder", default=SHAP_STORE_FOLDER, help="Folder of the SHAP stores")
+    parser.add_argument("--chunk-rows", type=int, default=SHAP_CHUNK_ROWS, help="Rows explained at a time")
+    args = parser.parse_args()
+
+    model = joblib.load(args.model)
+    data, X = load_features(args.data)
+    path = store_path(model_hash(args.model), dataset_hash(X), args.store_folder)
+    store = open_shap_store(path, len(X), X.columns)
+
+    start = time.perf_counter()
+    n_computed = fill_shap_store(store, shap.Explainer(model, X), X, args.chunk_rows)
+    print(f"{n_computed} rows explained in {time.perf_counter() - start:.1f}s, "
+          f"{len(X) - n_computed} already in {path}")
@@ -0,0 +1,201 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+# Weight of each field in the overall similarity (same weights as is_similar)
+FIELD_WEIGHTS = {
+    "company_name": 0.4,
+    "address": 0.3,
+    "locality": 0.1,
+    "region": 0.1,
+    "postal_code": 0.05,
+    "country": 0.05,
+}
+
+# Maximum number of string pairs scored at once, bounds the memory of the kernel
+PAIR_CHUNK_SIZE = 200_000
+
+# All 64 bits set, the initial state of the bit-parallel LCS vector
+_ALL_ONES = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+# Number of set bits of every byte value, used to popcount uint64 words
+_BYTE_POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.int64)
+
+
+# Function to normalize text
+def normalize_text(text):
+    if not isinstance(text, str):
+        return ""
+    return ''.join(e for e in text.lower() if e.isalnum() or e.isspace()).strip()
+
+
+def normalize_block(records):
+    """
+    Normalize the similarity fields of a block of records, once per string.
+    :param records: List of mappings (or DataFrame) with the FIELD_WEIGHTS fields.
+    :return: Dictionary of field name to object array of normalized strings.
+    """
+    if isinstance(records, pd.DataFrame):
+        records = records.to_dict("records")
+    block = {}
+    for field in FIELD_WEIGHTS:
+        block[field] = np.array([normalize_text(record.get(field)) for record in records], dtype=object)
+    return block
+
+
+def take_block(block, positions):
+    """
+    Select some rows of a normalized block.
+    :param block: Block created by normalize_block.
+    :param positions: Row positions to keep.
+    :return: Normalized block with the selected rows.
+    """
+    return {field: values[positions] for field, values in block.items()}
+
+
+def _popcount(words):
+    # Number of set bits of each uint64 element
+    as_bytes = words.view(np.uint8).reshape(words.shape + (8,))
+    return _BYTE_POPCOUNT[as_bytes].sum(axis=-1)
+
+
+def _lcs_lengths(left_strings, right_strings, left_index, right_index):
+    """
+    Compute the longest common subsequence of many string pairs at once with
+    the bit-parallel algorithm of Hyyrö, vectorized over the pairs.
+    :param left_strings: List of unique strings on the left side.
+    :param right_strings: List of unique strings on the right side.
+    :param left_index: Array with the left string of each pair.
+    :param right_index: Array with the right string of each pair.
+    :return: Array with the LCS length of each pair.
+    """
+    alphabet = {char: code for code, char in enumerate(sorted(set("".join(left_strings)) | set("".join(right_strings))))}
+    padding = len(alphabet)
+    n_words = max(1, (max(map(len, left_strings), default=0) + 63) // 64)
+
+    # Match masks of the left strings: bit i of pattern[s, c] is set if left_strings[s][i] == c
+    pattern = np.zeros((len(left_strings), padding + 1, n_words), dtype=np.uint64)
+    for row, text in enumerate(left_strings):
+        for position, char in enumerate(text):
+            pattern[row, alphabet[char], position // 64] |= np.uint64(1 << (position % 64))
+
+    # Character codes of the right strings, padded with a code whose mask is empty
+    right_length = max(map(len, right_strings), default=0)
+    right_codes = np.full((len(right_strings), right_length), padding, dtype=np.int64)
+    for row, text in enumerate(right_strings):
+        right_codes[row, :len(text)] = [alphabet[char] for char in text]
+
+    left_lengths = np.array([len(text) for text in left_strings], dtype=np.int64)[left_index]
+    vector = np.full((len(left_index), n_words), _ALL_ONES, dtype=np.uint64)
+    one = np.uint64(1)
+    for position in range(right_length):
+        matches = pattern[left_index, right_codes[right_index, position]]
+        update = vector & matches
+        # Multi-word addition vector + update, propagating the carry between words
+        carry = np.zeros(len(left_index), dtype=np.uint64)
+        total = np.empty_like(vector)
+        for word in range(n_words):
+            partial = vector[:, word] + update[:, word]
+            overflow = partial < vector[:, word]
+            total[:, word] = partial + carry
+            carry = (overflow | (total[:, word] < partial)).astype(np.uint64)
+        vector = total | (vector & ~update)
+
+    # The LCS length is the number of zero bits in the first len(left) bits
+    word_offsets = np.arange(n_words, dtype=np.int64) * 64
+    bits_per_word = np.clip(left_lengths[:, None] - word_offsets, 0, 64)
+    masks = np.where(bits_per_word >= 64, _ALL_ONES,
+                     (one << np.minimum(bits_per_word, 63).astype(np.uint64)) - one).astype(np.uint64)
+    return _popcount(~vector & masks).sum(axis=1)
+
+
+def field_ratios(left_values, right_values):
+    """
+    Compute fuzz.ratio for aligned arrays of normalized strings.
+    Identical pairs of strings are only scored once.
+    :param left_values: Object array of strings.
+    :param right_values: Object array of strings, same length as left_values.
+    :return: Integer array with the ratio (0-100) of each pair.
+    """
+    left_codes, left_uniques = pd.factorize(left_values)
+    right_codes, right_uniques = pd.factorize(right_values)
+    pair_keys = left_codes.astype(np.int64) * len(right_uniques) + right_codes
+    unique_keys, inverse = np.unique(pair_keys, return_inverse=True)
+    left_index = unique_keys // max(len(right_uniques), 1)
+    right_index = unique_keys % max(len(right_uniques), 1)
+
+    left_strings = list(left_uniques)
+    right_strings = list(right_uniques)
+    unique_ratios = np.empty(len(unique_keys), dtype=np.int64)
+    for start in range(0, len(unique_keys), PAIR_CHUNK_SIZE):
+        chunk = slice(start, start + PAIR_CHUNK_SIZE)
+        lcs = _lcs_lengths(left_strings, right_strings, left_index[chunk], right_index[chunk])
+        length_sum = (np.array([len(text) for text in left_strings], dtype=np.int64)[left_index[chunk]] +
+                      np.array([len(text) for text in right_strings], dtype=np.int64)[right_index[chunk]])
+        # Same expression as Levenshtein.ratio, so the float rounding matches fuzz.ratio
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = np.round(100 * (1 - (length_sum - 2 * lcs) / length_sum))
+        # Two empty strings are equal, which fuzz.ratio scores as 100
+        unique_ratios[chunk] = np.where(length_sum == 0, 100, ratio)
+    return unique_ratios[inverse.reshape(-1)]
+
+
+def pairwise_similarity(query_block, company_block, query_positions, company_positions):
+    """
+    Compute the weighted similarity of selected (query, company) pairs.
+    :param query_block: Normalized block of query records.
+    :param company_block: Normalized block of companies.
+    :param query_positions: Array with the query row of each pair.
+    :param company_positions: Array with the company row of each pair.
+    :return: Float array with the overall similarity of each pair.
+    """
+    query_positions = np.asarray(query_positions, dtype=np.int64)
+    company_positions = np.asarray(company_positions, dtype=np.int64)
+    similarity = np.zeros(len(query_positions), dtype=np.float64)
+    if len(query_positions) == 0:
+        return similarity
+    for field, weight in FIELD_WEIGHTS.items():
+        similarity += weight * field_ratios(query_block[field][query_positions],
+                                            company_block[field][company_positions])
+    return similarity
+
+
+def similarity_matrix(query_block, company_block):
+    """
+    Compute the weighted similarity of every query against every company.
+    :param query_block: Normalized block of query records.
+    :param company_block: Normalized block of companies.
+    :return: Float array of shape (n_queries, n_companies).
+    """
+    n_queries = len(query_block["company_name"])
+    n_companies = len(company_block["company_name"])
+    query_positions = np.repeat(np.arange(n_queries), n_companies)
+    company_positions = np.tile(np.arange(n_companies), n_queries)
+    similarity = pairwise_similarity(query_block, company_block, query_positions, company_positions)
+    return similarity.reshape(n_queries, n_companies)
+
+
+if __name__ == "__main__":
+    from blocking_index import generate_synthetic_companies
+    from cross_reference_datasets import is_similar
+
+    companies_df, query_records = generate_synthetic_companies(2000, n_queries=50)
+    company_rows = companies_df.to_dict("records")
+    n_pairs = len(query_records) * len(company_rows)
+
+    # Reference: one is_similar call per pair
+    start = time.perf_counter()
+    expected = np.array([[is_similar(query, company_row) for company_row in company_rows]
+                         for query in query_records])
+    reference_seconds = time.perf_counter() - start
+
+    # Batch engine
+    start = time.perf_counter()
+    matrix = similarity_matrix(normalize_block(query_records), normalize_block(companies_df))
+    engine_seconds = time.perf_counter() - start
+
+    print(f"Pairs: {n_pairs}")
+    print(f"  is_similar: {n_pairs / reference_seconds:,.0f} pairs/s")
+    print(f"  similarity_matrix: {n_pairs / engine_seconds:,.0f} pairs/s (x{reference_seconds / engine_seconds:.1f})")
+    print(f"  Decisions identical to is_similar: {np.array_equal(expected, matrix >= 85)}")
@@ -0,0 +1,188 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+from feature_aggregation import COUNT_FEATURES, SUM_FEATURES, MEAN_FEATURES, FEATURE_COLUMNS, one_hot_counts
+
+WINDOW_COLUMNS = ["analysis_start", "analysis_end", "prediction_start", "prediction_end"]
+
+# Columns of the sliding-window dataset, in order
+SLIDING_WINDOW_COLUMNS = ["supplier_id"] + FEATURE_COLUMNS + WINDOW_COLUMNS + ["ncr_or_warning_letter"]
+
+
+def window_bounds(start_date, end_date, analysis_window_size, prediction_window_size, step_size):
+    """
+    List the sliding windows that fit between two dates.
+    :return: List of (analysis_start, analysis_end, prediction_start, prediction_end) tuples.
+    """
+    windows = []
+    current_start = start_date
+    while current_start + analysis_window_size + prediction_window_size <= end_date:
+        analysis_end = current_start + analysis_window_size
+        windows.append((current_start, analysis_end, analysis_end, analysis_end + prediction_window_size))
+        current_start += step_size
+    return windows
+
+
+def _prefix_sums(values):
+    # Cumulative sums with a leading zero, so the sum of rows [lo, hi) is prefix[hi] - prefix[lo]
+    prefix = np.zeros(len(values) + 1, dtype=np.int64 if values.dtype.kind in "bi" else np.float64)
+    np.cumsum(values, out=prefix[1:])
+    return prefix
+
+
+# Counters of the partial aggregates besides the features: records in the analysis
+# window, and flagged records in the prediction window
+PARTIAL_KEYS = ["window", "supplier_id"]
+RECORDS_COLUMN = "analysis_records"
+FLAGGED_COLUMN = "prediction_flagged"
+
+
+def _mean_counters(feature):
+    # A mean is kept as a (sum, count) pair, which can be added across chunks
+    return f"{feature}_sum", f"{feature}_count"
+
+
+def window_partials(historical_data, windows):
+    """
+    Aggregate a chunk of the historical records into mergeable partials: for
+    every (window, supplier), the counts and sums of the features, a (sum,
+    count) pair per mean, the records in the analysis window and the flagged
+    records in the prediction window. The records are sorted once by
+    (supplier, date) and every window is read from per-supplier prefix sums
+    with searchsorted.
+    :param historical_data: DataFrame with (a chunk of) the historical records.
+    :param windows: Window bounds returned by window_bounds.
+    :return: DataFrame with the PARTIAL_KEYS and the counters of every (window,
+             supplier) with records in the chunk, in (window, supplier) order.
+    """
+    # Sort the records once by supplier and date
+    supplier_codes, suppliers = pd.factorize(historical_data["supplier_id"], sort=True)
+    dates = pd.to_datetime(historical_data["record_date"]).to_numpy(dtype="datetime64[ns]").astype(np.int64)
+    order = np.lexsort((dates, supplier_codes))
+    unique_dates = np.unique(dates)
+    n_ranks = len(unique_dates) + 1
+    keys = supplier_codes[order].astype(np.int64) * n_ranks + np.searchsorted(unique_dates, dates[order])
+
+    # Position of the first record of each supplier at or after each window bound
+    bounds = pd.DatetimeIndex([bound for window in windows for bound in window])
+    bound_ranks = np.searchsorted(unique_dates, bounds.to_numpy(dtype="datetime64[ns]").astype(np.int64))
+    bound_ranks = bound_ranks.reshape(len(windows), 4)
+    supplier_offsets = np.arange(len(suppliers), dtype=np.int64) * n_ranks
+
+    def positions(bound):
+        return np.searchsorted(keys, supplier_offsets[None, :] + bound_ranks[:, bound, None])
+
+    analysis_lo, analysis_hi = positions(0), positions(1)
+    prediction_lo, prediction_hi = positions(2), positions(3)
+
+    # Keep the (window, supplier) pairs with records in the analysis or the prediction window
+    window_index, supplier_index = np.nonzero((analysis_hi > analysis_lo) | (prediction_hi > prediction_lo))
+    lo = analysis_lo[window_index, supplier_index]
+    hi = analysis_hi[window_index, supplier_index]
+
+    def window_sum(values):
+        prefix = _prefix_sums(np.asarray(values)[order])
+        return prefix[hi] - prefix[lo]
+
+    partials = {"window": window_index, "supplier_id": suppliers[supplier_index], RECORDS_COLUMN: hi - lo}
+    partials["total_warnings"] = window_sum(historical_data["severity_level"].notna())
+    indicators = one_hot_counts(historical_data)
+    for feature in COUNT_FEATURES:
+        partials[feature] = window_sum(indicators[feature])
+    for feature, column in SUM_FEATURES.items():
+        values = historical_data[column]
+        partials[feature] = window_sum(values.fillna(0) if values.hasnans else values)
+    for feature, column in MEAN_FEATURES.items():
+        values = historical_data[column]
+        sum_column, count_column = _mean_counters(feature)
+        partials[sum_column] = window_sum(values.fillna(0) if values.hasnans else values)
+        partials[count_column] = window_sum(values.notna())
+
+    # Flagged records (NCR or warning letter) in the prediction window
+    target_prefix = _prefix_sums(historical_data["ncr_or_warning_letter"].to_numpy()[order] == 1)
+    partials[FLAGGED_COLUMN] = (target_prefix[prediction_hi[window_index, supplier_index]] -
+                                target_prefix[prediction_lo[window_index, supplier_index]])
+    return pd.DataFrame(partials)
+
+
+def merge_window_partials(partials):
+    """
+    Merge the partials of several chunks of history, split by date or by
+    supplier: the counters of a (window, supplier) are added up.
+    :param partials: List of DataFrames returned by window_partials or merge_window_partials.
+    :return: DataFrame of merged partials, in (window, supplier) order.
+    """
+    merged = pd.concat(partials, ignore_index=True)
+    # Chunks have their own categories, merge the supplier ids as strings
+    merged["supplier_id"] = merged["supplier_id"].astype(str)
+    return merged.groupby(PARTIAL_KEYS, sort=True, as_index=False).sum()
+
+
+def finalize_window_partials(partials, windows):
+    """
+    Turn partials into the sliding-window dataset: means from their (sum,
+    count) pairs, window dates and target, for the (window, supplier) pairs
+    with records in the analysis window.
+    :param partials: Partials in (window, supplier) order, covering the whole history.
+    :param windows: Window bounds the partials were computed with.
+    :return: DataFrame with one row per (window, supplier with records in the analysis window).
+    """
+    partials = partials[partials[RECORDS_COLUMN].to_numpy() > 0]
+    result = {"supplier_id": partials["supplier_id"].array}
+    for feature in ["total_warnings"] + list(COUNT_FEATURES) + list(SUM_FEATURES):
+        result[feature] = partials[feature].to_numpy()
+    for feature in MEAN_FEATURES:
+        sum_column, count_column = _mean_counters(feature)
+        result[feature] = partials[sum_column].to_numpy() / partials[count_column].to_numpy()
+
+    # Add window metadata
+    window_index = partials["window"].to_numpy()
+    for bound, column in enumerate(WINDOW_COLUMNS):
+        result[column] = pd.DatetimeIndex([window[bound] for window in windows])[window_index]
+
+    # Target: the supplier has a record flagged as NCR or warning letter in the prediction window
+    result["ncr_or_warning_letter"] = (partials[FLAGGED_COLUMN].to_numpy() > 0).astype(int)
+    return pd.DataFrame(result, columns=SLIDING_WINDOW_COLUMNS)
+
+
+def sliding_window_aggregate(historical_data, analysis_window_size, prediction_window_size, step_size):
+    """
+    Aggregate the historical records of every supplier over sliding windows,
+    in one pass over the sorted history (see window_partials) instead of
+    filtering the whole history and grouping it again for each window.
+    :param historical_data: DataFrame with the historical records.
+    :param analysis_window_size: DateOffset of the analysis window.
+    :param prediction_window_size: DateOffset of the prediction window.
+    :param step_size: DateOffset between two consecutive windows.
+    :return: DataFrame with one row per (window, supplier with records in the
+             analysis window), same as the former per-window groupby loop.
+    """
+    record_dates = pd.to_datetime(historical_data["record_date"])
+    windows = window_bounds(record_dates.min(), record_dates.max(),
+                            analysis_window_size, prediction_window_size, step_size)
+    if not windows:
+        return pd.DataFrame(columns=SLIDING_WINDOW_COLUMNS)
+    return finalize_window_partials(window_partials(historical_data, windows), windows)
+
+
+if __name__ == "__main__":
+    # Time the engine on a large synthetic history
+    rng = np.random.default_rng(42)
+    n_records = 2_000_000
+    historical_data = pd.DataFrame({
+        "supplier_id": rng.choice([f"S{i}" for i in range(1, 50_001)], n_records),
+        "record_date": pd.Timestamp("2019-01-01") + pd.to_timedelta(rng.integers(0, 6 * 365, n_records), unit="D"),
+        "severity_level": rng.choice(["Minor", "Moderate", "Critical"], n_records),
+        "category_of_violation": rng.choice(["Safety", "Quality", "Documentation", "Regulatory"], n_records),
+        "resolution_status": rng.choice(["Resolved", "Pending", "Unresolved"], n_records),
+        "follow_up_actions": rng.choice([0, 1], n_records),
+        "length_of_letter": rng.integers(100, 1000, n_records),
+        "deadline_for_resolution": rng.integers(1, 30, n_records),
+        "ncr_or_warning_letter": rng.choice([0, 1], n_records),
+    })
+    start = time.perf_counter()
+    windows_df = sliding_window_aggregate(historical_data, pd.DateOffset(months=12), pd.DateOffset(months=6),
+                                          pd.DateOffset(months=3))
+    print(f"{n_records} records -> {len(windows_df)} window rows in {time.perf_counter() - start:.1f}s")
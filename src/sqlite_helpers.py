@@ -0,0 +1,14 @@
+# Maximum number of parameters per SQLite query
+SQLITE_BATCH_SIZE = 900
+
+
+def parameter_batches(values, batch_size=SQLITE_BATCH_SIZE):
+    """
+    Split the values bound to an "IN (...)" clause into batches that stay
+    under the parameter limit of SQLite.
+    :param values: List of values.
+    :param batch_size: Values per batch.
+    :return: Iterator of lists of at most batch_size values.
+    """
+    for start in range(0, len(values), batch_size):
+        yield values[start:start + batch_size]
@@ -0,0 +1,61 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+
+def build_supplier_index(data, date_column="analysis_start"):
+    """
+    Index the rows of every supplier, so a supplier is looked up without
+    scanning the whole dataset.
+    :param data: Sliding-window DataFrame.
+    :param date_column: Column ordering the rows of a supplier.
+    :return: Dictionary of supplier_id to the array of its row positions,
+             sorted by date; suppliers are in sorted order.
+    """
+    codes, suppliers = pd.factorize(np.asarray(data["supplier_id"]), sort=True)
+    dates = pd.to_datetime(data[date_column]).to_numpy()
+    order = np.lexsort((dates, codes))
+    splits = np.cumsum(np.bincount(codes, minlength=len(suppliers)))[:-1]
+    return dict(zip(suppliers, np.split(order, splits)))
+
+
+def window_rows(supplier_rows, analysis_starts, supplier_id, analysis_start):
+    """
+    Find the rows of a supplier for one window.
+    :param supplier_rows: Index returned by build_supplier_index.
+    :param analysis_starts: datetime64 array with the analysis_start of every row.
+    :param supplier_id: Supplier.
+    :param analysis_start: Start of the analysis window.
+    :return: Array of row positions.
+    """
+    rows = supplier_rows.get(supplier_id, np.array([], dtype=np.int64))
+    return rows[analysis_starts[rows] == pd.Timestamp(analysis_start).to_datetime64()]
+
+
+if __name__ == "__main__":
+    # Compare the index lookup with the former full scan
+    rng = np.random.default_rng(42)
+    n_rows = 2_000_000
+    data = pd.DataFrame({
+        "supplier_id": rng.choice([f"S{i}" for i in range(1, 50_001)], n_rows),
+        "analysis_start": pd.Timestamp("2019-01-01") + pd.to_timedelta(rng.integers(0, 20, n_rows) * 91, unit="D"),
+    })
+    queries = rng.choice(data["supplier_id"].unique(), 100)
+
+    start = time.perf_counter()
+    supplier_rows = build_supplier_index(data)
+    build_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for supplier_id in queries:
+        data[data["supplier_id"] == supplier_id].index[0]
+    scan_seconds = (time.perf_counter() - start) / len(queries)
+
+    start = time.perf_counter()
+    for supplier_id in queries:
+        supplier_rows[supplier_id][0]
+    index_seconds = (time.perf_counter() - start) / len(queries)
+
+    print(f"{n_rows} rows, index built in {build_seconds:.2f}s")
+    print(f"  per lookup: scan {scan_seconds * 1e3:.2f}ms, index {index_seconds * 1e6:.2f}us")
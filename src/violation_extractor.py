@@ -0,0 +1,153 @@
+import glob
+import re
+import time
+from bisect import bisect_right
+from collections import namedtuple
+from itertools import product
+
+from bs4 import BeautifulSoup
+
+# Violation kinds, in the order of the former violation_patterns:
+# kind -> (keyword, text ending the match after the keyword on the same line, or None)
+VIOLATION_KINDS = {
+    "failure": ("fail", " to "),  # "failure to maintain records."
+    "deviation": ("deviat", " to "),
+    "inadequacy": ("inadequat", " "),  # "inadequate documentation."
+    "lack": ("lack of ", None),  # "lack of access controls."
+}
+
+# Former patterns, kept for the parity check
+VIOLATION_PATTERNS = [
+    r"fail.* to .*?\.?",
+    r"deviat.* to .*?\.?",
+    r"inadequat.* .*?\.?",
+    r"lack of .*?\.?",
+]
+
+# All the keywords in one case-insensitive pattern, compiled once per process. The
+# alternation sits in a lookahead so that one scan reports every keyword start, even
+# where two keywords overlap ("fail" and "lack of" share the "l" of "failack of");
+# the group that matched gives the kind. The class of first letters in front skips
+# most positions without trying the alternation.
+KEYWORD_PATTERN = re.compile(
+    "(?=[" + "".join(sorted({keyword[0] for keyword, _ in VIOLATION_KINDS.values()})) + "])"
+    "(?=" + "|".join(f"({re.escape(keyword)})" for keyword, _ in VIOLATION_KINDS.values()) + ")", re.IGNORECASE)
+
+ViolationSpan = namedtuple("ViolationSpan", ["kind", "header", "start", "end", "text"])
+
+
+def _case_variants(text):
+    # Every upper/lower case spelling of a short ASCII text
+    return {"".join(chars) for chars in product(*((char.lower(), char.upper()) for char in text))}
+
+
+END_MARKER_VARIANTS = {marker: _case_variants(marker) for _, marker in VIOLATION_KINDS.values() if marker}
+
+
+def _last_marker(text, lowered, marker, start, end):
+    if lowered is not None:
+        return lowered.rfind(marker, start, end)
+    return max(text.rfind(variant, start, end) for variant in END_MARKER_VARIANTS[marker])
+
+
+def find_violations(headers):
+    """
+    Find the violations of a letter in one scan of its header texts for all
+    the keywords. Gives the same matches as re.findall with every former
+    pattern on every header: a match runs from its keyword to the last end
+    marker on the same line, which is found with rfind instead of regex
+    backtracking.
+    :param headers: List of the texts of the <strong>/<b> elements of the letter.
+    :return: List of ViolationSpan (kind, header index, start and end offsets in the header, text),
+             ordered by header, then kind, then position.
+    """
+    # Headers joined by newlines: matches never cross a newline, so never cross headers
+    text = "\n".join(headers)
+    lowered = text.lower() if text.isascii() else None
+    header_starts = [0]
+    for header in headers[:-1]:
+        header_starts.append(header_starts[-1] + len(header) + 1)
+
+    kinds = [(kind, keyword, end_marker) for kind, (keyword, end_marker) in VIOLATION_KINDS.items()]
+    found = []
+    next_allowed = [0] * len(kinds)
+    line_end = -1
+    for hit in KEYWORD_PATTERN.finditer(text):
+        start = hit.start()
+        position = hit.lastindex - 1
+        kind, keyword, end_marker = kinds[position]
+        # findall does not return overlapping matches of the same pattern
+        if start < next_allowed[position]:
+            continue
+        # The line and its last end markers are looked up once for all the keywords on the line
+        if start > line_end:
+            line_start = text.rfind("\n", 0, start) + 1
+            line_end = text.find("\n", start)
+            if line_end == -1:
+                line_end = len(text)
+            markers = {}
+        end = start + len(keyword)
+        if end_marker is not None:
+            if end_marker not in markers:
+                markers[end_marker] = _last_marker(text, lowered, end_marker, line_start, line_end)
+            if markers[end_marker] < end:
+                continue
+            end = markers[end_marker] + len(end_marker)
+        # Optional trailing period
+        if end < line_end and text[end] == ".":
+            end += 1
+        next_allowed[position] = end
+        found.append((bisect_right(header_starts, start) - 1, position, start, end, kind))
+
+    found.sort()
+    return [ViolationSpan(kind, header, start - header_starts[header], end - header_starts[header], text[start:end])
+            for header, _, start, end, kind in found]
+
+
+def find_violations_reference(headers):
+    """
+    Former extraction: every pattern applied with re.findall to every header.
+    """
+    violations = []
+    for header in headers:
+        for pattern in VIOLATION_PATTERNS:
+            violations.extend(re.findall(pattern, header, re.IGNORECASE))
+    return violations
+
+
+def violation_headers(soup):
+    """
+    :return: Texts of the <strong>/<b> elements of a parsed letter.
+    """
+    return [header.text for header in soup.find_all(["strong", "b"])]
+
+
+def violations_text(spans):
+    """
+    Join the violation texts as stored in the Violations column.
+    """
+    return ';'.join(span.text for span in spans)
+
+
+if __name__ == "__main__":
+    # Parity with the former patterns on the sample letters, then a microbenchmark
+    letters_headers = []
+    for path in sorted(glob.glob("../data/warning_letters/*.html")):
+        with open(path, encoding="utf-8") as f:
+            letters_headers.append(violation_headers(BeautifulSoup(f, "html.parser")))
+    # Long headers make the greedy patterns backtrack
+    long_headers = ["Failure to comply, " + "failed review of the records and " * 200 + "inadequate"] * 20
+    for headers in letters_headers + [long_headers]:
+        assert [span.text for span in find_violations(headers)] == find_violations_reference(headers)
+    n_spans = sum(len(find_violations(headers)) for headers in letters_headers)
+    print(f"Identical violations for {len(letters_headers)} letters ({n_spans} spans) and the long headers")
+
+    for label, corpus, repeats in [("sample letters", letters_headers, 200), ("long headers", [long_headers], 20)]:
+        timings = []
+        for function in (find_violations_reference, find_violations):
+            start = time.perf_counter()
+            for _ in range(repeats):
+                for headers in corpus:
+                    function(headers)
+            timings.append((time.perf_counter() - start) / repeats / len(corpus) * 1e6)
+        print(f"  {label}: patterns {timings[0]:.0f}us, single pass {timings[1]:.0f}us per letter")
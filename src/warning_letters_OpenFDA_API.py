@@ -1,9 +1,49 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
 import requests
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from letter_downloader import HostRateLimiter, fetch_with_retry, make_session
 
 # Base URL for the openFDA API
 FDA_API_URL = "https://api.fda.gov/food/enforcement.json"
 
+# openFDA paging limits: at most 1000 records per page and skip + limit <= 26000
+OPENFDA_MAX_LIMIT = 1000
+OPENFDA_MAX_SKIP = 25000
+
+# openFDA allows 240 requests per minute (per API key)
+OPENFDA_REQUESTS_PER_SECOND = 240 / 60
+
+OPENFDA_DATA_DIR = "../data/openFDA"
+RESPONSE_CACHE_DIR = OPENFDA_DATA_DIR + "/response_cache"
+
+# Sub-ranges ending less than this many days ago can still get records, their pages are not cached
+OPEN_RANGE_DAYS = 30
+ENFORCEMENT_PARQUET = OPENFDA_DATA_DIR + "/food_enforcement.parquet"
+
+# Fields of the flattened records, all stored as strings
+RECORD_FIELDS = [
+    "recall_number", "reason_for_recall", "product_description", "recalling_firm", "report_date", "state", "country",
+    "city", "status", "classification", "voluntary_mandated", "recall_initiation_date", "event_id",
+    "product_type", "distribution_pattern",
+]
+RECORD_SCHEMA = pa.schema([(field, pa.string()) for field in RECORD_FIELDS])
+
 def fetch_warning_letters(limit=10):
     """
     Fetch warning letters from the openFDA API.
@@ -44,13 +84,270 @@ def fetch_warning_letters(limit=10):
         print(f"Error fetching warning letters: {e}")
         return []
 
-# Fetch warning letters
-warning_letters = fetch_warning_letters(limit=20)
 
-# Convert to a DataFrame and save to CSV
-if warning_letters:
-    df = pd.DataFrame(warning_letters)
-    df.to_csv("warning_letters_openFDA.csv", index=False)
-    print("Warning letters saved to warning_letters.csv")
-else:
-    print("No warning letters found.")
+def date_subranges(start_date, end_date, months=3):
+    """
+    Split a date range into consecutive sub-ranges.
+    :param start_date: First day of the range.
+    :param end_date: Last day of the range (included).
+    :param months: Length of the sub-ranges in months.
+    :return: List of (first day, last day) Timestamp tuples.
+    """
+    start_date, end_date = pd.Timestamp(start_date), pd.Timestamp(end_date)
+    subranges = []
+    while start_date <= end_date:
+        next_start = start_date + pd.DateOffset(months=months)
+        subranges.append((start_date, min(next_start - pd.Timedelta(days=1), end_date)))
+        start_date = next_start
+    return subranges
+
+
+def _search(subrange):
+    return f"report_date:[{subrange[0]:%Y%m%d} TO {subrange[1]:%Y%m%d}]"
+
+
+def cache_key(url, params):
+    """
+    Key of a query in the response cache (the API key is not part of it).
+    :return: Hex digest.
+    """
+    query = {key: value for key, value in params.items() if key != "api_key"}
+    return hashlib.sha256(json.dumps([url, query], sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def is_closed_range(subrange, today=None, open_days=OPEN_RANGE_DAYS):
+    """
+    Tell whether a sub-range is closed history, i.e. ends more than open_days
+    ago, so no record will be reported in it any more.
+    :param subrange: (first day, last day) tuple.
+    :param today: Reference date (default: today).
+    :param open_days: Days before today during which a range is still open.
+    :return: True if the pages of the sub-range can be cached.
+    """
+    today = pd.Timestamp.today().normalize() if today is None else pd.Timestamp(today)
+    return subrange[1] < today - pd.Timedelta(days=open_days)
+
+
+def fetch_page(session, rate_limiter, url, params, cache_dir=RESPONSE_CACHE_DIR, cacheable=True):
+    """
+    Fetch one page of an openFDA query, from the on-disk cache when the same
+    query was fetched before. Only pages of closed history should be cached:
+    empty results (404) are never cached.
+    :param cacheable: Read and write the cache for this query (False for open date ranges).
+    :return: Parsed JSON response ({"meta": ..., "results": [...]}); no results gives an empty list.
+    """
+    path = os.path.join(cache_dir, cache_key(url, params) + ".json")
+    if cacheable and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    try:
+        data = fetch_with_retry(session, url, rate_limiter, params=params).json()
+    except requests.HTTPError as e:
+        # openFDA answers 404 when the search matches nothing
+        if e.response is None or e.response.status_code != 404:
+            raise
+        return {"meta": {"results": {"skip": params.get("skip", 0), "limit": params["limit"], "total": 0}},
+                "results": []}
+    if not cacheable:
+        return data
+    temporary_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(temporary_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(temporary_path, path)
+    return data
+
+
+def flatten_record(item):
+    """
+    Flatten an enforcement record to the RECORD_FIELDS, lists joined with "; ".
+    :return: Dictionary of strings (None for missing fields).
+    """
+    record = {}
+    for field in RECORD_FIELDS:
+        value = item.get(field)
+        if isinstance(value, list):
+            value = "; ".join(map(str, value))
+        record[field] = None if value is None else str(value)
+    return record
+
+
+def fetch_enforcement_records(start_date, end_date, output_path=ENFORCEMENT_PARQUET, url=FDA_API_URL,
+                              months=3, limit=OPENFDA_MAX_LIMIT, workers=4,
+                              requests_per_second=OPENFDA_REQUESTS_PER_SECOND, api_key=None,
+                              cache_dir=RESPONSE_CACHE_DIR):
+    """
+    Fetch every enforcement record reported between two dates and stream them to Parquet.
+    The range is split into sub-ranges, split again while one holds more
+    records than openFDA lets skip through. The pages of all sub-ranges are
+    fetched concurrently under a shared rate limit, cached on disk as raw
+    JSON when their date range is closed history (see is_closed_range), and
+    written page by page in date-range order.
+    :param start_date: First report date.
+    :param end_date: Last report date (included).
+    :param output_path: Output Parquet file.
+    :param url: openFDA endpoint.
+    :param months: Initial length of the sub-ranges in months.
+    :param limit: Records per page.
+    :param workers: Concurrent requests.
+    :param requests_per_second: Rate limit.
+    :param api_key: Optional openFDA API key.
+    :param cache_dir: Directory of the response cache.
+    :return: Number of records written.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    session = make_session(workers)
+    rate_limiter = HostRateLimiter(requests_per_second)
+    extra_params = {"api_key": api_key} if api_key else {}
+
+    def fetch(subrange, skip=0):
+        params = {"search": _search(subrange), "limit": limit, "skip": skip, **extra_params}
+        return fetch_page(session, rate_limiter, url, params, cache_dir, cacheable=is_closed_range(subrange))
+
+    with ThreadPoolExecutor(workers) as executor:
+        # First page of every sub-range, giving its total
+        first_pages = {}
+        pending = date_subranges(start_date, end_date, months)
+        while pending:
+            for subrange, data in zip(pending, executor.map(fetch, pending)):
+                first_pages[subrange] = data
+            too_large = [subrange for subrange in pending
+                         if first_pages[subrange]["meta"]["results"]["total"] > OPENFDA_MAX_SKIP + limit]
+            for subrange in [subrange for subrange in too_large if subrange[0] == subrange[1]]:
+                print(f"Only the first {OPENFDA_MAX_SKIP + limit} records of {subrange[0]:%Y-%m-%d} can be fetched")
+                too_large.remove(subrange)
+            pending = []
+            for subrange in too_large:
+                del first_pages[subrange]
+                middle = subrange[0] + (subrange[1] - subrange[0]) // 2
+                pending += [(subrange[0], middle.normalize()), (middle.normalize() + pd.Timedelta(days=1), subrange[1])]
+        subranges = sorted(first_pages)
+
+        # Remaining pages, fetched concurrently and written in order
+        pages = [(subrange, skip) for subrange in subranges
+                 for skip in range(limit, min(first_pages[subrange]["meta"]["results"]["total"],
+                                              OPENFDA_MAX_SKIP + limit), limit)]
+        page_results = executor.map(lambda page: fetch(*page), pages)
+
+        n_written = 0
+        with pq.ParquetWriter(output_path, RECORD_SCHEMA) as writer:
+            for subrange in subranges:
+                n_pages = sum(1 for page_subrange, _ in pages if page_subrange == subrange)
+                for data in [first_pages[subrange]] + [next(page_results) for _ in range(n_pages)]:
+                    records = [flatten_record(item) for item in data.get("results", [])]
+                    if records:
+                        writer.write_table(pa.Table.from_pylist(records, schema=RECORD_SCHEMA))
+                        n_written += len(records)
+    return n_written
+
+
+def serve_fake_openfda(records, port=0, failure_rate=0.0, seed=42):
+    """
+    Local stand-in for an openFDA endpoint: supports report_date range searches,
+    limit/skip paging, the 404 of empty searches and random 429 errors.
+    :param records: List of record dictionaries (with a report_date YYYYMMDD field).
+    :param port: Port to listen on (0: any free port).
+    :param failure_rate: Probability of answering 429 to a request.
+    :return: (server, endpoint URL, request counter dictionary); call server.shutdown() to stop it.
+    """
+    records = sorted(records, key=lambda item: (item["report_date"], item["recall_number"]))
+    search_pattern = re.compile(r"report_date:\[(\d{8})\s+TO\s+(\d{8})\]")
+    counter = {"requests": 0}
+    lock = threading.Lock()
+    random_state = random.Random(seed)
+
+    class FakeOpenFDAHandler(BaseHTTPRequestHandler):
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            with lock:
+                counter["requests"] += 1
+                fail = random_state.random() < failure_rate
+            if fail:
+                self._send_json(429, {"error": {"code": "TOO_MANY_REQUESTS"}})
+                return
+            query = parse_qs(urlparse(self.path).query)
+            limit = int(query.get("limit", ["1"])[0])
+            skip = int(query.get("skip", ["0"])[0])
+            if limit > OPENFDA_MAX_LIMIT or skip > OPENFDA_MAX_SKIP:
+                self._send_json(400, {"error": {"code": "BAD_REQUEST"}})
+                return
+            match = search_pattern.search(query.get("search", [""])[0])
+            matched = [item for item in records
+                       if match is None or match.group(1) <= item["report_date"] <= match.group(2)]
+            if not matched:
+                self._send_json(404, {"error": {"code": "NOT_FOUND", "message": "No matches found!"}})
+                return
+            self._send_json(200, {"meta": {"results": {"skip": skip, "limit": limit, "total": len(matched)}},
+                                  "results": matched[skip:skip + limit]})
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeOpenFDAHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/food/enforcement.json", counter
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetch openFDA food enforcement records")
+    parser.add_argument("--start", default="2022-01-01", help="First report date")
+    parser.add_argument("--end", default="2023-12-31", help="Last report date")
+    parser.add_argument("--output", default=ENFORCEMENT_PARQUET, help="Output Parquet file")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent requests")
+    parser.add_argument("--api-key", default=None, help="openFDA API key")
+    parser.add_argument("--fake-records", type=int, default=0,
+                        help="Fetch from a local fake openFDA server with this many records instead")
+    parser.add_argument("--single-page", action="store_true",
+                        help="Former behaviour: fetch 20 records and save them to CSV")
+    args = parser.parse_args()
+
+    if args.single_page:
+        # Fetch warning letters
+        warning_letters = fetch_warning_letters(limit=20)
+
+        # Convert to a DataFrame and save to CSV
+        if warning_letters:
+            df = pd.DataFrame(warning_letters)
+            df.to_csv("warning_letters_openFDA.csv", index=False)
+            print("Warning letters saved to warning_letters.csv")
+        else:
+            print("No warning letters found.")
+    elif args.fake_records:
+        # Fetch from the fake server twice (with random 429s): in the second run, the pages of the closed date
+        # ranges are served by the response cache
+        rng = random.Random(42)
+        days = (pd.Timestamp(args.end) - pd.Timestamp(args.start)).days + 1
+        records = [{"recall_number": f"F-{number:06d}-2023",
+                    "report_date": f"{pd.Timestamp(args.start) + pd.Timedelta(days=rng.randrange(days)):%Y%m%d}",
+                    "recalling_firm": f"Firm {rng.randrange(1000)}", "country": "United States",
+                    "openfda": {}} for number in range(args.fake_records)]
+        server, fake_url, counter = serve_fake_openfda(records, failure_rate=0.05)
+        folder = tempfile.mkdtemp()
+        try:
+            for label in ["first run", "cached run"]:
+                counter["requests"] = 0
+                start = time.perf_counter()
+                n_written = fetch_enforcement_records(args.start, args.end, os.path.join(folder, "records.parquet"),
+                                                      fake_url, months=1, workers=args.workers,
+                                                      requests_per_second=1000,
+                                                      cache_dir=os.path.join(folder, "cache"))
+                fetched = pd.read_parquet(os.path.join(folder, "records.parquet"))
+                complete = sorted(fetched["recall_number"]) == sorted(item["recall_number"] for item in records)
+                print(f"{label}: {n_written} records in {time.perf_counter() - start:.2f}s, "
+                      f"{counter['requests']} requests, all records fetched once: {complete}")
+        finally:
+            server.shutdown()
+            shutil.rmtree(folder)
+    else:
+        os.makedirs(os.path.dirname(args.output), exist_ok=True)
+        start = time.perf_counter()
+        n_written = fetch_enforcement_records(args.start, args.end, args.output, workers=args.workers,
+                                              api_key=args.api_key)
+        print(f"{n_written} records written to {args.output} in {time.perf_counter() - start:.1f}s")